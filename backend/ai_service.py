@@ -1,27 +1,39 @@
 import os
-import requests
+import re
 import json
+import uuid
+import time
+import asyncio
+import httpx
 from dotenv import load_dotenv
 from pathlib import Path
+from redis_client import redis_client
+from analysis_cache import analysis_cache, content_hash
 
 # Explicitly load .env from the backend directory
 env_path = Path(__file__).parent / '.env'
 load_dotenv(dotenv_path=env_path)
 
 GROQ_API_KEY = os.getenv("GROQ_API_KEY")
-GROQ_API_URL = "https://api.groq.com/openai/v1/chat/completions"
+# Overridable so tests can point at tests/fake_llm_server.py
+GROQ_API_URL = os.getenv("GROQ_API_URL", "https://api.groq.com/openai/v1/chat/completions")
+GROQ_MODEL = os.getenv("GROQ_MODEL", "llama-3.1-8b-instant")
+GROQ_TEMPERATURE = 0.1
+GROQ_TIMEOUT = float(os.getenv("GROQ_TIMEOUT", "30"))
 
-def analyze_content(content: str):
-    if not GROQ_API_KEY:
-        print("Warning: GROQ_API_KEY not found. Using dummy analysis.")
-        return False, 0.0, "", ""
+# At most this many LLM calls in flight per process
+AI_MAX_CONCURRENCY = int(os.getenv("AI_MAX_CONCURRENCY", "4"))
+# Jobs running at once. Most of them just wait on a shared micro-batch or
+# the LLM semaphore, so this is well above AI_MAX_CONCURRENCY; it has to be
+# at least AI_BATCH_MAX_ITEMS for a batch to ever fill up.
+AI_MAX_ACTIVE_JOBS = int(os.getenv("AI_MAX_ACTIVE_JOBS", "64"))
+AI_QUEUE_SIZE = int(os.getenv("AI_QUEUE_SIZE", "1000"))
+# Finished jobs stay pollable for this long
+AI_JOB_TTL = int(os.getenv("AI_JOB_TTL", "3600"))
 
-    if not content or len(content.strip()) < 10:
-        return False, 0.0, "", ""
-
-    system_prompt = """
+SYSTEM_PROMPT = """
     You are an expert Idea Extractor. Your job is to analyze the user's input (which could be a message or file content) and determine if it contains a Startup Idea, Business Concept, or Project Idea.
-    
+
     Output JSON ONLY:
     {
         "is_idea": boolean,
@@ -31,33 +43,343 @@ def analyze_content(content: str):
     }
     """
 
-    payload = {
-        "model": "llama-3.1-8b-instant",
-        "messages": [
-            {"role": "system", "content": system_prompt},
-            {"role": "user", "content": content[:15000]} 
-        ],
-        "temperature": 0.1,
-        "response_format": {"type": "json_object"}
+# Short chat messages are classified together in one prompt
+AI_BATCH_WINDOW = float(os.getenv("AI_BATCH_WINDOW", "0.05"))
+AI_BATCH_MAX_ITEMS = int(os.getenv("AI_BATCH_MAX_ITEMS", "16"))
+AI_BATCH_MAX_CHARS = int(os.getenv("AI_BATCH_MAX_CHARS", "1000"))
+
+BATCH_SYSTEM_PROMPT = """
+    You are an expert Idea Extractor. You receive a JSON object {"items": [{"i": number, "text": string}, ...]} of chat messages. For EACH item decide if it contains a Startup Idea, Business Concept, or Project Idea.
+
+    Output JSON ONLY, one result per item, same "i":
+    {
+        "results": [
+            {
+                "i": number,
+                "is_idea": boolean,
+                "confidence": float (0.0 to 1.0),
+                "summary": "Short 1-sentence summary of the idea",
+                "category": "Technology" | "Health" | "Finance" | "Education" | "Lifestyle" | "Other"
+            }
+        ]
     }
+    """
+
+# Cheap local pre-filter for short chat messages: ones with none of these
+# words never reach the model. Whole words only ("app" is not in "happy"),
+# plus simple inflections ("apps", "building").
+IDEA_HINTS = (
+    "idea", "what if", "we could", "we should", "how about", "propose", "proposal",
+    "app", "startup", "platform", "product", "business", "build", "launch",
+    "market", "customer", "feature", "service", "tool", "project", "solution",
+)
+IDEA_HINT_PATTERN = re.compile(
+    r"\b(" + "|".join(re.escape(hint) for hint in IDEA_HINTS) + r")(?:s|es|ed|ing)?\b")
+PREFILTER_MIN_WORDS = 5
+
+NOT_AN_IDEA = (False, 0.0, "", "")
+
+def prefilter_score(content: str) -> int:
+    # 0 means "obviously not an idea" (greetings, acks, one-liners)
+    words = content.split()
+    if len(words) < PREFILTER_MIN_WORDS:
+        return 0
+    return len({match.group(1) for match in IDEA_HINT_PATTERN.finditer(content.lower())})
+
+def parse_analysis(data: dict):
+    return data.get("is_idea", False), data.get("confidence", 0.0), data.get("summary", ""), data.get("category", "General")
+
+class AnalysisQueueFull(Exception):
+    pass
+
+class AIService:
+    """Async Groq client plus an in-process job queue.
+
+    One pooled httpx.AsyncClient is shared by every call and a semaphore caps
+    concurrent LLM requests, so a slow model never blocks the event loop.
+    Results are cached by content hash (see analysis_cache.py). Obvious
+    non-ideas among chat messages are dropped by a local pre-filter, and
+    short messages are micro-batched into one JSON-array prompt.
+    A dispatcher starts each queued job as its own task (up to
+    AI_MAX_ACTIVE_JOBS), so jobs waiting on an open batch don't hold up the
+    queue and a batch can actually fill.
+    Job state is kept in memory and mirrored to Redis (when connected) so any
+    API worker can answer a status poll.
+    """
 
-    try:
+    def __init__(self):
+        self.client = None
+        self.semaphore = asyncio.Semaphore(AI_MAX_CONCURRENCY)
+        self.queue = None
+        self.dispatcher = None
+        self.job_slots = asyncio.Semaphore(AI_MAX_ACTIVE_JOBS)
+        self.job_tasks = set()
+        # job_id -> job dict
+        self.jobs = {}
+        # content hash -> Future for analyses in flight
+        self.inflight = {}
+        # Open micro-batch of (content, Future)
+        self.batch = []
+        self.batch_timer = None
+        self.batch_tasks = set()
+        self.stats = {"prefiltered": 0, "batches": 0, "batched_items": 0}
+
+    async def start(self):
+        self.client = httpx.AsyncClient(
+            timeout=httpx.Timeout(GROQ_TIMEOUT, connect=5.0),
+            limits=httpx.Limits(max_connections=AI_MAX_CONCURRENCY, max_keepalive_connections=AI_MAX_CONCURRENCY),
+        )
+        self.queue = asyncio.Queue(maxsize=AI_QUEUE_SIZE)
+        self.dispatcher = asyncio.create_task(self.dispatch())
+        print(f"AI service started (up to {AI_MAX_ACTIVE_JOBS} active jobs).")
+
+    async def close(self):
+        tasks = list(self.job_tasks)
+        if self.dispatcher:
+            tasks.append(self.dispatcher)
+        for task in tasks:
+            task.cancel()
+        for task in tasks:
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+        self.dispatcher = None
+        self.job_tasks.clear()
+        if self.client:
+            await self.client.aclose()
+            print("AI service stopped.")
+
+    # --- LLM call ---
+
+    def is_analyzable(self, content: str) -> bool:
+        if not GROQ_API_KEY:
+            print("Warning: GROQ_API_KEY not found. Using dummy analysis.")
+            return False
+        return bool(content) and len(content.strip()) >= 10
+
+    async def request_analysis(self, content: str):
+        # Raises on any API/parse failure so callers can tell errors from answers
+        payload = {
+            "model": GROQ_MODEL,
+            "messages": [
+                {"role": "system", "content": SYSTEM_PROMPT},
+                {"role": "user", "content": content[:15000]}
+            ],
+            "temperature": GROQ_TEMPERATURE,
+            "response_format": {"type": "json_object"}
+        }
         headers = {
             "Authorization": f"Bearer {GROQ_API_KEY}",
             "Content-Type": "application/json"
         }
-        response = requests.post(GROQ_API_URL, headers=headers, json=payload, timeout=30)
-        
+
+        async with self.semaphore:
+            response = await self.client.post(GROQ_API_URL, headers=headers, json=payload)
+
         if response.status_code != 200:
-            print(f"Groq API Error ({response.status_code}): {response.text}")
-            return False, 0.0, "", ""
-            
+            raise RuntimeError(f"Groq API Error ({response.status_code}): {response.text}")
+
         result = response.json()
         content_str = result['choices'][0]['message']['content']
-        data = json.loads(content_str)
-        
-        return data.get("is_idea", False), data.get("confidence", 0.0), data.get("summary", ""), data.get("category", "General")
+        return parse_analysis(json.loads(content_str))
+
+    async def request_batch_analysis(self, texts: list) -> dict:
+        # One round trip for many short messages; returns {index: result}
+        payload = {
+            "model": GROQ_MODEL,
+            "messages": [
+                {"role": "system", "content": BATCH_SYSTEM_PROMPT},
+                {"role": "user", "content": json.dumps({"items": [{"i": i, "text": text} for i, text in enumerate(texts)]})}
+            ],
+            "temperature": GROQ_TEMPERATURE,
+            "response_format": {"type": "json_object"}
+        }
+        headers = {
+            "Authorization": f"Bearer {GROQ_API_KEY}",
+            "Content-Type": "application/json"
+        }
+
+        async with self.semaphore:
+            response = await self.client.post(GROQ_API_URL, headers=headers, json=payload)
+
+        if response.status_code != 200:
+            raise RuntimeError(f"Groq API Error ({response.status_code}): {response.text}")
+
+        result = response.json()
+        data = json.loads(result['choices'][0]['message']['content'])
+        results = {}
+        for item in data.get("results", []):
+            try:
+                results[int(item["i"])] = parse_analysis(item)
+            except (KeyError, TypeError, ValueError):
+                continue
+        return results
+
+    async def analyze_content(self, content: str, prefilter: bool = False):
+        result, _ = await self.analyze_with_cache(content, prefilter)
+        return result
+
+    async def analyze_with_cache(self, content: str, prefilter: bool = False):
+        """Returns (result, cached). cached is True when this content was
+        already analyzed (or is being analyzed right now by another job).
+
+        prefilter: content is a chat message; if it is short and has no idea
+        words, skip the model. Never used for extracted file text.
+        """
+        if not self.is_analyzable(content):
+            return NOT_AN_IDEA, False
+        if prefilter and len(content) <= AI_BATCH_MAX_CHARS and prefilter_score(content) == 0:
+            self.stats["prefiltered"] += 1
+            return NOT_AN_IDEA, False
+
+        key = content_hash(content[:15000], GROQ_MODEL, GROQ_TEMPERATURE)
+        cached = await analysis_cache.get(key)
+        if cached is not None:
+            return cached, True
+
+        # Identical content submitted concurrently shares one LLM call
+        pending = self.inflight.get(key)
+        if pending:
+            return await asyncio.shield(pending), True
+
+        pending = asyncio.get_running_loop().create_future()
+        self.inflight[key] = pending
+        result = NOT_AN_IDEA
+        try:
+            if len(content) <= AI_BATCH_MAX_CHARS:
+                result = await self.classify_batched(content)
+            else:
+                result = await self.request_analysis(content)
+            await analysis_cache.set(key, result)
+        except Exception as e:
+            # Failures are not cached
+            print(f"Groq Analysis Error: {e}")
+        finally:
+            self.inflight.pop(key, None)
+            pending.set_result(result)
+        return result, False
+
+    # --- Micro-batching ---
+
+    async def classify_batched(self, content: str):
+        # Joins the open batch; the first caller opens it and schedules the
+        # flush, a full batch flushes immediately
+        future = asyncio.get_running_loop().create_future()
+        self.batch.append((content, future))
+        if len(self.batch) >= AI_BATCH_MAX_ITEMS:
+            self.flush_batch()
+        elif self.batch_timer is None:
+            self.batch_timer = asyncio.get_running_loop().call_later(AI_BATCH_WINDOW, self.flush_batch)
+        return await future
+
+    def flush_batch(self):
+        if self.batch_timer:
+            self.batch_timer.cancel()
+            self.batch_timer = None
+        items, self.batch = self.batch, []
+        if items:
+            task = asyncio.create_task(self.send_batch(items))
+            self.batch_tasks.add(task)
+            task.add_done_callback(self.batch_tasks.discard)
+
+    async def send_batch(self, items):
+        if len(items) == 1:
+            content, future = items[0]
+            try:
+                future.set_result(await self.request_analysis(content))
+            except Exception as e:
+                future.set_exception(e)
+            return
+
+        self.stats["batches"] += 1
+        self.stats["batched_items"] += len(items)
+        try:
+            results = await self.request_batch_analysis([content for content, _ in items])
+        except Exception as e:
+            for _, future in items:
+                future.set_exception(e)
+            return
+
+        for i, (content, future) in enumerate(items):
+            if i in results:
+                future.set_result(results[i])
+                continue
+            # Model dropped this item; fall back to a single call
+            try:
+                future.set_result(await self.request_analysis(content))
+            except Exception as e:
+                future.set_exception(e)
+
+    # --- Job queue ---
+
+    async def submit(self, handler, *args) -> dict:
+        # handler is an async callable; its return value becomes job["result"]
+        job = {"id": uuid.uuid4().hex, "status": "queued", "result": None, "error": None, "created_at": time.time()}
+        try:
+            self.queue.put_nowait((job, handler, args))
+        except asyncio.QueueFull:
+            raise AnalysisQueueFull()
+        self.jobs[job["id"]] = job
+        await self.save_job(job)
+        return job
+
+    async def get_job(self, job_id: str):
+        job = self.jobs.get(job_id)
+        if job:
+            return job
+        redis = redis_client.get_client()
+        if redis:
+            try:
+                data = await redis.get(f"analysis_job:{job_id}")
+                if data:
+                    return json.loads(data)
+            except Exception as e:
+                print(f"Redis job lookup error: {e}")
+        return None
+
+    async def save_job(self, job: dict):
+        redis = redis_client.get_client()
+        if redis:
+            try:
+                await redis.set(f"analysis_job:{job['id']}", json.dumps(job, default=str), ex=AI_JOB_TTL)
+            except Exception as e:
+                print(f"Redis job save error: {e}")
+
+    async def dispatch(self):
+        # Hands jobs out in queue order without waiting for them to finish
+        while True:
+            job, handler, args = await self.queue.get()
+            await self.job_slots.acquire()
+            task = asyncio.create_task(self.run_job(job, handler, args))
+            self.job_tasks.add(task)
+            task.add_done_callback(self.job_tasks.discard)
+
+    async def run_job(self, job, handler, args):
+        try:
+            job["status"] = "running"
+            await self.save_job(job)
+            try:
+                job["result"] = await handler(*args)
+                job["status"] = "done"
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"Analysis job {job['id']} failed: {e}")
+                job["status"] = "failed"
+                job["error"] = str(e)
+            job["finished_at"] = time.time()
+            await self.save_job(job)
+            self.prune_jobs()
+        finally:
+            self.queue.task_done()
+            self.job_slots.release()
+
+    def prune_jobs(self):
+        cutoff = time.time() - AI_JOB_TTL
+        expired = [job_id for job_id, job in self.jobs.items() if job.get("finished_at", time.time()) < cutoff]
+        for job_id in expired:
+            del self.jobs[job_id]
 
-    except Exception as e:
-        print(f"Groq Analysis Error: {e}")
-        return False, 0.0, "", ""
+# Global instance
+ai_service = AIService()
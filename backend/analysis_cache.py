@@ -0,0 +1,93 @@
+import os
+import re
+import json
+import hashlib
+from collections import OrderedDict
+from redis_client import redis_client
+
+ANALYSIS_CACHE_SIZE = int(os.getenv("ANALYSIS_CACHE_SIZE", "2048"))
+ANALYSIS_CACHE_TTL = int(os.getenv("ANALYSIS_CACHE_TTL", str(7 * 24 * 3600)))
+# Bump when the prompt or output format changes so old entries stop matching
+ANALYSIS_CACHE_VERSION = "1"
+
+def normalize_content(content: str) -> str:
+    # Forwarded/re-pasted copies differ only in case and whitespace
+    return re.sub(r"\s+", " ", content or "").strip().lower()
+
+def content_hash(content: str, model: str, temperature: float) -> str:
+    key = f"{ANALYSIS_CACHE_VERSION}|{model}|{temperature}|{normalize_content(content)}"
+    return hashlib.sha256(key.encode("utf-8")).hexdigest()
+
+class AnalysisCache:
+    """Two-tier cache of LLM analysis results keyed by content hash.
+
+    Tier 1 is a per-process LRU; tier 2 is Redis with a TTL, shared by every
+    worker. Hit/miss counters are kept locally and in Redis.
+    """
+
+    def __init__(self, max_size: int = ANALYSIS_CACHE_SIZE):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    async def get(self, key: str):
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            await self.count("hits")
+            return self.entries[key]
+
+        redis = redis_client.get_client()
+        if redis:
+            try:
+                data = await redis.get(f"analysis_cache:{key}")
+                if data:
+                    value = tuple(json.loads(data))
+                    self.remember(key, value)
+                    await self.count("hits")
+                    return value
+            except Exception as e:
+                print(f"Analysis cache Redis error: {e}")
+
+        await self.count("misses")
+        return None
+
+    async def set(self, key: str, value: tuple):
+        self.remember(key, value)
+        redis = redis_client.get_client()
+        if redis:
+            try:
+                await redis.set(f"analysis_cache:{key}", json.dumps(list(value)), ex=ANALYSIS_CACHE_TTL)
+            except Exception as e:
+                print(f"Analysis cache Redis error: {e}")
+
+    def remember(self, key: str, value: tuple):
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    async def count(self, field: str):
+        setattr(self, field, getattr(self, field) + 1)
+        redis = redis_client.get_client()
+        if redis:
+            try:
+                await redis.hincrby("analysis_cache:stats", field, 1)
+            except Exception:
+                pass
+
+    async def stats(self) -> dict:
+        shared = {}
+        redis = redis_client.get_client()
+        if redis:
+            try:
+                shared = {k: int(v) for k, v in (await redis.hgetall("analysis_cache:stats")).items()}
+            except Exception as e:
+                print(f"Analysis cache Redis error: {e}")
+        return {
+            "local": {"hits": self.hits, "misses": self.misses, "size": len(self.entries)},
+            "shared": shared
+        }
+
+# Global instance
+analysis_cache = AnalysisCache()
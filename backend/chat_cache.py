@@ -0,0 +1,98 @@
+import os
+import json
+import time
+from database import db_pool
+
+# Entries are invalidated by pub/sub events; the TTL only bounds how stale
+# an entry can get if an event was missed (e.g. Redis reconnecting)
+CHAT_CACHE_TTL = float(os.getenv("CHAT_CACHE_TTL", "60"))
+CHAT_CACHE_MAX_ENTRIES = int(os.getenv("CHAT_CACHE_MAX_ENTRIES", "10000"))
+
+# Chat events that change what the cache holds
+INVALIDATING_EVENTS = ('"participant_update"', '"chat_deleted"')
+BLOCK_UPDATE = "block_update"
+
+class ChatCache:
+    """Per-worker cache of what the chat WebSocket needs for every inbound
+    message: chat type, member ids and block pairs between the members.
+
+    Loaded once per chat and shared by every socket on that chat. Kept
+    fresh by ConnectionManager event hooks: participant_update and
+    chat_deleted on chat:{id} drop that chat, block_update on user:{id}
+    drops every chat with both users in it.
+    """
+
+    def __init__(self):
+        # chat_id -> {"type", "is_private", "members": set, "blocks": set of (blocker, blocked), "loaded_at"}
+        self.chats = {}
+        self.stats = {"hits": 0, "misses": 0, "invalidations": 0}
+
+    async def get(self, chat_id: int):
+        entry = self.chats.get(chat_id)
+        if entry and time.monotonic() - entry["loaded_at"] < CHAT_CACHE_TTL:
+            self.stats["hits"] += 1
+            return entry
+        self.stats["misses"] += 1
+        entry = await self.load(chat_id)
+        if entry is None:
+            self.chats.pop(chat_id, None)
+            return None
+        if len(self.chats) >= CHAT_CACHE_MAX_ENTRIES:
+            # Oldest insertion first
+            self.chats.pop(next(iter(self.chats)), None)
+        self.chats[chat_id] = entry
+        return entry
+
+    async def load(self, chat_id: int):
+        async with db_pool.acquire() as conn:
+            chat = await conn.fetchrow("SELECT type, isPrivate FROM chats WHERE id = $1", chat_id)
+            if chat is None:
+                return None
+            chat_type = chat["type"]
+            members = {row["user_id"] for row in await conn.fetch(
+                "SELECT user_id FROM chat_participants WHERE chat_id = $1", chat_id)}
+            blocks = set()
+            if chat_type == 'private' and members:
+                rows = await conn.fetch('''
+                    SELECT blocker_id, blocked_id FROM blocked_users
+                    WHERE blocker_id = ANY($1::bigint[]) AND blocked_id = ANY($1::bigint[])
+                ''', list(members))
+                blocks = {(row["blocker_id"], row["blocked_id"]) for row in rows}
+        return {"type": chat_type, "is_private": chat["isprivate"] is not False, "members": members,
+                "blocks": blocks, "loaded_at": time.monotonic()}
+
+    def can_view(self, entry: dict, user_id) -> bool:
+        # Same rule as the user socket's subscribe: members, or anyone for public groups
+        return user_id in entry["members"] or (entry["type"] == 'group' and not entry["is_private"])
+
+    def is_blocked(self, entry: dict, sender_id) -> bool:
+        # Only 1-1 chats honour blocks: the other member blocked the sender
+        if entry["type"] != 'private' or sender_id is None:
+            return False
+        return any(blocked == sender_id and blocker != sender_id for blocker, blocked in entry["blocks"])
+
+    def invalidate(self, chat_id: int):
+        if self.chats.pop(chat_id, None) is not None:
+            self.stats["invalidations"] += 1
+
+    def invalidate_pair(self, user_a: int, user_b: int):
+        for chat_id, entry in list(self.chats.items()):
+            if user_a in entry["members"] and user_b in entry["members"]:
+                self.invalidate(chat_id)
+
+    def handle_event(self, kind: str, target_id: int, data: str):
+        # ConnectionManager event hook; a cheap substring test first so
+        # ordinary messages are never parsed here
+        if kind == "chat":
+            if target_id in self.chats and any(marker in data for marker in INVALIDATING_EVENTS):
+                self.invalidate(target_id)
+        elif kind == "user" and BLOCK_UPDATE in data:
+            try:
+                event = json.loads(data)
+                if event.get("type") == BLOCK_UPDATE:
+                    self.invalidate_pair(int(event["blocker_id"]), int(event["blocked_id"]))
+            except (ValueError, KeyError, TypeError):
+                pass
+
+# Global instance
+chat_cache = ChatCache()
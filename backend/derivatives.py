@@ -0,0 +1,120 @@
+import os
+import json
+import zipfile
+from file_extractor import extract_text, text_extractor, ExtractionTimeout
+from database import db_pool
+from outbox import append_outbox_many, outbox_relay, MESSAGE_UPDATED
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+THUMB_SIZE = int(os.getenv("THUMB_SIZE", "320"))
+THUMB_QUALITY = int(os.getenv("THUMB_QUALITY", "70"))
+PREVIEW_TEXT_CHARS = int(os.getenv("PREVIEW_TEXT_CHARS", "280"))
+# Skip thumbnailing absurd images (decompression bombs)
+THUMB_MAX_PIXELS = 80_000_000
+
+IMAGE_EXTENSIONS = {".jpg", ".jpeg", ".png", ".gif", ".webp", ".bmp"}
+# Office files usually embed a first-page/slide thumbnail at save time
+OFFICE_EXTENSIONS = {".docx", ".pptx", ".xlsx"}
+OFFICE_THUMBNAILS = ("docProps/thumbnail.jpeg", "docProps/thumbnail.jpg", "docProps/thumbnail.png")
+TEXT_PREVIEW_EXTENSIONS = {".txt", ".pdf", ".docx", ".pptx", ".xlsx", ".html", ".htm"}
+
+def thumb_path(blob_path: str) -> str:
+    # Stored next to the blob, served by the same immutable /uploads route
+    return f"{blob_path}.thumb.webp"
+
+def save_thumbnail(image, blob_path: str) -> dict:
+    if image.width * image.height > THUMB_MAX_PIXELS:
+        return {}
+    image.thumbnail((THUMB_SIZE, THUMB_SIZE))
+    if image.mode not in ("RGB", "RGBA"):
+        image = image.convert("RGBA" if "transparency" in image.info else "RGB")
+    out_path = thumb_path(blob_path)
+    tmp_path = f"{out_path}.tmp"
+    image.save(tmp_path, "WEBP", quality=THUMB_QUALITY)
+    os.replace(tmp_path, out_path)
+    return {
+        "thumbUrl": "/" + out_path.replace(os.sep, "/"),
+        "thumbWidth": image.width,
+        "thumbHeight": image.height,
+    }
+
+def image_thumbnail(blob_path: str) -> dict:
+    with Image.open(blob_path) as image:
+        # JPEG can decode straight at a reduced scale
+        image.draft("RGB", (THUMB_SIZE, THUMB_SIZE))
+        return save_thumbnail(image, blob_path)
+
+def office_thumbnail(blob_path: str) -> dict:
+    with zipfile.ZipFile(blob_path) as archive:
+        names = set(archive.namelist())
+        for name in OFFICE_THUMBNAILS:
+            if name in names:
+                with archive.open(name) as f, Image.open(f) as image:
+                    image.load()
+                    return save_thumbnail(image, blob_path)
+    return {}
+
+def make_derivatives(blob_path: str) -> dict:
+    """Builds the small stand-ins for an upload. Runs in the extraction
+    worker pool, so it's under the same time/memory limits."""
+    ext = os.path.splitext(blob_path)[1].lower()
+    result = {}
+    try:
+        if Image is not None and ext in IMAGE_EXTENSIONS:
+            result.update(image_thumbnail(blob_path))
+        elif Image is not None and ext in OFFICE_EXTENSIONS:
+            result.update(office_thumbnail(blob_path))
+    except ExtractionTimeout:
+        print(f"Thumbnail timed out for {blob_path}")
+    except Exception as e:
+        print(f"Thumbnail failed for {blob_path}: {e}")
+
+    if ext in TEXT_PREVIEW_EXTENSIONS:
+        text = extract_text(blob_path, PREVIEW_TEXT_CHARS * 2)
+        if text and not text.startswith("Error") and not text.startswith("Unsupported file format"):
+            snippet = " ".join(text.split())[:PREVIEW_TEXT_CHARS]
+            if snippet:
+                result["previewText"] = snippet
+    return result
+
+async def build_derivatives(name: str):
+    """Background step after a new blob is stored: generate derivatives,
+    record them on the blob and fill them into messages already sent."""
+    try:
+        await store_derivatives(name)
+    except Exception as e:
+        print(f"Derivative pipeline failed for {name}: {e}")
+
+async def store_derivatives(name: str):
+    blob_path = os.path.join("uploads", name)
+    result = await text_extractor.run(make_derivatives, blob_path, default={})
+    if not result:
+        return
+
+    file_url = f"/uploads/{name}"
+    async with db_pool.transaction() as conn:
+        digest, ext = os.path.splitext(name)
+        await conn.execute("UPDATE upload_blobs SET derivatives = $1 WHERE sha256 = $2 AND ext = $3",
+                           json.dumps(result), digest, ext)
+        # Messages sent before the pipeline finished
+        rows = await conn.fetch('''
+            UPDATE messages SET thumbUrl = $1, previewText = $2, synced = FALSE
+            WHERE fileUrl = $3 AND thumbUrl IS NULL AND previewText IS NULL
+            RETURNING *
+        ''', result.get("thumbUrl"), result.get("previewText"), file_url)
+        # One call so the chats get locked in id order, like other batches
+        await append_outbox_many(conn, [(row["chat_id"], MESSAGE_UPDATED, dict(row)) for row in rows])
+    if rows:
+        outbox_relay.notify()
+
+async def get_derivatives(conn, file_url: str) -> dict:
+    # Derivative fields for a message's fileUrl, if the pipeline has run
+    if not file_url or not file_url.startswith("/uploads/"):
+        return {}
+    digest, ext = os.path.splitext(file_url[len("/uploads/"):])
+    raw = await conn.fetchval("SELECT derivatives FROM upload_blobs WHERE sha256 = $1 AND ext = $2", digest, ext)
+    return json.loads(raw) if raw else {}
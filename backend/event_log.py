@@ -0,0 +1,141 @@
+import os
+import time
+import zlib
+import socket
+from redis_client import redis_client
+
+# How events travel between API workers:
+#   pubsub  - PUBLISH on chat:{id} / user:{id}; an event sent while a
+#             worker's subscription is down is lost for that worker
+#   streams - XADD to sharded Redis Streams; every worker reads them through
+#             its own consumer group, so it resumes where it stopped
+EVENT_TRANSPORT = os.getenv("EVENT_TRANSPORT", "pubsub")
+EVENT_STREAM_PREFIX = "events:"
+EVENT_STREAM_SHARDS = int(os.getenv("EVENT_STREAM_SHARDS", "16"))
+# Approximate per-shard cap (XADD MAXLEN ~); a worker further behind than this skips ahead
+EVENT_STREAM_MAXLEN = int(os.getenv("EVENT_STREAM_MAXLEN", "10000"))
+EVENT_READ_COUNT = int(os.getenv("EVENT_READ_COUNT", "500"))
+EVENT_READ_BLOCK_MS = int(os.getenv("EVENT_READ_BLOCK_MS", "1000"))
+# Groups whose consumers have been idle this long belong to dead workers
+EVENT_GROUP_IDLE_MS = int(os.getenv("EVENT_GROUP_IDLE_MS", str(60 * 60 * 1000)))
+# Set WORKER_ID to something stable (e.g. the pod name) to keep a worker's
+# group across restarts and catch up on what it missed while down
+WORKER_ID = os.getenv("WORKER_ID") or f"{socket.gethostname()}-{os.getpid()}"
+
+# Wall-clock ms stamped into events as they are published; receivers use it
+# for the publish -> socket latency histogram (assumes roughly synced clocks)
+PUBLISHED_AT = "published_at"
+
+def stamp(event: dict) -> dict:
+    event[PUBLISHED_AT] = round(time.time() * 1000, 3)
+    return event
+
+def published_at(event: dict):
+    value = event.get(PUBLISHED_AT) if isinstance(event, dict) else None
+    return value if isinstance(value, (int, float)) else None
+
+def use_streams() -> bool:
+    return EVENT_TRANSPORT == "streams"
+
+def stream_for(channel: str) -> str:
+    # Events for one chat/user always land in one shard, in order
+    return f"{EVENT_STREAM_PREFIX}{zlib.crc32(channel.encode()) % EVENT_STREAM_SHARDS}"
+
+def all_streams():
+    return [f"{EVENT_STREAM_PREFIX}{shard}" for shard in range(EVENT_STREAM_SHARDS)]
+
+def add_event(pipe, channel: str, data: str):
+    # Queue one event on a Redis pipeline with the configured transport
+    if use_streams():
+        pipe.xadd(stream_for(channel), {"channel": channel, "data": data},
+                  maxlen=EVENT_STREAM_MAXLEN, approximate=True)
+    else:
+        pipe.publish(channel, data)
+
+async def publish(channel: str, data: str):
+    redis = redis_client.get_client()
+    if not redis:
+        print("Redis not connected, skipping publish")
+        return
+    if use_streams():
+        await redis.xadd(stream_for(channel), {"channel": channel, "data": data},
+                         maxlen=EVENT_STREAM_MAXLEN, approximate=True)
+    else:
+        await redis.publish(channel, data)
+
+class StreamReader:
+    """Reads every event shard through this worker's consumer group.
+
+    One XREADGROUP call covers all shards, up to EVENT_READ_COUNT entries
+    each. Entries are acknowledged after dispatch, and entries this worker
+    was given but never acknowledged (crash, Redis hiccup) are delivered
+    again first, so delivery is at-least-once; clients drop repeats by seq.
+    """
+
+    def __init__(self):
+        self.group = f"ws:{WORKER_ID}"
+        self.stats = {"delivered": 0, "redelivered": 0, "acked": 0}
+
+    async def ensure_groups(self, redis):
+        for stream in all_streams():
+            try:
+                # "$": a new worker has no sockets yet, so no history needed
+                await redis.xgroup_create(stream, self.group, id="$", mkstream=True)
+            except Exception as e:
+                if "BUSYGROUP" not in str(e):
+                    raise
+
+    async def prune_groups(self, redis):
+        # Ephemeral groups of workers that died without cleaning up
+        for stream in all_streams():
+            try:
+                groups = await redis.xinfo_groups(stream)
+            except Exception:
+                continue
+            for group in groups:
+                name = group["name"]
+                if name == self.group or not name.startswith("ws:"):
+                    continue
+                consumers = await redis.xinfo_consumers(stream, name)
+                if all(consumer["idle"] > EVENT_GROUP_IDLE_MS for consumer in consumers):
+                    await redis.xgroup_destroy(stream, name)
+                    print(f"Event log: dropped idle group {name} on {stream}")
+
+    async def run(self, redis, dispatch):
+        await self.ensure_groups(redis)
+        await self.prune_groups(redis)
+        # "0" = our own unacknowledged entries; ">" = new entries
+        cursor = "0"
+        while True:
+            response = await redis.xreadgroup(
+                self.group, WORKER_ID, {stream: cursor for stream in all_streams()},
+                count=EVENT_READ_COUNT, block=None if cursor == "0" else EVENT_READ_BLOCK_MS)
+            if cursor == "0" and not any(entries for _, entries in response or []):
+                cursor = ">"
+                continue
+            for stream, entries in response or []:
+                ids = []
+                for entry_id, fields in entries:
+                    ids.append(entry_id)
+                    if not fields:
+                        # Trimmed away while pending; nothing left to deliver
+                        continue
+                    await dispatch(fields["channel"], fields["data"])
+                if not ids:
+                    continue
+                await redis.xack(stream, self.group, *ids)
+                self.stats["acked"] += len(ids)
+                if cursor == "0":
+                    self.stats["redelivered"] += len(ids)
+                else:
+                    self.stats["delivered"] += len(ids)
+
+    async def close(self, redis):
+        # Workers without a stable WORKER_ID never come back for their group
+        if os.getenv("WORKER_ID") or redis is None:
+            return
+        for stream in all_streams():
+            try:
+                await redis.xgroup_destroy(stream, self.group)
+            except Exception:
+                pass
@@ -1,4 +1,16 @@
 import os
+import signal
+import hashlib
+import asyncio
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
 try:
     from docx import Document
 except ImportError:
@@ -14,47 +26,300 @@ try:
 except ImportError:
     BeautifulSoup = None
 
-def extract_text(file_path: str) -> str:
+try:
+    from pypdf import PdfReader
+except ImportError:
+    PdfReader = None
+
+try:
+    from openpyxl import load_workbook
+except ImportError:
+    load_workbook = None
+
+# Analysis only ever looks at the first ~15k chars, so stop there
+EXTRACT_MAX_CHARS = int(os.getenv("EXTRACT_MAX_CHARS", "15000"))
+# Files bigger than this are not parsed at all
+EXTRACT_MAX_FILE_BYTES = int(os.getenv("EXTRACT_MAX_FILE_BYTES", str(50 * 1024 * 1024)))
+# HTML has to be parsed as a whole; only read this much of it
+EXTRACT_MAX_HTML_BYTES = int(os.getenv("EXTRACT_MAX_HTML_BYTES", str(2 * 1024 * 1024)))
+# Per-file limits, enforced inside the worker process
+EXTRACT_TIMEOUT = float(os.getenv("EXTRACT_TIMEOUT", "20"))
+EXTRACT_MAX_MEMORY_MB = int(os.getenv("EXTRACT_MAX_MEMORY_MB", "512"))
+EXTRACT_WORKERS = int(os.getenv("EXTRACT_WORKERS", "2"))
+
+# Extracted text is cached next to the uploads, keyed by content hash and
+# extractor version. Bump EXTRACTOR_VERSION when extraction output changes;
+# stale sidecars are then ignored and replaced on the next read.
+EXTRACTOR_VERSION = "2"
+EXTRACT_CACHE_DIR = os.getenv("EXTRACT_CACHE_DIR", os.path.join("uploads", ".extracted"))
+
+SUPPORTED_EXTENSIONS = ('.txt', '.pdf', '.docx', '.pptx', '.html', '.htm', '.xlsx')
+
+class ExtractionTimeout(Exception):
+    pass
+
+class PartialText(str):
+    """Text cut short by EXTRACT_TIMEOUT. Usable as-is, but never cached,
+    so the next read gets another chance at the full text."""
+
+# --- Lazy per-format readers: each yields text pieces in document order ---
+
+def iter_txt(file_path: str):
+    with open(file_path, "r", encoding="utf-8", errors="replace") as f:
+        while True:
+            chunk = f.read(64 * 1024)
+            if not chunk:
+                break
+            yield chunk
+
+def iter_docx(file_path: str):
+    if Document is None:
+        raise RuntimeError("Error: python-docx library not installed.")
+    doc = Document(file_path)
+    for para in doc.paragraphs:
+        yield para.text + "\n"
+
+def iter_pptx(file_path: str):
+    if Presentation is None:
+        raise RuntimeError("Error: python-pptx library not installed.")
+    prs = Presentation(file_path)
+    for slide in prs.slides:
+        for shape in slide.shapes:
+            if hasattr(shape, "text"):
+                yield shape.text + "\n"
+
+def iter_html(file_path: str):
+    if BeautifulSoup is None:
+        raise RuntimeError("Error: beautifulsoup4 library not installed.")
+    with open(file_path, "r", encoding="utf-8", errors="replace") as f:
+        markup = f.read(EXTRACT_MAX_HTML_BYTES)
+    soup = BeautifulSoup(markup, "lxml")
+    for text in soup.stripped_strings:
+        yield text + "\n"
+
+def iter_pdf(file_path: str):
+    if PdfReader is None:
+        raise RuntimeError("Error: pypdf library not installed.")
+    reader = PdfReader(file_path)
+    # Pages are parsed on access, so unread pages cost nothing
+    for page in reader.pages:
+        yield (page.extract_text() or "") + "\n"
+
+def iter_xlsx(file_path: str):
+    if load_workbook is None:
+        raise RuntimeError("Error: openpyxl library not installed.")
+    # read_only streams rows instead of loading every sheet into memory
+    workbook = load_workbook(file_path, read_only=True, data_only=True)
+    try:
+        for sheet in workbook.worksheets:
+            yield f"# {sheet.title}\n"
+            for row in sheet.iter_rows(values_only=True):
+                cells = [str(cell) for cell in row if cell is not None]
+                if cells:
+                    yield "\t".join(cells) + "\n"
+    finally:
+        workbook.close()
+
+READERS = {
+    ".txt": iter_txt,
+    ".docx": iter_docx,
+    ".pptx": iter_pptx,
+    ".html": iter_html,
+    ".htm": iter_html,
+    ".pdf": iter_pdf,
+    ".xlsx": iter_xlsx,
+}
+
+def extract_text(file_path: str, max_chars: int = EXTRACT_MAX_CHARS) -> str:
     """
     Extracts text content from various file formats.
+    Stops reading once max_chars have been collected.
     """
     if not os.path.exists(file_path):
         return ""
 
     ext = os.path.splitext(file_path)[1].lower()
+    reader = READERS.get(ext)
+    if reader is None:
+        return f"Unsupported file format: {ext}"
+
+    if os.path.getsize(file_path) > EXTRACT_MAX_FILE_BYTES:
+        print(f"Skipping extraction, file too large: {file_path}")
+        return ""
 
+    parts = []
+    total = 0
     try:
-        if ext == ".docx":
-            if Document is None:
-                return "Error: python-docx library not installed."
-            doc = Document(file_path)
-            return "\n".join([para.text for para in doc.paragraphs])
-        
-        elif ext == ".pptx":
-            if Presentation is None:
-                return "Error: python-pptx library not installed."
-            prs = Presentation(file_path)
-            text = []
-            for slide in prs.slides:
-                for shape in slide.shapes:
-                    if hasattr(shape, "text"):
-                        text.append(shape.text)
-            return "\n".join(text)
-        
-        elif ext == ".html" or ext == ".htm":
-            if BeautifulSoup is None:
-                return "Error: beautifulsoup4 library not installed."
-            with open(file_path, "r", encoding="utf-8") as f:
-                soup = BeautifulSoup(f, "lxml")
-                return soup.get_text(separator="\n")
-        
-        elif ext == ".txt":
-            with open(file_path, "r", encoding="utf-8") as f:
-                return f.read()
-        
-        else:
-            return f"Unsupported file format: {ext}"
-            
+        for piece in reader(file_path):
+            parts.append(piece)
+            total += len(piece)
+            if total >= max_chars:
+                break
+        return "".join(parts)[:max_chars]
+
+    except RuntimeError as e:
+        # Missing optional library
+        return str(e)
+    except ExtractionTimeout:
+        print(f"Extraction timed out for {file_path}, returning partial text")
+        return PartialText("".join(parts)[:max_chars])
+    except MemoryError:
+        print(f"Extraction hit the memory limit for {file_path}")
+        return ""
     except Exception as e:
         print(f"Error extracting text from {file_path}: {e}")
         return ""
+
+# --- Sidecar cache ---
+
+# path -> (size, mtime_ns, sha256) so unchanged files aren't rehashed
+file_digests = {}
+
+def file_digest(file_path: str) -> str:
+    stat = os.stat(file_path)
+    known = file_digests.get(file_path)
+    if known and known[0] == stat.st_size and known[1] == stat.st_mtime_ns:
+        return known[2]
+    sha = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            sha.update(block)
+    digest = sha.hexdigest()
+    file_digests[file_path] = (stat.st_size, stat.st_mtime_ns, digest)
+    return digest
+
+def sidecar_path(digest: str, max_chars: int) -> str:
+    return os.path.join(EXTRACT_CACHE_DIR, f"{digest}.v{EXTRACTOR_VERSION}.{max_chars}.txt")
+
+def read_sidecar(digest: str, max_chars: int):
+    try:
+        with open(sidecar_path(digest, max_chars), "r", encoding="utf-8") as f:
+            return f.read()
+    except FileNotFoundError:
+        return None
+
+def write_sidecar(digest: str, max_chars: int, text: str):
+    os.makedirs(EXTRACT_CACHE_DIR, exist_ok=True)
+    path = sidecar_path(digest, max_chars)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.write(text)
+    os.replace(tmp_path, path)
+    # Lazy invalidation: drop sidecars left by older extractor versions
+    for name in os.listdir(EXTRACT_CACHE_DIR):
+        if name.startswith(f"{digest}.v") and not name.startswith(f"{digest}.v{EXTRACTOR_VERSION}."):
+            try:
+                os.remove(os.path.join(EXTRACT_CACHE_DIR, name))
+            except OSError:
+                pass
+
+def is_cacheable(text: str) -> bool:
+    # Errors, empty and partial results (timeouts, missing libraries) are retried next time
+    if not text or isinstance(text, PartialText):
+        return False
+    return not text.startswith("Error") and not text.startswith("Unsupported file format")
+
+# --- Process pool (keeps parsing off the event loop and out of the API process) ---
+
+def limit_worker_memory():
+    if resource is not None and EXTRACT_MAX_MEMORY_MB > 0:
+        limit = EXTRACT_MAX_MEMORY_MB * 1024 * 1024
+        try:
+            resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+        except (ValueError, OSError) as e:
+            print(f"Could not set extraction memory limit: {e}")
+
+def on_extraction_timeout(signum, frame):
+    raise ExtractionTimeout()
+
+def run_with_timeout(func, *args):
+    # Runs in the main thread of a pool worker, so SIGALRM is available
+    use_alarm = hasattr(signal, "setitimer")
+    if use_alarm:
+        signal.signal(signal.SIGALRM, on_extraction_timeout)
+        signal.setitimer(signal.ITIMER_REAL, EXTRACT_TIMEOUT)
+    try:
+        return func(*args)
+    finally:
+        if use_alarm:
+            signal.setitimer(signal.ITIMER_REAL, 0)
+
+class TextExtractor:
+    def __init__(self):
+        self.pool = None
+
+    def start(self):
+        self.pool = ProcessPoolExecutor(
+            max_workers=EXTRACT_WORKERS,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=limit_worker_memory,
+        )
+        print(f"Extraction pool started ({EXTRACT_WORKERS} workers).")
+
+    def close(self):
+        if self.pool:
+            self.pool.shutdown(wait=False, cancel_futures=True)
+            self.pool = None
+            print("Extraction pool stopped.")
+
+    def restart(self, pool=None):
+        # A stuck or crashed worker takes the pool down with it; replace it.
+        # Every job on a broken pool fails at once: only the first one to
+        # report it (while `pool` is still current) replaces it.
+        if pool is not None and pool is not self.pool:
+            return
+        pool = self.pool
+        self.pool = None
+        if pool:
+            for process in list(getattr(pool, "_processes", {}).values()):
+                process.terminate()
+            pool.shutdown(wait=False, cancel_futures=True)
+        self.start()
+
+    async def extract(self, file_path: str, max_chars: int = EXTRACT_MAX_CHARS) -> str:
+        if not os.path.exists(file_path):
+            return ""
+        try:
+            digest = await asyncio.to_thread(file_digest, file_path)
+            cached = await asyncio.to_thread(read_sidecar, digest, max_chars)
+        except OSError as e:
+            print(f"Extraction cache unavailable for {file_path}: {e}")
+            digest, cached = None, None
+        if cached is not None:
+            return cached
+
+        text = await self.parse(file_path, max_chars)
+        if digest and is_cacheable(text):
+            try:
+                await asyncio.to_thread(write_sidecar, digest, max_chars, text)
+            except OSError as e:
+                print(f"Could not cache extracted text for {file_path}: {e}")
+        return text
+
+    async def parse(self, file_path: str, max_chars: int) -> str:
+        return await self.run(extract_text, file_path, max_chars, default="")
+
+    async def run(self, func, file_path: str, *args, default=None):
+        # Runs func(file_path, *args) in a worker under the per-file limits.
+        # func must be a module-level function (the pool uses spawn).
+        if self.pool is None:
+            self.start()
+        pool = self.pool
+        loop = asyncio.get_running_loop()
+        try:
+            # The worker enforces EXTRACT_TIMEOUT itself; this is the backstop
+            # for parsers stuck in C code where the alarm can't interrupt
+            return await asyncio.wait_for(
+                loop.run_in_executor(pool, run_with_timeout, func, file_path, *args),
+                timeout=EXTRACT_TIMEOUT + 5)
+        except asyncio.TimeoutError:
+            print(f"Extraction worker unresponsive for {file_path}, restarting pool")
+            self.restart(pool)
+            return default
+        except BrokenProcessPool:
+            print(f"Extraction worker died on {file_path}, restarting pool")
+            self.restart(pool)
+            return default
+
+# Global instance
+text_extractor = TextExtractor()
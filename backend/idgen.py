@@ -0,0 +1,163 @@
+import os
+import time
+import socket
+import asyncio
+import threading
+
+# Snowflake-style IDs, sized to stay exact as JavaScript numbers (53 bits):
+#   41 bits  milliseconds since ID_EPOCH_MS   (~69 years)
+#    5 bits  worker id                        (32 processes at once)
+#    7 bits  sequence within the millisecond  (128 ids/ms per worker)
+# IDs are time-ordered, and larger than the old timestamp*1000 ids, so
+# keyset pagination and "newest id wins" logic keep working across the switch.
+ID_EPOCH_MS = 1577836800000  # 2020-01-01T00:00:00Z
+WORKER_BITS = 5
+SEQUENCE_BITS = 7
+MAX_WORKERS = 1 << WORKER_BITS
+MAX_SEQUENCE = (1 << SEQUENCE_BITS) - 1
+
+# Worker ids are leased in Redis so two processes never share one.
+# ID_WORKER_ID pins it instead (only safe if you assign them yourself).
+# With neither, the generator refuses to start rather than risk collisions.
+ID_LEASE_TTL = int(os.getenv("ID_LEASE_TTL", "30"))
+ID_LEASE_RENEW = ID_LEASE_TTL / 3
+ID_LEASE_KEY = "idgen:worker:{}"
+
+# Renew only our own lease; an expired one is re-taken only if still free.
+# Returns 1 when we hold the slot afterwards, 0 when someone else does.
+RENEW_LEASE_SCRIPT = """
+local holder = redis.call('GET', KEYS[1])
+if holder == ARGV[1] then
+    redis.call('SET', KEYS[1], ARGV[1], 'EX', ARGV[2])
+    return 1
+elseif not holder then
+    if redis.call('SET', KEYS[1], ARGV[1], 'NX', 'EX', ARGV[2]) then
+        return 1
+    end
+end
+return 0
+"""
+
+def id_timestamp_ms(new_id: int) -> int:
+    # Unix milliseconds an id was generated at
+    return (new_id >> (WORKER_BITS + SEQUENCE_BITS)) + ID_EPOCH_MS
+
+class IdGenerator:
+    """Process-wide generator of unique, time-ordered 53-bit ids.
+
+    Ids from one process are strictly increasing. If the clock steps back,
+    or a millisecond's sequence runs out, generation carries on from the
+    last millisecond used instead of waiting or reusing values.
+    """
+
+    def __init__(self, worker_id: int = None):
+        self.worker_id = worker_id
+        self.owner = f"{socket.gethostname()}-{os.getpid()}"
+        self.last_ms = 0
+        self.last_clock_ms = 0
+        self.sequence = 0
+        self.lock = threading.Lock()
+        self.redis = None
+        self.renew_task = None
+        # monotonic time just before the last successful lease write; the
+        # lease can't have expired until ID_LEASE_TTL after it
+        self.lease_renewed_at = None
+        self.stats = {"generated": 0, "clock_backwards": 0, "sequence_overflow": 0}
+
+    async def start(self, redis=None):
+        pinned = os.getenv("ID_WORKER_ID")
+        if pinned is not None:
+            self.worker_id = int(pinned) % MAX_WORKERS
+        elif redis is not None:
+            self.redis = redis
+            try:
+                await self.acquire_lease()
+            except Exception as e:
+                self.redis = None
+                raise RuntimeError(f"ID generator: could not lease a worker slot ({e}); set ID_WORKER_ID") from e
+            self.renew_task = asyncio.create_task(self.renew_lease())
+        else:
+            raise RuntimeError("ID generator: Redis is not connected; set ID_WORKER_ID")
+        print(f"ID generator started (worker {self.worker_id}).")
+
+    async def stop(self):
+        if self.renew_task:
+            self.renew_task.cancel()
+            try:
+                await self.renew_task
+            except asyncio.CancelledError:
+                pass
+            self.renew_task = None
+        if self.redis and self.worker_id is not None:
+            try:
+                key = ID_LEASE_KEY.format(self.worker_id)
+                if await self.redis.get(key) == self.owner:
+                    await self.redis.delete(key)
+            except Exception as e:
+                print(f"ID generator: could not release lease: {e}")
+
+    async def acquire_lease(self):
+        # Start at a pid-derived slot so restarts don't all race for slot 0
+        start = os.getpid() % MAX_WORKERS
+        for offset in range(MAX_WORKERS):
+            candidate = (start + offset) % MAX_WORKERS
+            attempted_at = time.monotonic()
+            if await self.redis.set(ID_LEASE_KEY.format(candidate), self.owner, nx=True, ex=ID_LEASE_TTL):
+                self.lease_renewed_at = attempted_at
+                self.worker_id = candidate
+                return
+        raise RuntimeError(f"All {MAX_WORKERS} ID worker slots are leased")
+
+    async def renew_lease(self):
+        while True:
+            await asyncio.sleep(ID_LEASE_RENEW)
+            try:
+                if self.worker_id is not None:
+                    attempted_at = time.monotonic()
+                    held = await self.redis.eval(RENEW_LEASE_SCRIPT, 1, ID_LEASE_KEY.format(self.worker_id),
+                                                 self.owner, ID_LEASE_TTL)
+                    if held:
+                        self.lease_renewed_at = attempted_at
+                        continue
+                    # Our lease expired and someone else took the slot: stop
+                    # issuing ids with it until we hold a slot again
+                    print(f"ID generator: lost worker slot {self.worker_id}, leasing a new one")
+                    self.worker_id = None
+                await self.acquire_lease()
+            except Exception as e:
+                # next_id refuses once the lease may have expired
+                print(f"ID generator: lease renewal failed: {e}")
+
+    def next_id(self) -> int:
+        if self.worker_id is None:
+            raise RuntimeError("ID generator has no worker id (not started, or lease lost)")
+        if self.redis is not None and time.monotonic() - self.lease_renewed_at >= ID_LEASE_TTL:
+            # Redis unreachable too long: the slot may already be someone else's
+            raise RuntimeError(f"ID generator lease on worker {self.worker_id} may have expired")
+        with self.lock:
+            now = int(time.time() * 1000)
+            if now < self.last_clock_ms:
+                self.stats["clock_backwards"] += 1
+            self.last_clock_ms = now
+            if now < self.last_ms:
+                # Clock stepped back, or we ran ahead after sequence overflows
+                now = self.last_ms
+            if now == self.last_ms:
+                self.sequence += 1
+                if self.sequence > MAX_SEQUENCE:
+                    self.stats["sequence_overflow"] += 1
+                    now += 1
+                    self.sequence = 0
+            else:
+                self.sequence = 0
+            self.last_ms = now
+            self.stats["generated"] += 1
+            return (((now - ID_EPOCH_MS) << (WORKER_BITS + SEQUENCE_BITS))
+                    | (self.worker_id << SEQUENCE_BITS)
+                    | self.sequence)
+
+# Global instance
+id_generator = IdGenerator()
+
+def new_id() -> int:
+    return id_generator.next_id()
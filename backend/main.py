@@ -1,19 +1,25 @@
 import json
 import os
-import shutil
-from fastapi import FastAPI, WebSocket, WebSocketDisconnect, UploadFile, File, HTTPException, BackgroundTasks
+from fastapi import FastAPI, WebSocket, WebSocketDisconnect, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.staticfiles import StaticFiles
-from models import Message, IdeaAnalysis, FileInput
+from fastapi.responses import JSONResponse
+from models import Message, IdeaAnalysis
 from websocket_manager import ConnectionManager
-from ai_service import analyze_content
+from ai_service import ai_service, AnalysisQueueFull
+from analysis_cache import analysis_cache
 import firebase_admin
 from firebase_admin import credentials, firestore
-from datetime import datetime
+from datetime import datetime, timedelta, timezone
 from dotenv import load_dotenv
-from database import init_db, get_db_connection, get_db_cursor
-import psycopg2
+from database import init_db, db_pool, rows_affected
 from redis_client import redis_client
+from sync_worker import sync_worker
+import upload_store
+from derivatives import get_derivatives
+from chat_cache import chat_cache, BLOCK_UPDATE
+from idgen import id_generator
+from message_writer import message_writer, DuplicateMessage
+from outbox import outbox_relay, append_outbox, events_since, broadcast_payload, MESSAGE_CREATED, MESSAGE_UPDATED, MESSAGES_CLEARED, MESSAGES_UPDATED, MESSAGES_READ, CHAT_DELETED, PARTICIPANTS_CHANGED
 
 # Load environment variables
 load_dotenv()
@@ -37,20 +43,44 @@ app = FastAPI()
 
 # WebSocket Manager
 manager = ConnectionManager()
+manager.add_event_hook(chat_cache.handle_event)
+
+# Largest text accepted in one chat WebSocket frame
+WS_MAX_TEXT_CHARS = int(os.getenv("WS_MAX_TEXT_CHARS", "20000"))
 
 # Initialize DB & Redis
 @app.on_event("startup")
 async def startup_event():
     init_db() # Ensure tables exist
+    await db_pool.connect()
     await redis_client.connect()
+    await id_generator.start(redis_client.get_client()) # Leases a worker slot for unique ids
+    sync_worker.start(db) # Postgres -> Firestore mirror
+    outbox_relay.start(db) # Outbox -> Redis fan-out + Firestore
+    await ai_service.start() # Async LLM client + analysis job queue
+    text_extractor.start() # Process pool for file text extraction
+    manager.start() # One Redis pattern subscription for all WebSockets
+    message_writer.start() # Batched inserts for messages sent over chat sockets
 
 @app.on_event("shutdown")
 async def shutdown_event():
+    await manager.stop()
+    await message_writer.stop()
+    await ai_service.close()
+    text_extractor.close()
+    await outbox_relay.stop()
+    await sync_worker.stop()
+    await db_pool.close()
+    await id_generator.stop()
     await redis_client.close()
 
 # Create uploads directory
 os.makedirs("uploads", exist_ok=True)
-app.mount("/uploads", StaticFiles(directory="uploads"), name="uploads")
+
+@app.api_route("/uploads/{name:path}", methods=["GET", "HEAD"])
+async def get_upload(name: str, request: Request):
+    # Immutable caching, strong ETags (304s), Range for audio/video seeking
+    return await upload_store.serve_upload(request, name)
 
 # CORS
 app.add_middleware(
@@ -61,87 +91,32 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# --- Sync Logic ---
-def sync_to_firebase():
-    if not db:
-        return # Skip sync if firebase not configured
-        
-    print("Starting sync to Firebase...")
-    conn = get_db_connection()
-    cursor = get_db_cursor(conn)
-    
-    # Sync Messages
-    cursor.execute("SELECT * FROM messages WHERE synced = FALSE")
-    unsynced_messages = cursor.fetchall()
-    
-    for msg in unsynced_messages:
-        try:
-            chat_id = msg['chat_id']
-            # Get Firestore Chat Doc
-            chats_ref = db.collection("chats")
-            query = chats_ref.where("id", "==", chat_id).limit(1).stream()
-            
-            for doc in query:
-                messages_ref = doc.reference.collection("messages")
-                
-                msg_data = dict(msg)
-                # Remove internal fields
-                del msg_data['synced']
-                del msg_data['chat_id'] # Firestore structure is hierarchical
-                
-                # Convert boolean back if needed (SQLite stores 0/1)
-                msg_data['isPinned'] = bool(msg_data['isPinned'])
-                
-                # Add to Firestore
-                messages_ref.add(msg_data)
-                
-                # Update last message
-                doc.reference.update({
-                    "lastMessage": msg_data.get("text", "Sent a file"),
-                    "timestamp": msg_data.get("time")
-                })
-                
-                # Mark as synced in Postgres
-                conn.cursor().execute("UPDATE messages SET synced = TRUE WHERE id = %s", (msg['id'],))
-                conn.commit()
-                print(f"Synced message {msg['id']}")
-                
-        except Exception as e:
-            print(f"Failed to sync message {msg['id']}: {e}")
-            
-    conn.close()
-    print("Sync complete.")
-
 # --- Helper Functions ---
 
-def get_user(user_id: int):
-    conn = get_db_connection()
-    cursor = get_db_cursor(conn)
-    cursor.execute("SELECT * FROM users WHERE id = %s", (user_id,))
-    row = cursor.fetchone()
-    conn.close()
+def to_int(value):
+    # IDs arrive as ints, numeric strings or placeholders like "me"
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+async def get_user(user_id: int):
+    async with db_pool.acquire() as conn:
+        row = await conn.fetchrow("SELECT * FROM users WHERE id = $1", user_id)
     if row:
         return dict(row)
     return None
 
-def get_user_by_email(email: str):
-    conn = get_db_connection()
-    cursor = get_db_cursor(conn)
-    cursor.execute("SELECT * FROM users WHERE email = %s", (email,))
-    row = cursor.fetchone()
-    conn.close()
-    if row:
-        return dict(row)
+async def get_user_by_email(email: str):
+    async with db_pool.acquire() as conn:
+        row = await conn.fetchrow("SELECT * FROM users WHERE email = $1", email)
     if row:
         return dict(row)
     return None
 
-def get_user_by_phone(phone: str):
-    conn = get_db_connection()
-    cursor = get_db_cursor(conn)
-    cursor.execute("SELECT * FROM users WHERE phone = %s", (phone,))
-    row = cursor.fetchone()
-    conn.close()
+async def get_user_by_phone(phone: str):
+    async with db_pool.acquire() as conn:
+        row = await conn.fetchrow("SELECT * FROM users WHERE phone = $1", phone)
     if row:
         return dict(row)
     return None
@@ -150,37 +125,55 @@ def create_user_doc(user_data):
     # Deprecated: Use inline SQL in endpoints + sync
     pass
 
-def update_user_doc(user_id: int, update_data):
+async def update_user_doc(user_id: int, update_data):
     # This should update Postgres
-    conn = get_db_connection()
-    cursor = conn.cursor() # Standard cursor for updates is fine
-    
     # Construct SET clause dynamically
-    set_clause = ", ".join([f"{k} = %s" for k in update_data.keys()])
+    set_clause = ", ".join([f"{k} = ${i}" for i, k in enumerate(update_data.keys(), start=1)])
     values = list(update_data.values())
     values.append(user_id)
     
-    cursor.execute(f"UPDATE users SET {set_clause} WHERE id = %s", values)
-    conn.commit()
-    conn.close()
+    async with db_pool.acquire() as conn:
+        await conn.execute(f"UPDATE users SET {set_clause} WHERE id = ${len(values)}", *values)
 
-def get_chat_doc(chat_id: int):
-    conn = get_db_connection()
-    cursor = get_db_cursor(conn)
-    cursor.execute("SELECT * FROM chats WHERE id = %s", (chat_id,))
-    row = cursor.fetchone()
-    conn.close()
+async def get_chat_doc(chat_id: int):
+    async with db_pool.acquire() as conn:
+        row = await conn.fetchrow("SELECT * FROM chats WHERE id = $1", chat_id)
     if row:
         chat = dict(row)
-        # Parse JSON fields
-        if chat.get("participants"):
-            try:
-                chat["participants"] = json.loads(chat["participants"])
-            except:
-                chat["participants"] = []
+        chat["participants"] = chat.get("participants") or []
         return chat
     return None
 
+async def add_chat_member(conn, chat_id: int, user: dict, role: str = "member"):
+    # Membership lives in chat_participants; chats.participants is kept as the
+    # JSON profile snapshot the clients and the Firestore mirror read.
+    # Returns the updated participants list, or None if already a member.
+    user_id = to_int(user.get("id"))
+    if user_id is None:
+        return None
+    
+    inserted = await conn.fetchval('''
+        INSERT INTO chat_participants (chat_id, user_id, role)
+        VALUES ($1, $2, $3)
+        ON CONFLICT (chat_id, user_id) DO NOTHING
+        RETURNING user_id
+    ''', chat_id, user_id, role)
+    if inserted is None:
+        return None
+    
+    # Append server-side so concurrent joins can't overwrite each other
+    participants = await conn.fetchval('''
+        UPDATE chats
+        SET participants = COALESCE(participants, '[]'::jsonb) || $2::jsonb
+        WHERE id = $1
+        RETURNING participants
+    ''', chat_id, [user])
+    participants = participants or [user]
+    
+    # Broadcast + Firestore mirror go through the outbox (same transaction)
+    await append_outbox(conn, chat_id, PARTICIPANTS_CHANGED, {"participants": participants})
+    return participants
+
 # --- Endpoints ---
 
 
@@ -189,50 +182,91 @@ def get_chat_doc(chat_id: int):
 
 @app.get("/chats")
 async def get_chats(user_id: int = None):
-    conn = get_db_connection()
-    cursor = get_db_cursor(conn)
+    async with db_pool.acquire() as conn:
+        if user_id:
+            # Indexed membership lookup (idx_chat_participants_user_id)
+            rows = await conn.fetch('''
+                SELECT c.* FROM chat_participants cp
+                JOIN chats c ON c.id = cp.chat_id
+                WHERE cp.user_id = $1
+            ''', user_id)
+        else:
+            rows = await conn.fetch("SELECT * FROM chats")
     
-    if user_id:
-        cursor.execute("SELECT * FROM chats")
-    else:
-        cursor.execute("SELECT * FROM chats")
-        
-    rows = cursor.fetchall()
-    conn.close()
+    chats = []
+    for row in rows:
+        chat = dict(row)
+        # JSONB columns arrive decoded (database.init_connection)
+        chat["participants"] = chat.get("participants") or []
+        chats.append(chat)
+            
+    return chats
+
+UNREAD_COUNT_CAP = 999
+
+@app.get("/users/{user_id}/chats")
+async def get_user_chats(user_id: int):
+    # Sidebar list: only this user's chats, newest activity first, with the
+    # latest message and unread count resolved in the same query.
+    async with db_pool.acquire() as conn:
+        rows = await conn.fetch('''
+            SELECT c.*,
+                   lm.id AS last_message_id,
+                   lm.text AS last_message_text,
+                   lm.type AS last_message_type,
+                   lm.sender AS last_message_sender,
+                   lm.time AS last_message_time,
+                   uc.unread
+            FROM chat_participants cp
+            JOIN chats c ON c.id = cp.chat_id
+            LEFT JOIN LATERAL (
+                SELECT m.id, m.text, m.type, m.sender, m.time
+                FROM messages m
+                WHERE m.chat_id = c.id
+                ORDER BY m.id DESC
+                LIMIT 1
+            ) lm ON TRUE
+            LEFT JOIN LATERAL (
+                SELECT COUNT(*) AS unread FROM (
+                    SELECT 1 FROM messages m
+                    WHERE m.chat_id = c.id AND m.id > COALESCE(cp.last_read_id, 0) AND m.sender <> $2
+                    LIMIT $3
+                ) capped
+            ) uc ON TRUE
+            WHERE cp.user_id = $1
+            ORDER BY COALESCE(lm.id, c.id) DESC
+        ''', user_id, str(user_id), UNREAD_COUNT_CAP)
     
     chats = []
     for row in rows:
         chat = dict(row)
-        # Parse JSON fields
-        if chat.get("participants"):
-            try:
-                chat["participants"] = json.loads(chat["participants"])
-            except:
-                chat["participants"] = []
-        if chat.get("createdBy"):
-            try:
-                chat["createdBy"] = json.loads(chat["createdBy"])
-            except:
-                chat["createdBy"] = None
+        chat["participants"] = chat.get("participants") or []
+        chat["createdBy"] = chat.pop("createdby", None)
+        chat["isPrivate"] = chat.pop("isprivate", None)
         
-        # Filter if user_id is provided
-        if user_id:
-            participants = chat.get("participants", [])
-            if any(p.get("id") == user_id for p in participants):
-                chats.append(chat)
+        # Message ids are time ordered, so the latest message is the last activity
+        stored_preview = chat.pop("lastmessage", None)
+        last_id = chat.pop("last_message_id")
+        last_type = chat.pop("last_message_type")
+        last_text = chat.pop("last_message_text")
+        if last_id is not None:
+            chat["lastMessage"] = last_text if last_type in (None, "text") else (last_text or f"Sent a {last_type}")
         else:
-            chats.append(chat)
-            
+            chat["lastMessage"] = stored_preview
+        chat["lastMessageId"] = last_id
+        chat["lastMessageSender"] = chat.pop("last_message_sender")
+        chat["lastMessageTime"] = chat.pop("last_message_time")
+        chat["unread"] = chat.pop("unread") or 0
+        chats.append(chat)
     return chats
 
 @app.post("/chats")
-async def create_chat(chat_data: dict, background_tasks: BackgroundTasks):
+async def create_chat(chat_data: dict):
     import traceback
     try:
         print(f"Received chat_data: {chat_data}")
-        # Use Postgres SERIAL or manual ID? We used timestamp manual ID in SQLite.
-        # Postgres supports BIGINT Primary Key, so manual ID is fine.
-        new_id = int(datetime.now().timestamp() * 1000)
+        # Time-ordered id, unique across workers (idgen.py)
+        new_id = id_generator.next_id()
         
         new_chat = {
             "id": new_id,
@@ -242,35 +276,47 @@ async def create_chat(chat_data: dict, background_tasks: BackgroundTasks):
             "avatar": chat_data.get("avatar", f"https://ui-avatars.com/api/?name={chat_data['name']}&background=random"),
             "members": len(chat_data.get("participants", [])),
             "lastMessage": "Tap to start chatting",
-            "timestamp": datetime.now().isoformat(),
+            "timestamp": datetime.now(timezone.utc),
             "isPrivate": chat_data.get("isPrivate", False),
             "createdBy": chat_data.get("createdBy", None)
         }
         
         # 1. Save to Postgres
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        
-        import json
-        cursor.execute('''
-            INSERT INTO chats (id, name, type, participants, avatar, lastMessage, timestamp, isPrivate, createdBy, synced)
-            VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, FALSE)
-        ''', (
-            new_id,
-            new_chat["name"],
-            new_chat["type"],
-            json.dumps(new_chat["participants"]),
-            new_chat["avatar"],
-            new_chat["lastMessage"],
-            new_chat["timestamp"],
-            new_chat["isPrivate"], # Postgres handles bool natively
-            json.dumps(new_chat["createdBy"]) if new_chat["createdBy"] else None
-        ))
-        conn.commit()
-        conn.close()
+        async with db_pool.transaction() as conn:
+            await conn.execute('''
+                INSERT INTO chats (id, name, type, participants, avatar, lastMessage, timestamp, isPrivate, createdBy, synced)
+                VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9, FALSE)
+            ''',
+                new_id,
+                new_chat["name"],
+                new_chat["type"],
+                new_chat["participants"],
+                new_chat["avatar"],
+                new_chat["lastMessage"],
+                new_chat["timestamp"],
+                bool(new_chat["isPrivate"]), # Postgres handles bool natively
+                new_chat["createdBy"] or None
+            )
+            
+            # Membership rows (creator is the owner)
+            owner_id = to_int((new_chat["createdBy"] or {}).get("id")) if isinstance(new_chat["createdBy"], dict) else None
+            members = [
+                (new_id, to_int(p.get("id")), "owner" if to_int(p.get("id")) == owner_id else "member")
+                for p in new_chat["participants"] if isinstance(p, dict) and to_int(p.get("id")) is not None
+            ]
+            if members:
+                await conn.executemany('''
+                    INSERT INTO chat_participants (chat_id, user_id, role)
+                    VALUES ($1, $2, $3)
+                    ON CONFLICT (chat_id, user_id) DO NOTHING
+                ''', members)
+            
+            # Routes the new chat to its members' user sockets
+            await append_outbox(conn, new_id, PARTICIPANTS_CHANGED, {"participants": new_chat["participants"]})
         
         # 2. Trigger Background Sync
-        background_tasks.add_task(sync_to_firebase)
+        sync_worker.notify()
+        outbox_relay.notify()
         
         return new_chat
     except Exception as e:
@@ -282,34 +328,24 @@ async def create_chat(chat_data: dict, background_tasks: BackgroundTasks):
 
 @app.post("/chats/join")
 async def join_chat(request: dict):
-    chat_id = request.get("chat_id")
+    chat_id = to_int(request.get("chat_id"))
     user = request.get("user")
     
-    chat_doc_data = get_chat_doc(chat_id)
+    chat_doc_data = await get_chat_doc(chat_id)
     
     if not chat_doc_data:
         raise HTTPException(status_code=404, detail="Chat not found")
     
-    participants = chat_doc_data.get("participants", [])
-    # Parse if string
-    if isinstance(participants, str):
-        participants = json.loads(participants)
-
-    if not any(p.get("id") == user["id"] for p in participants):
-        participants.append(user)
-        
-        # Update Postgres. get_chat_doc handles fetch. update needs specific call
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        cursor.execute("UPDATE chats SET participants = %s, synced = FALSE WHERE id = %s", 
-                       (json.dumps(participants), chat_id))
-        conn.commit()
-        conn.close()
+    async with db_pool.transaction() as conn:
+        participants = await add_chat_member(conn, chat_id, user)
+    if participants is not None:
+        outbox_relay.notify()
+        chat_doc_data["participants"] = participants
             
     return {"message": "Joined chat", "chat": chat_doc_data}
 
 @app.post("/login")
-async def login(user_data: dict, background_tasks: BackgroundTasks):
+async def login(user_data: dict):
     email = user_data.get("email")
     phone = user_data.get("phone")
     id_token = user_data.get("idToken")
@@ -321,16 +357,16 @@ async def login(user_data: dict, background_tasks: BackgroundTasks):
     existing_user = None
     if phone:
         print(f"DEBUG: Login attempting lookup for phone: '{phone}'")
-        existing_user = get_user_by_phone(phone)
+        existing_user = await get_user_by_phone(phone)
         print(f"DEBUG: Lookup Result: {existing_user}")
     elif email:
-        existing_user = get_user_by_email(email)
+        existing_user = await get_user_by_email(email)
     
     if existing_user:
         return existing_user
     
     # New User
-    new_id = int(datetime.now().timestamp() * 1000)
+    new_id = id_generator.next_id()
 
     new_user = {
         "id": new_id,
@@ -344,32 +380,29 @@ async def login(user_data: dict, background_tasks: BackgroundTasks):
     }
     
     # 1. Save to Postgres
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute('''
-        INSERT INTO users (id, name, email, phone, avatar, status, lastSeen, username, synced)
-        VALUES (%s, %s, %s, %s, %s, %s, %s, %s, FALSE)
-    ''', (
-        new_user["id"],
-        new_user["name"],
-        new_user["email"],
-        new_user["phone"],
-        new_user["avatar"],
-        new_user["status"],
-        new_user["lastSeen"],
-        new_user["username"]
-    ))
-    conn.commit()
-    conn.close()
+    async with db_pool.acquire() as conn:
+        await conn.execute('''
+            INSERT INTO users (id, name, email, phone, avatar, status, lastSeen, username, synced)
+            VALUES ($1, $2, $3, $4, $5, $6, $7, $8, FALSE)
+        ''',
+            new_user["id"],
+            new_user["name"],
+            new_user["email"],
+            new_user["phone"],
+            new_user["avatar"],
+            new_user["status"],
+            new_user["lastSeen"],
+            new_user["username"]
+        )
     
     # 2. Trigger Sync
-    background_tasks.add_task(sync_to_firebase)
+    sync_worker.notify()
     
     return new_user
 
 @app.put("/users/{user_id}")
 async def update_user(user_id: int, user_data: dict):
-    user = get_user(user_id)
+    user = await get_user(user_id)
     if not user:
         return {"error": "User not found"}
     
@@ -379,7 +412,7 @@ async def update_user(user_id: int, user_data: dict):
         updates["avatar"] = f"https://ui-avatars.com/api/?name={user_data['name']}&background=random"
     
     if updates:
-        update_user_doc(user_id, updates)
+        await update_user_doc(user_id, updates)
         # Return updated user
         user.update(updates)
         return user
@@ -387,7 +420,7 @@ async def update_user(user_id: int, user_data: dict):
 
 @app.post("/set_username")
 async def set_username(request: dict):
-    user_id = request.get("user_id")
+    user_id = to_int(request.get("user_id"))
     username = request.get("username")
     
     if not user_id or not username:
@@ -397,33 +430,25 @@ async def set_username(request: dict):
     if len(username) < 3:
         raise HTTPException(status_code=400, detail="Username must be at least 3 characters")
         
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    
-    # Check uniqueness
-    cursor.execute("SELECT 1 FROM users WHERE username = %s", (username,))
-    if cursor.fetchone():
-        conn.close()
-        raise HTTPException(status_code=400, detail="Username already taken")
-        
-    # Update user (username AND name)
-    cursor.execute("UPDATE users SET username = %s, name = %s, synced = FALSE WHERE id = %s", (username, username, user_id))
-    conn.commit()
-    conn.close()
+    async with db_pool.acquire() as conn:
+        # Check uniqueness
+        if await conn.fetchval("SELECT 1 FROM users WHERE username = $1", username):
+            raise HTTPException(status_code=400, detail="Username already taken")
+            
+        # Update user (username AND name)
+        await conn.execute("UPDATE users SET username = $1, name = $2, synced = FALSE WHERE id = $3", username, username, user_id)
+    sync_worker.notify()
     
     return {"message": "Username set successfully", "username": username}
 
 @app.get("/ideas")
 async def get_ideas():
-    conn = get_db_connection()
-    cursor = get_db_cursor(conn)
-    cursor.execute("SELECT * FROM ideas ORDER BY timestamp DESC")
-    ideas = cursor.fetchall()
-    conn.close()
+    async with db_pool.acquire() as conn:
+        ideas = await conn.fetch("SELECT * FROM ideas ORDER BY timestamp DESC NULLS LAST")
     
     # Map Schema to Component Expectation
     mapped_ideas = []
-    for idea in ideas:
+    for idea in map(dict, ideas):
         mapped_ideas.append({
             "id": idea.get("id"),
             "title": idea.get("text", "Untitled Idea"), # Using text as title
@@ -437,72 +462,56 @@ async def get_ideas():
     return mapped_ideas
 
 @app.post("/ideas")
-async def add_idea(idea: dict, background_tasks: BackgroundTasks):
-    new_id = int(datetime.now().timestamp() * 1000)
-    
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute('''
-        INSERT INTO ideas (id, text, category, votes, timestamp, is_analyzed, synced)
-        VALUES (%s, %s, %s, %s, %s, %s, FALSE)
-    ''', (
-        new_id,
-        idea.get("text") or idea.get("title"), 
-        idea.get("category") or idea.get("content"), 
-        0,
-        datetime.now().isoformat(),
-        False
-    ))
-    conn.commit()
-    conn.close()
-    
-    background_tasks.add_task(sync_to_firebase)
+async def add_idea(idea: dict):
+    new_id = id_generator.next_id()
+    
+    async with db_pool.acquire() as conn:
+        await conn.execute('''
+            INSERT INTO ideas (id, text, category, votes, timestamp, is_analyzed, synced)
+            VALUES ($1, $2, $3, $4, $5, $6, FALSE)
+        ''',
+            new_id,
+            idea.get("text") or idea.get("title"), 
+            idea.get("category") or idea.get("content"), 
+            0,
+            datetime.now(timezone.utc),
+            False
+        )
+    
+    sync_worker.notify()
     
     # Return what frontend expects
     idea["id"] = new_id
     return idea
 
 @app.delete("/ideas/{idea_id}")
-async def delete_idea(idea_id: int, background_tasks: BackgroundTasks):
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute("DELETE FROM ideas WHERE id = %s", (idea_id,))
-    if cursor.rowcount == 0:
-        conn.close()
+async def delete_idea(idea_id: int):
+    async with db_pool.acquire() as conn:
+        result = await conn.execute("DELETE FROM ideas WHERE id = $1", idea_id)
+    if rows_affected(result) == 0:
         raise HTTPException(status_code=404, detail="Idea not found")
-    conn.commit()
-    conn.close()
     
-    background_tasks.add_task(sync_to_firebase)
     return {"message": "Idea deleted"}
 
 @app.get("/chats/public")
 async def get_public_chats():
-    conn = get_db_connection()
-    cursor = get_db_cursor(conn)
-    # Filter for public groups (type='group' and isPrivate=FALSE)
-    cursor.execute("SELECT * FROM chats WHERE type = 'group' AND isPrivate = FALSE")
-    rows = cursor.fetchall()
-    conn.close()
+    async with db_pool.acquire() as conn:
+        # Filter for public groups (type='group' and isPrivate=FALSE)
+        rows = await conn.fetch("SELECT * FROM chats WHERE type = 'group' AND isPrivate = FALSE")
     
     public_chats = []
     for row in rows:
         chat = dict(row)
-        # Parse JSON fields
-        if chat.get("participants") and isinstance(chat["participants"], str):
-            try:
-                chat["participants"] = json.loads(chat["participants"])
-            except:
-                chat["participants"] = []
+        chat["participants"] = chat.get("participants") or []
         public_chats.append(chat)
     return public_chats
 
 @app.post("/chats/join")
-async def join_chat(request: dict, background_tasks: BackgroundTasks):
-    chat_id = request.get("chat_id")
+async def join_chat(request: dict):
+    chat_id = to_int(request.get("chat_id"))
     user = request.get("user")
     
-    chat_doc_data = get_chat_doc(chat_id)
+    chat_doc_data = await get_chat_doc(chat_id)
     
     if not chat_doc_data:
         # Auto-create if not exists (legacy behavior)
@@ -514,441 +523,406 @@ async def join_chat(request: dict, background_tasks: BackgroundTasks):
             "avatar": f"https://ui-avatars.com/api/?name=Group {chat_id}&background=random",
             "members": 1,
             "lastMessage": "Tap to start chatting",
-            "timestamp": datetime.now().isoformat(),
+            "timestamp": datetime.now(timezone.utc),
             "isPrivate": False,
             "createdBy": None
         }
         
-        # Save to SQLite
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        import json
-        cursor.execute('''
-            INSERT INTO chats (id, name, type, participants, avatar, lastMessage, timestamp, isPrivate, createdBy, synced)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, 0)
-        ''', (
-            new_chat["id"],
-            new_chat["name"],
-            new_chat["type"],
-            json.dumps(new_chat["participants"]),
-            new_chat["avatar"],
-            new_chat["lastMessage"],
-            new_chat["timestamp"],
-            0,
-            None
-        ))
-        conn.commit()
-        conn.close()
+        # Save to Postgres
+        async with db_pool.transaction() as conn:
+            await conn.execute('''
+                INSERT INTO chats (id, name, type, participants, avatar, lastMessage, timestamp, isPrivate, createdBy, synced)
+                VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9, FALSE)
+            ''',
+                new_chat["id"],
+                new_chat["name"],
+                new_chat["type"],
+                [],
+                new_chat["avatar"],
+                new_chat["lastMessage"],
+                new_chat["timestamp"],
+                False,
+                None
+            )
+            await add_chat_member(conn, chat_id, user, role="owner")
         
-        background_tasks.add_task(sync_to_firebase)
+        sync_worker.notify()
+        outbox_relay.notify()
         return {"message": "Joined new chat", "chat": new_chat}
     
     # Update existing chat
-    # 1. Read from Postgres
-    conn = get_db_connection()
-    cursor = get_db_cursor(conn)
-    cursor.execute("SELECT participants FROM chats WHERE id = %s", (chat_id,))
-    row = cursor.fetchone()
-    
-    if not row:
-        # If not in SQLite but in Firestore (edge case), we might need to fetch from Firestore.
-        # But for "Local First", we assume SQLite is master or synced.
-        # If missing in SQLite, we should probably fetch from Firestore or error.
-        # Given the hybrid nature, let's try to get from SQLite.
-        pass 
-    
-    participants = []
-    if row:
-        import json
-        try:
-            participants = json.loads(row["participants"])
-        except:
-            participants = []
-            
-    if not any(p.get("id") == user["id"] for p in participants):
-        participants.append(user)
-        
-        # Update Postgres
-        # Logic above reuses conn implicitly if not closed, but here we closed nothing.
-        # Actually line 512 closes conn.
-        # Let's keep it clean.
-        cursor = conn.cursor()
-        cursor.execute('''
-            UPDATE chats 
-            SET participants = %s, synced = FALSE 
-            WHERE id = %s
-        ''', (json.dumps(participants), chat_id))
-        conn.commit()
-        
-        background_tasks.add_task(sync_to_firebase)
-        
-    conn.close()
+    async with db_pool.transaction() as conn:
+        participants = await add_chat_member(conn, chat_id, user)
+    
+    if participants is not None:
+        outbox_relay.notify()
+    else:
+        participants = chat_doc_data.get("participants", [])
             
     return {"message": "Joined chat", "chat": {"id": chat_id, "participants": participants}}
 
 
 
+MESSAGES_PAGE_SIZE = 50
+MESSAGES_MAX_PAGE_SIZE = 200
+
 @app.get("/chats/{chat_id}/messages")
-async def get_messages(chat_id: int, user_id: int = None):
-    conn = get_db_connection()
-    try:
-        cursor = get_db_cursor(conn)
-        cursor.execute("SELECT * FROM messages WHERE chat_id = %s ORDER BY id ASC", (chat_id,))
-        messages = []
-        
-        import json
+async def get_messages(chat_id: int, user_id: int = None, before_id: int = None, after_id: int = None, limit: int = MESSAGES_PAGE_SIZE):
+    # Keyset pagination on (chat_id, id):
+    #   no cursor  -> newest page
+    #   before_id  -> older page (scroll back)
+    #   after_id   -> newer page (catch up)
+    if before_id is not None and after_id is not None:
+        raise HTTPException(status_code=400, detail="Use either before_id or after_id, not both")
+    limit = max(1, min(limit, MESSAGES_MAX_PAGE_SIZE))
+    
+    async with db_pool.acquire() as conn:
+        # Read first: anything committed after this arrives on the socket
+        # (or is replayed from this seq on reconnect)
+        last_seq = await conn.fetchval("SELECT last_seq FROM chats WHERE id = $1", chat_id) or 0
+        conditions = ["m.chat_id = $1"]
+        params = [chat_id]
+        if after_id is not None:
+            params.append(after_id)
+            conditions.append(f"m.id > ${len(params)}")
+        elif before_id is not None:
+            params.append(before_id)
+            conditions.append(f"m.id < ${len(params)}")
+        if user_id:
+            # 'Delete for me': anti-join on message_hidden's (user_id, message_id)
+            # key, so pages are always full and nothing is filtered afterwards
+            params.append(user_id)
+            conditions.append(f"NOT EXISTS (SELECT 1 FROM message_hidden h WHERE h.user_id = ${len(params)} AND h.message_id = m.id)")
+        params.append(limit + 1)
+        order = "ASC" if after_id is not None else "DESC"
+        rows = await conn.fetch(
+            f"SELECT m.* FROM messages m WHERE {' AND '.join(conditions)} ORDER BY m.id {order} LIMIT ${len(params)}",
+            *params)
+    
+    # We asked for one extra row to know if there is another page
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    if after_id is None:
+        rows = list(reversed(rows)) # Always return oldest -> newest
         
-        for row in cursor.fetchall():
-            msg = dict(row)
-            
-            # Check 'Delete for Me' logic
-            if user_id and msg.get("deleted_for"):
-                try:
-                    deleted_for_list = json.loads(msg["deleted_for"])
-                    if any(str(u) == str(user_id) for u in deleted_for_list):
-                        continue # Skip this message
-                except Exception as e:
-                    pass
-                    
-            # Parse replyTo JSON if it exists
-            if msg.get("replyTo"):
-                try:
-                    msg["replyTo"] = json.loads(msg["replyTo"])
-                except:
-                    msg["replyTo"] = None
-            messages.append(msg)
-        return messages
-    finally:
-        conn.close()
+    messages = [dict(row) for row in rows]
+    
+    oldest_id = rows[0]["id"] if rows else None
+    newest_id = rows[-1]["id"] if rows else None
+    older_available = has_more if after_id is None else True
+    
+    return {
+        "messages": messages,
+        "has_more": has_more,
+        # Pass as before_id to load the previous (older) page
+        "next_before_id": oldest_id if older_available and oldest_id is not None else None,
+        # Pass as after_id to fetch anything newer than this page
+        "next_after_id": newest_id if newest_id is not None else after_id,
+        # Pass as last_seq when opening the chat WebSocket to resume from here
+        "last_seq": last_seq,
+    }
 
 @app.post("/chats/{chat_id}/messages")
-async def send_message(chat_id: int, message: Message, background_tasks: BackgroundTasks):
-    # 1. Save to Postgres
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    
+async def send_message(chat_id: int, message: Message):
     # Check Blocking Logic
     sender_id = message.sender 
     # If sender is "me", we need valid ID. But this endpoint expects valid ID or string.
     
-    # 1. Fetch participants of this chat to check if any of them blocked the sender
-    cursor.execute("SELECT type, participants FROM chats WHERE id = %s", (chat_id,))
-    chat_row = cursor.fetchone()
-    
-    if chat_row:
-        chat_type = chat_row[0]
-        participants = json.loads(chat_row[1])
-        if chat_type == 'private':
-            # Find the other person
-            other_user_id = next((p['id'] for p in participants if str(p['id']) != str(sender_id)), None)
-            if other_user_id:
-                # Check if other_user blocked sender
-                cursor.execute("SELECT 1 FROM blocked_users WHERE blocker_id = %s AND blocked_id = %s", (other_user_id, sender_id))
-                if cursor.fetchone():
-                    conn.close()
-                    raise HTTPException(status_code=403, detail="You are blocked by this user.")
-
-    # Generate ID using timestamp
-    # Postgres supports BIGINT, manual ID is ok.
-    new_id = int(datetime.now().timestamp() * 1000)
+    # Time-ordered id, unique across workers (idgen.py)
+    new_id = id_generator.next_id()
     
     msg_dict = message.dict()
     
     msg_dict["id"] = new_id
     msg_dict["isPinned"] = False
     
-    cursor.execute('''
-        INSERT INTO messages (id, chat_id, text, sender, time, type, fileUrl, fileName, fileSize, isPinned, callRoomName, callStatus, isVoice, replyTo, synced)
-        VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, FALSE)
-    ''', (
-        new_id,
-        chat_id,
-        msg_dict.get("text"),
-        msg_dict.get("sender"),
-        msg_dict.get("time"),
-        msg_dict.get("type"),
-        msg_dict.get("fileUrl"),
-        msg_dict.get("filename"),
-        msg_dict.get("size"),
-        False, # isPinned
-        msg_dict.get("callRoomName"),
-        msg_dict.get("callStatus"),
-        msg_dict.get("isVoice", False),
-        json.dumps(msg_dict.get("replyTo")) if msg_dict.get("replyTo") else None
-    ))
-    
-    # Self-Healing: Check if sender is in participants, if not add them
-    try:
-        sender_id = msg_dict.get("sender")
-        if sender_id and sender_id != 'me':
-             # Try to interpret sender_id as int if possible
-             try:
-                 sender_int = int(sender_id)
-             except:
-                 sender_int = sender_id
-                 
-             # Re-get cursor as dict
-             dict_cursor = get_db_cursor(conn)
-             dict_cursor.execute("SELECT participants FROM chats WHERE id = %s", (chat_id,))
-             chat_row = dict_cursor.fetchone()
-             if chat_row:
-                 parts = json.loads(chat_row["participants"])
-                 if not any(str(p.get("id")) == str(sender_int) for p in parts):
-                     # Fetch user query
-                     dict_cursor.execute("SELECT * FROM users WHERE id = %s", (sender_int,))
-                     user_row = dict_cursor.fetchone()
-                     if user_row:
-                         user_data = dict(user_row)
-                         new_part = {
-                             "id": user_data["id"],
-                             "name": user_data["name"],
-                             "email": user_data["email"],
-                             "avatar": user_data["avatar"]
-                         }
-                         parts.append(new_part)
-                         cursor.execute("UPDATE chats SET participants = %s WHERE id = %s", 
-                                      (json.dumps(parts), chat_id))
-                                      
-                         # Broadcast updated participants list
-                         await manager.broadcast({
-                             "type": "participant_update",
-                             "participants": parts
-                         }, chat_id)
-    except Exception as e:
-        print(f"Self-healing participant error: {e}")
+    # 1. Save to Postgres
+    async with db_pool.transaction() as conn:
+        # 1. Check if the other member of a 1-1 chat blocked the sender
+        chat_row = await conn.fetchrow("SELECT type FROM chats WHERE id = $1", chat_id)
         
-    conn.commit()
-    conn.close()
-    
-    # 2. Trigger Background Sync
-    background_tasks.add_task(sync_to_firebase)
+        if chat_row and chat_row["type"] == 'private' and to_int(sender_id) is not None:
+            if await conn.fetchval('''
+                SELECT 1 FROM chat_participants cp
+                JOIN blocked_users b ON b.blocker_id = cp.user_id AND b.blocked_id = $2
+                WHERE cp.chat_id = $1 AND cp.user_id <> $2
+                LIMIT 1
+            ''', chat_id, to_int(sender_id)):
+                raise HTTPException(status_code=403, detail="You are blocked by this user.")
+        
+        # Thumbnail/preview fields for uploaded files (kilobytes instead of the blob)
+        if msg_dict.get("fileUrl") and not (msg_dict.get("thumbUrl") or msg_dict.get("previewText")):
+            derived = await get_derivatives(conn, msg_dict["fileUrl"])
+            msg_dict["thumbUrl"] = derived.get("thumbUrl")
+            msg_dict["previewText"] = derived.get("previewText")
+        
+        await conn.execute('''
+            INSERT INTO messages (id, chat_id, text, sender, time, type, fileUrl, fileName, fileSize, isPinned, callRoomName, callStatus, isVoice, replyTo, thumbUrl, previewText, synced)
+            VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9, $10, $11, $12, $13, $14, $15, $16, FALSE)
+        ''',
+            new_id,
+            chat_id,
+            msg_dict.get("text"),
+            str(msg_dict.get("sender")),
+            msg_dict.get("time"),
+            msg_dict.get("type"),
+            msg_dict.get("fileUrl"),
+            msg_dict.get("filename"),
+            msg_dict.get("size"),
+            False, # isPinned
+            msg_dict.get("callRoomName"),
+            msg_dict.get("callStatus"),
+            msg_dict.get("isVoice", False),
+            msg_dict.get("replyTo") or None,
+            msg_dict.get("thumbUrl"),
+            msg_dict.get("previewText")
+        )
+        
+        # Self-Healing: Check if sender is in participants, if not add them
+        # (savepoint so a failure here doesn't abort the message insert;
+        # add_chat_member queues the participant_update event)
+        try:
+            sender_id = msg_dict.get("sender")
+            sender_int = to_int(sender_id)
+            if sender_int is not None and chat_row:
+                is_member = await conn.fetchval(
+                    "SELECT 1 FROM chat_participants WHERE chat_id = $1 AND user_id = $2", chat_id, sender_int)
+                if not is_member:
+                    async with conn.transaction():
+                        # Fetch user query
+                        user_row = await conn.fetchrow("SELECT id, name, email, avatar FROM users WHERE id = $1", sender_int)
+                        if user_row:
+                            await add_chat_member(conn, chat_id, dict(user_row))
+        except Exception as e:
+            print(f"Self-healing participant error: {e}")
+        
+        # 2. Broadcast + Firestore mirror via the outbox (commits with the insert)
+        await append_outbox(conn, chat_id, MESSAGE_CREATED, msg_dict)
     
-    # 3. Broadcast via WebSocket (Uses Redis Pub/Sub internally now)
-    await manager.broadcast(msg_dict, chat_id)
+    outbox_relay.notify()
     
     return msg_dict
 
-def sync_clear_messages(chat_id: int):
-    if not db: return
-    chats_ref = db.collection("chats")
-    query = chats_ref.where("id", "==", chat_id).limit(1).stream()
-    for doc in query:
-        messages_ref = doc.reference.collection("messages")
-        batch = db.batch()
-        count = 0
-        for msg in messages_ref.stream():
-            batch.delete(msg.reference)
-            count += 1
-            if count >= 400:
-                batch.commit()
-                batch = db.batch()
-                count = 0
-        if count > 0:
-            batch.commit()
-        
-        doc.reference.update({
-            "lastMessage": "Chat cleared",
-            "timestamp": datetime.now().isoformat()
-        })
-
 @app.delete("/chats/{chat_id}/messages")
-async def clear_chat_messages(chat_id: int, background_tasks: BackgroundTasks):
-    # 1. Delete from Postgres
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute("DELETE FROM messages WHERE chat_id = %s", (chat_id,))
-    
-    # Update last message in chat
-    cursor.execute('''
-        UPDATE chats 
-        SET lastMessage = 'Chat cleared', timestamp = %s, synced = FALSE 
-        WHERE id = %s
-    ''', (datetime.now().isoformat(), chat_id))
+async def clear_chat_messages(chat_id: int):
+    now = datetime.now(timezone.utc)
     
-    conn.commit()
-    conn.close()
+    # 1. Delete from Postgres
+    async with db_pool.transaction() as conn:
+        await conn.execute("DELETE FROM messages WHERE chat_id = $1", chat_id)
+        
+        # Update last message in chat
+        await conn.execute('''
+            UPDATE chats 
+            SET lastMessage = 'Chat cleared', timestamp = $1
+            WHERE id = $2
+        ''', now, chat_id)
+        
+        # 2. Broadcast + Firestore clear via the outbox
+        await append_outbox(conn, chat_id, MESSAGES_CLEARED, {"timestamp": now.isoformat()})
     
-    # 2. Background Sync
-    background_tasks.add_task(sync_clear_messages, chat_id)
-    background_tasks.add_task(sync_to_firebase) # For the chat update
+    outbox_relay.notify()
     
     return {"message": "Chat cleared"}
 
-def sync_delete_chat(chat_id: int):
-    if not db: return
-    chats_ref = db.collection("chats")
-    query = chats_ref.where("id", "==", chat_id).limit(1).stream()
-    for doc in query:
-        # Delete messages first
-        messages_ref = doc.reference.collection("messages")
-        batch = db.batch()
-        for msg in messages_ref.stream():
-            batch.delete(msg.reference)
-            if len(batch) >= 400:
-                batch.commit()
-                batch = db.batch()
-        if len(batch) > 0:
-            batch.commit()
-            
-        # Delete chat doc
-        doc.reference.delete()
-
 @app.delete("/chats/{chat_id}")
-async def delete_chat(chat_id: int, background_tasks: BackgroundTasks):
+async def delete_chat(chat_id: int):
     # 1. Soft/Hard Delete from Postgres
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute("DELETE FROM messages WHERE chat_id = %s", (chat_id,))
-    cursor.execute("DELETE FROM chats WHERE id = %s", (chat_id,))
-    conn.commit()
-    conn.close()
+    async with db_pool.transaction() as conn:
+        await conn.execute("DELETE FROM messages WHERE chat_id = $1", chat_id)
+        await conn.execute("DELETE FROM chats WHERE id = $1", chat_id)
+        
+        # 2. Broadcast + Firestore delete via the outbox
+        await append_outbox(conn, chat_id, CHAT_DELETED, {})
     
-    # 2. Background Sync
-    background_tasks.add_task(sync_delete_chat, chat_id)
+    outbox_relay.notify()
     
     return {"message": "Chat deleted"}
 
+# Messages of chat $1 picked by an id list ($2) and/or an inclusive id
+# range ($3, $4); a NULL leaves that part open. Ids from other chats never match.
+MESSAGE_SELECTION_SQL = '''
+    chat_id = $1
+    AND ($2::bigint[] IS NULL OR id = ANY($2::bigint[]))
+    AND ($3::bigint IS NULL OR id >= $3)
+    AND ($4::bigint IS NULL OR id <= $4)
+'''
+
+async def hide_messages(conn, user_id: int, chat_id: int, message_ids=None, from_id: int = None, to_id: int = None) -> int:
+    # 'Delete for me' as one set-based insert: the given ids, an inclusive id
+    # range, or (neither) the whole chat. Returns how many were newly hidden.
+    result = await conn.execute(f'''
+        INSERT INTO message_hidden (user_id, message_id)
+        SELECT $5, id FROM messages WHERE {MESSAGE_SELECTION_SQL}
+        ON CONFLICT (user_id, message_id) DO NOTHING
+    ''', chat_id, message_ids, from_id, to_id, user_id)
+    return rows_affected(result)
+
+# --- Bulk message actions ---
+# Body: {"message_ids": [...]} and/or {"from_id": .., "to_id": ..} (inclusive).
+# Each call is one transaction, one WebSocket event and one Firestore batch.
+# Pin/delete touch at most BULK_MAX_MESSAGES rows (one Firestore batch);
+# "has_more" means repeat the same request for the rest. Registered ahead
+# of /messages/{message_id}/..., which would otherwise match "bulk".
+BULK_MAX_MESSAGES = 500
+
+def message_selection(request: dict, allow_all: bool = False):
+    message_ids = request.get("message_ids")
+    if message_ids is not None:
+        if not isinstance(message_ids, list):
+            raise HTTPException(status_code=400, detail="message_ids must be a list")
+        message_ids = [to_int(message_id) for message_id in message_ids]
+        if None in message_ids:
+            raise HTTPException(status_code=400, detail="message_ids must be numbers")
+    from_id = request.get("from_id")
+    to_id = request.get("to_id")
+    if (from_id is not None and to_int(from_id) is None) or (to_id is not None and to_int(to_id) is None):
+        raise HTTPException(status_code=400, detail="from_id and to_id must be numbers")
+    from_id, to_id = to_int(from_id), to_int(to_id)
+    if message_ids is None and from_id is None and to_id is None:
+        # Whole chat, only where that is explicitly asked for
+        if not (allow_all and request.get("all") is True):
+            raise HTTPException(status_code=400, detail="message_ids or from_id/to_id required")
+    return message_ids, from_id, to_id
+
+async def update_messages(chat_id: int, set_sql: str, skip_sql: str, request: dict):
+    # Shared by bulk pin/delete: rows already in the target state are skipped,
+    # so a repeated request only picks up what is left
+    message_ids, from_id, to_id = message_selection(request)
+    async with db_pool.transaction() as conn:
+        rows = await conn.fetch(f'''
+            UPDATE messages SET {set_sql}, synced = FALSE
+            WHERE id IN (
+                SELECT id FROM messages
+                WHERE {MESSAGE_SELECTION_SQL} AND NOT ({skip_sql})
+                ORDER BY id
+                LIMIT $5
+                FOR UPDATE
+            )
+            RETURNING *
+        ''', chat_id, message_ids, from_id, to_id, BULK_MAX_MESSAGES)
+        messages = sorted((dict(row) for row in rows), key=lambda message: message["id"])
+        for message in messages:
+            message["isPinned"] = message["ispinned"]
+        if messages:
+            await append_outbox(conn, chat_id, MESSAGES_UPDATED, {"messages": messages})
+
+    if messages:
+        outbox_relay.notify()
+    return {
+        "status": "success",
+        "updated": len(messages),
+        "messages": messages,
+        "has_more": len(messages) == BULK_MAX_MESSAGES,
+    }
+
+@app.post("/chats/{chat_id}/messages/bulk/delete_for_me")
+async def bulk_delete_for_me(chat_id: int, request: dict):
+    # {"all": true} clears the whole chat for this user only
+    user_id = to_int(request.get("user_id"))
+    if user_id is None:
+        raise HTTPException(status_code=400, detail="user_id required")
+    message_ids, from_id, to_id = message_selection(request, allow_all=True)
+
+    async with db_pool.acquire() as conn:
+        hidden = await hide_messages(conn, user_id, chat_id, message_ids, from_id, to_id)
+
+    # Only this user's other sessions care
+    if hidden:
+        await manager.send_to_user({
+            "type": "messages_hidden", "chat_id": chat_id,
+            "message_ids": message_ids, "from_id": from_id, "to_id": to_id,
+        }, user_id)
+    return {"status": "success", "hidden": hidden}
+
+@app.post("/chats/{chat_id}/messages/bulk/delete")
+async def bulk_delete_messages(chat_id: int, request: dict):
+    # Soft delete for everyone, same fields as delete_message
+    return await update_messages(chat_id, '''
+        text = '🚫 This message was deleted', type = 'text', fileUrl = NULL, fileName = NULL,
+        fileSize = NULL, callStatus = NULL, callRoomName = NULL,
+        isVoice = NULL, replyTo = NULL, isDeleted = TRUE
+    ''', "COALESCE(isDeleted, FALSE)", request)
+
+@app.post("/chats/{chat_id}/messages/bulk/pin")
+async def bulk_pin_messages(chat_id: int, request: dict):
+    # {"pinned": false} unpins; a bulk toggle would be ambiguous
+    pinned = request.get("pinned", True)
+    if not isinstance(pinned, bool):
+        raise HTTPException(status_code=400, detail="pinned must be true or false")
+    if pinned:
+        return await update_messages(chat_id, "isPinned = TRUE", "COALESCE(isPinned, FALSE)", request)
+    return await update_messages(chat_id, "isPinned = FALSE", "NOT COALESCE(isPinned, FALSE)", request)
+
 @app.post("/chats/{chat_id}/messages/{message_id}/delete_for_me")
 async def delete_message_for_me(chat_id: int, message_id: int, request: dict):
     print(f"DEBUG: delete_message_for_me hit. chat_id={chat_id}, msg_id={message_id}, request={request}")
-    user_id = request.get("user_id")
-    if not user_id:
+    user_id = to_int(request.get("user_id"))
+    if user_id is None:
         print("DEBUG: user_id missing")
         raise HTTPException(status_code=400, detail="user_id required")
         
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    
-    # 1. Fetch current deleted_for
-    cursor.execute("SELECT deleted_for FROM messages WHERE id = %s", (message_id,))
-    row = cursor.fetchone()
-    if not row:
-        print("DEBUG: Message not found")
-        conn.close()
-        raise HTTPException(status_code=404, detail="Message not found")
-        
-    current_deleted_for = row[0]
-    deleted_list = []
-    if current_deleted_for:
-        try:
-            deleted_list = json.loads(current_deleted_for)
-        except:
-            deleted_list = []
+    async with db_pool.acquire() as conn:
+        if not await conn.fetchval("SELECT 1 FROM messages WHERE id = $1 AND chat_id = $2", message_id, chat_id):
+            print("DEBUG: Message not found")
+            raise HTTPException(status_code=404, detail="Message not found")
+        await hide_messages(conn, user_id, chat_id, message_ids=[message_id])
             
-    # 2. Add user_id if not present
-    if user_id not in deleted_list:
-        deleted_list.append(user_id)
-        cursor.execute("UPDATE messages SET deleted_for = %s WHERE id = %s", (json.dumps(deleted_list), message_id))
-        conn.commit()
-        
-    conn.close()
-    return {"status": "success", "deleted_for": deleted_list}
+    return {"status": "success"}
 
 @app.post("/chats/{chat_id}/messages/{message_id}/pin")
 async def pin_message(chat_id: int, message_id: int):
-    # TODO: This endpoint used Firestore only? It should update Postgres too.
-    # The original implementation only updated Firestore!
-    # I should verify this.
-    # Original: chats_ref = db.collection...
-    # I should add Postgres update.
-    
-    conn = get_db_connection()
-    cursor = get_db_cursor(conn)
-    cursor.execute("SELECT isPinned FROM messages WHERE id = %s", (message_id,))
-    row = cursor.fetchone()
-    
-    new_status = False
-    if row:
-        new_status = not row["isPinned"]
-        cursor.execute("UPDATE messages SET isPinned = %s, synced = FALSE WHERE id = %s", (new_status, message_id))
-        conn.commit()
-    
-    conn.close()
-    
-    # Also update Firestore (Hybrid)
-    chats_ref = db.collection("chats")
-    query = chats_ref.where("id", "==", chat_id).limit(1).stream()
-    
-    for doc in query:
-        messages_ref = doc.reference.collection("messages")
-        msg_query = messages_ref.where("id", "==", message_id).limit(1).stream()
+    # Postgres is the source of truth; the outbox relay mirrors the flag
+    async with db_pool.transaction() as conn:
+        # Toggle in a single statement
+        row = await conn.fetchrow(
+            "UPDATE messages SET isPinned = NOT COALESCE(isPinned, FALSE), synced = FALSE WHERE id = $1 AND chat_id = $2 RETURNING *",
+            message_id, chat_id)
         
-        for msg_doc in msg_query:
-            msg_data = msg_doc.to_dict()
-            new_status = not msg_data.get("isPinned", False)
-            msg_doc.reference.update({"isPinned": new_status})
-            
-            msg_data["isPinned"] = new_status
-            return msg_data
-            
-    raise HTTPException(status_code=404, detail="Message not found")
+        if not row:
+            raise HTTPException(status_code=404, detail="Message not found")
+        
+        msg_data = dict(row)
+        msg_data["isPinned"] = msg_data["ispinned"]
+        await append_outbox(conn, chat_id, MESSAGE_UPDATED, msg_data)
+    
+    outbox_relay.notify()
+    return msg_data
 
 @app.put("/chats/{chat_id}/messages/{message_id}")
-async def update_message(chat_id: int, message_id: int, updates: dict, background_tasks: BackgroundTasks):
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    
+async def update_message(chat_id: int, message_id: int, updates: dict):
     # 1. Update Postgres
     fields = []
     values = []
     for k, v in updates.items():
         if k in ['text', 'callStatus', 'isPinned', 'replyTo']: # Allowed fields
-            fields.append(f"{k} = %s")
-            if isinstance(v, (dict, list)):
-                values.append(json.dumps(v))
-            else:
-                values.append(v)
+            fields.append(f"{k} = ${len(values) + 1}")
+            values.append(v)
                 
     if not fields:
-        conn.close()
         return {"error": "No valid fields to update"}
         
     values.append(message_id) # For WHERE clause
     
-    cursor.execute(f"UPDATE messages SET {', '.join(fields)} WHERE id = %s", values)
-    
-    if cursor.rowcount == 0:
-        conn.close()
-        raise HTTPException(status_code=404, detail="Message not found in local DB")
+    # 2. Fetch updated message (RETURNING saves the second round trip)
+    async with db_pool.transaction() as conn:
+        row = await conn.fetchrow(
+            f"UPDATE messages SET {', '.join(fields)} WHERE id = ${len(values)} RETURNING *", *values)
         
-    conn.commit()
-    
-    # 2. Fetch updated message
-    cursor = get_db_cursor(conn) # Switch to dict cursor
-    cursor.execute("SELECT * FROM messages WHERE id = %s", (message_id,))
-    row = cursor.fetchone()
-    updated_msg = dict(row)
-    
-    if updated_msg.get("replyTo"):
-         try:
-             updated_msg["replyTo"] = json.loads(updated_msg["replyTo"])
-         except:
-             pass
-             
-    conn.close()
-    
-    # 3. Broadcast
-    await manager.broadcast(updated_msg, chat_id)
-    
-    # 4. Background Sync (Firestore)
-    def sync_update():
-        chats_ref = db.collection("chats")
-        query = chats_ref.where("id", "==", chat_id).limit(1).stream()
-        for doc in query:
-            messages_ref = doc.reference.collection("messages")
-            msg_query = messages_ref.where("id", "==", message_id).limit(1).stream()
-            for msg_doc in msg_query:
-                msg_doc.reference.update(updates)
-                
-    background_tasks.add_task(sync_update)
+        if not row:
+            raise HTTPException(status_code=404, detail="Message not found in local DB")
+            
+        updated_msg = dict(row)
+        
+        # 3. Broadcast + Firestore mirror via the outbox
+        await append_outbox(conn, chat_id, MESSAGE_UPDATED, updated_msg)
+    
+    outbox_relay.notify()
     
     return updated_msg
 
 @app.delete("/chats/{chat_id}/messages/{message_id}")
 async def delete_message(chat_id: int, message_id: int):
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    
     # 1. Soft Delete in Postgres
     updates = {
         "text": "🚫 This message was deleted",
@@ -963,227 +937,216 @@ async def delete_message(chat_id: int, message_id: int):
         "isDeleted": True 
     }
     
-    cursor.execute("""
-        UPDATE messages 
-        SET text = %s, type = %s, fileUrl = NULL, fileName = NULL, 
-            fileSize = NULL, callStatus = NULL, callRoomName = NULL, 
-            isVoice = NULL, replyTo = NULL, isDeleted = TRUE
-        WHERE id = %s
-    """, (updates["text"], updates["type"], message_id))
-    
-    if cursor.rowcount == 0:
-        conn.close()
-        raise HTTPException(status_code=404, detail="Message not found")
+    # Fetch updated message for broadcast
+    async with db_pool.transaction() as conn:
+        row = await conn.fetchrow("""
+            UPDATE messages 
+            SET text = $1, type = $2, fileUrl = NULL, fileName = NULL, 
+                fileSize = NULL, callStatus = NULL, callRoomName = NULL, 
+                isVoice = NULL, replyTo = NULL, isDeleted = TRUE
+            WHERE id = $3
+            RETURNING *
+        """, updates["text"], updates["type"], message_id)
+        
+        if not row:
+            raise HTTPException(status_code=404, detail="Message not found")
+            
+        updated_msg = dict(row)
         
-    conn.commit()
+        # 2. Broadcast Update + Firestore mirror via the outbox
+        await append_outbox(conn, chat_id, MESSAGE_UPDATED, updated_msg)
     
-    # Fetch updated message for broadcast
-    cursor = get_db_cursor(conn)
-    cursor.execute("SELECT * FROM messages WHERE id = %s", (message_id,))
-    updated_msg = dict(cursor.fetchone())
-    conn.close()
-    
-    # 2. Broadcast Update
-    await manager.broadcast(updated_msg, chat_id)
-    
-    # 3. Background Sync (Firestore)
-    def sync_soft_delete():
-        chats_ref = db.collection("chats")
-        query = chats_ref.where("id", "==", chat_id).limit(1).stream()
-        for doc in query:
-            messages_ref = doc.reference.collection("messages")
-            msg_query = messages_ref.where("id", "==", message_id).limit(1).stream()
-            for msg_doc in msg_query:
-                msg_doc.reference.update(updates)
-
-    sync_soft_delete()
+    outbox_relay.notify()
     
     return {"status": "success", "message": "Message deleted"}
 
 @app.post("/chats/{chat_id}/participants")
-async def add_participant(chat_id: int, user_data: dict, background_tasks: BackgroundTasks):
+async def add_participant(chat_id: int, user_data: dict):
     email = user_data.get("email")
     if not email:
         raise HTTPException(status_code=400, detail="Email is required")
         
-    user_to_add = get_user_by_email(email)
+    user_to_add = await get_user_by_email(email)
     if not user_to_add:
         raise HTTPException(status_code=404, detail="User not found")
         
     # 1. Update Postgres
-    conn = get_db_connection()
-    cursor = get_db_cursor(conn)
-    
-    # Get current participants from SQLite
-    cursor.execute("SELECT participants FROM chats WHERE id = %s", (chat_id,))
-    row = cursor.fetchone()
-    
-    if not row:
-        conn.close()
-        raise HTTPException(status_code=404, detail="Chat not found")
-        
-    import json
-    current_participants = json.loads(row["participants"])
-    
-    # Check if already in chat
-    if any(p.get("id") == user_to_add["id"] for p in current_participants):
-         conn.close()
-         raise HTTPException(status_code=400, detail="User already in chat")
-         
-    current_participants.append(user_to_add)
-    
-    cursor.execute("UPDATE chats SET participants = %s, synced = FALSE WHERE id = %s", 
-                  (json.dumps(current_participants), chat_id))
-    conn.commit()
-    conn.close()
+    async with db_pool.transaction() as conn:
+        if not await conn.fetchval("SELECT 1 FROM chats WHERE id = $1", chat_id):
+            raise HTTPException(status_code=404, detail="Chat not found")
+            
+        # Check if already in chat (the membership insert is the check)
+        if await add_chat_member(conn, chat_id, user_to_add) is None:
+             raise HTTPException(status_code=400, detail="User already in chat")
     
-    # 2. Background Sync
-    background_tasks.add_task(sync_to_firebase)
+    # 2. Broadcast + Firestore mirror (queued by add_chat_member)
+    outbox_relay.notify()
     
     return {"message": "User added", "user": user_to_add}
 
 @app.get("/chats/{chat_id}/participants")
 async def get_participants(chat_id: int):
-    conn = get_db_connection()
-    cursor = get_db_cursor(conn)
-    cursor.execute("SELECT participants FROM chats WHERE id = %s", (chat_id,))
-    row = cursor.fetchone()
-    conn.close()
+    async with db_pool.acquire() as conn:
+        row = await conn.fetchrow("SELECT participants FROM chats WHERE id = $1", chat_id)
     
     if row:
-        import json
-        try:
-            return json.loads(row["participants"])
-        except:
-            return []
+        return row["participants"] or []
     return []
 
 
 
-from ai_service import analyze_content
-from file_extractor import extract_text
-import re
+from file_extractor import text_extractor, SUPPORTED_EXTENSIONS
 
-@app.post("/analyze-message")
-async def analyze_message_endpoint(analysis_request: IdeaAnalysis):
-    text_to_analyze = analysis_request.text
+async def save_idea(idea_text: str, category: str):
+    new_id = id_generator.next_id()
+    timestamp = datetime.now(timezone.utc)
     
+    async with db_pool.acquire() as conn:
+        await conn.execute('''
+            INSERT INTO ideas (id, text, category, votes, timestamp, is_analyzed, synced)
+            VALUES ($1, $2, $3, $4, $5, $6, FALSE)
+        ''', new_id, idea_text, category, 0, timestamp, True)
+    sync_worker.notify()
+
+async def run_message_analysis(text_to_analyze: str) -> dict:
+    # The pre-filter is only meant for chat text, not extracted file content
+    is_chat_text = True
     # Check if text looks like a filename we have access to
-    valid_extensions = ('.txt', '.pdf', '.docx', '.pptx', '.html', '.htm')
-    if text_to_analyze.lower().endswith(valid_extensions):
+    if text_to_analyze.lower().endswith(SUPPORTED_EXTENSIONS):
         # Construct full path to uploads
         file_path = os.path.join("uploads", text_to_analyze)
         if os.path.exists(file_path):
             print(f"Extracting text from file: {file_path}")
-            extracted_text = extract_text(file_path)
+            extracted_text = await text_extractor.extract(file_path)
             if extracted_text and not extracted_text.startswith("Error"):
-                 # Limit text to avoid token limits (approx 15k chars)
-                text_to_analyze = extracted_text[:15000]
+                 # Already capped at EXTRACT_MAX_CHARS by the extractor
+                text_to_analyze = extracted_text
+                is_chat_text = False
             else:
                 print(f"Failed to extract text or empty: {extracted_text}")
 
     print(f"Analyzing content (length={len(text_to_analyze)}): {text_to_analyze[:50]}...")
     
-    is_idea, confidence, summary, category = analyze_content(text_to_analyze)
+    (is_idea, confidence, summary, category), cached = await ai_service.analyze_with_cache(text_to_analyze, prefilter=is_chat_text)
     
     if is_idea:
-        # Save to Postgres ideas
-        new_id = int(datetime.now().timestamp() * 1000)
-        timestamp = datetime.now().isoformat()
-        
-        # Use summary as the main text for the idea card if it's long content
-        idea_text = summary if len(text_to_analyze) > 200 else text_to_analyze
-        
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        
-        cursor.execute('''
-            INSERT INTO ideas (id, text, category, votes, timestamp, is_analyzed, synced)
-            VALUES (%s, %s, %s, %s, %s, %s, FALSE)
-        ''', (new_id, idea_text, category, 0, timestamp, True))
-        
-        conn.commit()
-        conn.close()
+        # Known content was already saved the first time it was analyzed
+        if not cached:
+            # Use summary as the main text for the idea card if it's long content
+            idea_text = summary if len(text_to_analyze) > 200 else text_to_analyze
+            await save_idea(idea_text, category)
         
         return {
             "is_idea": True,
             "confidence": confidence,
             "category": category,
-            "summary": summary
+            "summary": summary,
+            "duplicate": cached
         }
     
     return {"is_idea": False, "confidence": confidence}
 
-@app.post("/analyze-file")
-async def analyze_file_endpoint(request: dict):
-    print(f"DEBUG: analyze_file_endpoint called with {request}")
-    filename = request.get("filename")
-    if not filename:
-        raise HTTPException(status_code=400, detail="Filename required")
-        
-    file_path = os.path.join("uploads", filename)
-    print(f"DEBUG: Checking file path: {file_path}")
-    if not os.path.exists(file_path):
-        print(f"DEBUG: File not found at {file_path}")
-        raise HTTPException(status_code=404, detail=f"File not found: {filename}")
-        
+async def run_file_analysis(filename: str, file_path: str) -> dict:
     print(f"Analyzing file: {file_path}")
-    extracted_text = extract_text(file_path)
+    extracted_text = await text_extractor.extract(file_path)
     
     if not extracted_text or len(extracted_text) < 10:
          return {"is_idea": False, "confidence": 0.0, "message": "No text extracted"}
          
     # Analyze
-    text_to_analyze = extracted_text[:15000]
-    is_idea, confidence, summary, category = analyze_content(text_to_analyze)
+    text_to_analyze = extracted_text
+    (is_idea, confidence, summary, category), cached = await ai_service.analyze_with_cache(text_to_analyze)
     
     if is_idea:
-        new_id = int(datetime.now().timestamp() * 1000)
-        timestamp = datetime.now().isoformat()
-        
-        idea_text = summary if summary else f"Idea from {filename}"
-        
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        
-        cursor.execute('''
-            INSERT INTO ideas (id, text, category, votes, timestamp, is_analyzed, synced)
-            VALUES (%s, %s, %s, %s, %s, %s, FALSE)
-        ''', (new_id, idea_text, category, 0, timestamp, True))
-        
-        conn.commit()
-        conn.close()
+        # Same file analyzed again: don't insert a second ideas row
+        if not cached:
+            idea_text = summary if summary else f"Idea from {filename}"
+            await save_idea(idea_text, category)
         
         return {
             "is_idea": True,
             "confidence": confidence,
             "category": category,
-            "summary": summary
+            "summary": summary,
+            "duplicate": cached
         }
         
     return {"is_idea": False, "confidence": confidence}
 
+async def queue_analysis(handler, *args):
+    try:
+        job = await ai_service.submit(handler, *args)
+    except AnalysisQueueFull:
+        raise HTTPException(status_code=503, detail="Analysis queue is full, try again later")
+    return JSONResponse(status_code=202, content={"job_id": job["id"], "status": job["status"]})
 
-@app.post("/upload")
-async def upload_file(file: UploadFile = File(...)):
-    import uuid
-    # Create unique filename to avoid collisions
-    _, ext = os.path.splitext(file.filename)
-    unique_name = f"{uuid.uuid4()}{ext}"
-    file_path = f"uploads/{unique_name}"
-    
-    with open(file_path, "wb+") as buffer:
-        shutil.copyfileobj(file.file, buffer)
+# Analysis runs on the AI service's worker queue; clients poll
+# GET /analysis-jobs/{job_id} for the result.
+@app.post("/analyze-message")
+async def analyze_message_endpoint(analysis_request: IdeaAnalysis):
+    return await queue_analysis(run_message_analysis, analysis_request.text)
+
+@app.post("/analyze-file")
+async def analyze_file_endpoint(request: dict):
+    filename = request.get("filename")
+    if not filename:
+        raise HTTPException(status_code=400, detail="Filename required")
         
-    return {"url": f"/uploads/{unique_name}", "filename": unique_name}
+    file_path = os.path.join("uploads", filename)
+    if not os.path.exists(file_path):
+        print(f"DEBUG: File not found at {file_path}")
+        raise HTTPException(status_code=404, detail=f"File not found: {filename}")
+    
+    return await queue_analysis(run_file_analysis, filename, file_path)
+
+@app.get("/analysis-cache/stats")
+async def get_analysis_cache_stats():
+    stats = await analysis_cache.stats()
+    stats["batching"] = ai_service.stats
+    return stats
+
+@app.get("/analysis-jobs/{job_id}")
+async def get_analysis_job(job_id: str):
+    job = await ai_service.get_job(job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return {
+        "job_id": job["id"],
+        "status": job["status"],
+        "result": job.get("result"),
+        "error": job.get("error")
+    }
+
+
+@app.post("/upload")
+async def upload_file(request: Request):
+    # Multipart body streamed straight to disk (no spooled copy) and stored
+    # by content hash; identical files share one blob
+    return await upload_store.save_upload(request)
+
+# Resumable chunked uploads for large files (voice notes, decks):
+# init -> append at the server's offset (repeat) -> complete.
+# GET /upload/{upload_id} tells a reconnecting client where to resume.
+@app.post("/upload/init")
+async def init_chunked_upload(request: dict):
+    return await upload_store.init_session(request.get("filename", ""), to_int(request.get("size")))
+
+@app.get("/upload/{upload_id}")
+async def get_chunked_upload(upload_id: str):
+    return await upload_store.get_session(upload_id)
+
+@app.post("/upload/{upload_id}/append")
+async def append_chunked_upload(upload_id: str, offset: int, request: Request):
+    return await upload_store.append_chunk(upload_id, offset, request.stream())
+
+@app.post("/upload/{upload_id}/complete")
+async def complete_chunked_upload(upload_id: str):
+    return await upload_store.complete_session(upload_id)
 
 @app.get("/ideas")
 async def get_ideas():
-    conn = get_db_connection()
-    cursor = get_db_cursor(conn)
-    
-    cursor.execute("SELECT * FROM ideas ORDER BY timestamp DESC")
-    rows = cursor.fetchall()
+    async with db_pool.acquire() as conn:
+        rows = await conn.fetch("SELECT * FROM ideas ORDER BY timestamp DESC NULLS LAST")
     
     ideas = []
     for row in rows:
@@ -1216,16 +1179,12 @@ async def get_ideas():
 
         ideas.append(idea)
         
-    conn.close()
     return ideas
 
 @app.delete("/ideas/{idea_id}")
 async def delete_idea(idea_id: int):
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute("DELETE FROM ideas WHERE id = %s", (idea_id,))
-    conn.commit()
-    conn.close()
+    async with db_pool.acquire() as conn:
+        await conn.execute("DELETE FROM ideas WHERE id = $1", idea_id)
     return {"status": "deleted"}
 
 
@@ -1233,28 +1192,34 @@ async def delete_idea(idea_id: int):
 async def mark_messages_read(chat_id: int, request: dict):
     user_id = request.get("user_id")
     
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    
-    # Update all messages in this chat sent by OTHERS to 'read'
-    # For MVP (1-1): Just set status='read' where sender != user_id
-    cursor.execute('''
-        UPDATE messages 
-        SET status = 'read', synced = FALSE 
-        WHERE chat_id = %s AND sender != %s AND status != 'read'
-    ''', (chat_id, str(user_id)))
-    
-    row_count = cursor.rowcount
-    conn.commit()
-    conn.close()
+    async with db_pool.transaction() as conn:
+        # Update all messages in this chat sent by OTHERS to 'read'
+        # For MVP (1-1): Just set status='read' where sender != user_id
+        rows = await conn.fetch('''
+            UPDATE messages 
+            SET status = 'read', synced = FALSE 
+            WHERE chat_id = $1 AND sender != $2 AND status != 'read'
+            RETURNING id
+        ''', chat_id, str(user_id))
+        
+        # Advance this member's read marker (drives GET /users/{id}/chats unread)
+        if to_int(user_id) is not None:
+            await conn.execute('''
+                UPDATE chat_participants
+                SET last_read_id = GREATEST(COALESCE(last_read_id, 0),
+                    COALESCE((SELECT MAX(id) FROM messages WHERE chat_id = $1), 0))
+                WHERE chat_id = $1 AND user_id = $2
+            ''', chat_id, to_int(user_id))
+        
+        row_count = len(rows)
+        if row_count > 0:
+            # Read receipt goes through the outbox so it gets a seq and can be
+            # replayed; the ids let the relay mirror the status to Firestore
+            await append_outbox(conn, chat_id, MESSAGES_READ,
+                                {"read_by": user_id, "message_ids": [row["id"] for row in rows]})
     
     if row_count > 0:
-        # Broadcast read receipt
-        await manager.broadcast({
-            "type": "messages_read",
-            "chat_id": chat_id,
-            "read_by": user_id
-        }, chat_id)
+        outbox_relay.notify()
         
     return {"status": "success", "updated": row_count}
 
@@ -1262,88 +1227,67 @@ async def mark_messages_read(chat_id: int, request: dict):
 
 @app.post("/keys")
 async def upload_keys(request: dict):
-    user_id = request.get("user_id")
+    user_id = to_int(request.get("user_id"))
     public_key = request.get("public_key")
     pre_key_bundle = request.get("pre_key_bundle")
     
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    
-    # Upsert keys
-    cursor.execute('''
-        INSERT INTO user_keys (user_id, public_key, pre_key_bundle, timestamp, synced)
-        VALUES (%s, %s, %s, %s, FALSE)
-        ON CONFLICT (user_id) DO UPDATE 
-        SET public_key = EXCLUDED.public_key, 
-            pre_key_bundle = EXCLUDED.pre_key_bundle,
-            timestamp = EXCLUDED.timestamp,
-            synced = FALSE
-    ''', (user_id, public_key, json.dumps(pre_key_bundle) if pre_key_bundle else None, datetime.now().isoformat()))
-    
-    conn.commit()
-    conn.close()
+    async with db_pool.acquire() as conn:
+        # Upsert keys
+        await conn.execute('''
+            INSERT INTO user_keys (user_id, public_key, pre_key_bundle, timestamp, synced)
+            VALUES ($1, $2, $3, $4, FALSE)
+            ON CONFLICT (user_id) DO UPDATE 
+            SET public_key = EXCLUDED.public_key, 
+                pre_key_bundle = EXCLUDED.pre_key_bundle,
+                timestamp = EXCLUDED.timestamp,
+                synced = FALSE
+        ''', user_id, public_key, pre_key_bundle or None, datetime.now().isoformat())
     
     return {"status": "keys_uploaded"}
 
 @app.get("/keys/{user_id}")
 async def get_keys(user_id: int):
-    conn = get_db_connection()
-    cursor = get_db_cursor(conn)
-    cursor.execute("SELECT * FROM user_keys WHERE user_id = %s", (user_id,))
-    row = cursor.fetchone()
-    conn.close()
+    async with db_pool.acquire() as conn:
+        row = await conn.fetchrow("SELECT * FROM user_keys WHERE user_id = $1", user_id)
     
-    if row:
-        return dict(row)
     if row:
         return dict(row)
     return {"error": "Keys not found", "user_id": user_id}
 
 @app.post("/users/block")
 async def block_user(request: dict):
-    blocker_id = request.get("blocker_id")
-    blocked_id = request.get("blocked_id")
-    
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    
-    cursor.execute('''
-        INSERT INTO blocked_users (blocker_id, blocked_id, timestamp)
-        VALUES (%s, %s, %s)
-        ON CONFLICT (blocker_id, blocked_id) DO NOTHING
-    ''', (blocker_id, blocked_id, datetime.now().isoformat()))
-    
-    conn.commit()
-    conn.close()
+    blocker_id = to_int(request.get("blocker_id"))
+    blocked_id = to_int(request.get("blocked_id"))
+    
+    async with db_pool.acquire() as conn:
+        await conn.execute('''
+            INSERT INTO blocked_users (blocker_id, blocked_id, timestamp)
+            VALUES ($1, $2, $3)
+            ON CONFLICT (blocker_id, blocked_id) DO NOTHING
+        ''', blocker_id, blocked_id, datetime.now().isoformat())
+    # Every worker drops its cached block state for chats between the two
+    await manager.send_to_user({"type": BLOCK_UPDATE, "blocker_id": blocker_id, "blocked_id": blocked_id, "blocked": True}, blocked_id)
     return {"status": "blocked"}
 
 @app.post("/users/unblock")
 async def unblock_user(request: dict):
-    blocker_id = request.get("blocker_id")
-    blocked_id = request.get("blocked_id")
-    
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    
-    cursor.execute('''
-        DELETE FROM blocked_users 
-        WHERE blocker_id = %s AND blocked_id = %s
-    ''', (blocker_id, blocked_id))
-    
-    conn.commit()
-    conn.close()
+    blocker_id = to_int(request.get("blocker_id"))
+    blocked_id = to_int(request.get("blocked_id"))
+    
+    async with db_pool.acquire() as conn:
+        await conn.execute('''
+            DELETE FROM blocked_users 
+            WHERE blocker_id = $1 AND blocked_id = $2
+        ''', blocker_id, blocked_id)
+    await manager.send_to_user({"type": BLOCK_UPDATE, "blocker_id": blocker_id, "blocked_id": blocked_id, "blocked": False}, blocked_id)
     return {"status": "unblocked"}
 
 @app.get("/users/{user_id}/blocked")
 async def get_blocked_users(user_id: int):
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    
-    cursor.execute("SELECT blocked_id FROM blocked_users WHERE blocker_id = %s", (user_id,))
-    rows = cursor.fetchall() # List of tuples [(1,), (2,)]
+    async with db_pool.acquire() as conn:
+        rows = await conn.fetch("SELECT blocked_id FROM blocked_users WHERE blocker_id = $1", user_id)
     
     blocked_ids = [row[0] for row in rows]
-    conn.close()
     return blocked_ids
 
 @app.put("/users/{user_id}")
@@ -1357,97 +1301,67 @@ async def update_profile(user_id: int, request: dict):
     avatar = request.get("avatar")
     status = request.get("about") # Map 'about' to 'status' column
     
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    
     fields = []
     values = []
     
     if name:
-        fields.append("name = %s")
         values.append(name)
+        fields.append(f"name = ${len(values)}")
     if status is not None:
-        fields.append("status = %s")
         values.append(status)
+        fields.append(f"status = ${len(values)}")
     if avatar:
-        fields.append("avatar = %s")
         values.append(avatar)
+        fields.append(f"avatar = ${len(values)}")
         
     values.append(user_id) # For WHERE clause
     
     if fields:
-        query = f"UPDATE users SET {', '.join(fields)}, synced = FALSE WHERE id = %s"
-        cursor.execute(query, tuple(values))
-        conn.commit()
+        query = f"UPDATE users SET {', '.join(fields)}, synced = FALSE WHERE id = ${len(values)}"
+        async with db_pool.acquire() as conn:
+            await conn.execute(query, *values)
+        sync_worker.notify()
     
-    conn.close()
     return {"status": "updated"}
 
 @app.post("/users/{user_id}/settings")
 async def update_settings(user_id: int, settings: dict):
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    
-    # Merge existing settings? For now, overwrite or partial update logic needed
-    # Let's read first
-    cursor.execute("SELECT settings FROM users WHERE id = %s", (user_id,))
-    row = cursor.fetchone()
-    current_settings = {}
-    if row and row[0]:
-        try:
-            current_settings = json.loads(row[0])
-        except:
-            current_settings = {}
-            
-    # Update
-    current_settings.update(settings)
-    
-    cursor.execute("UPDATE users SET settings = %s WHERE id = %s", (json.dumps(current_settings), user_id))
-    conn.commit()
-    conn.close()
-    return {"status": "updated", "settings": current_settings}
+    async with db_pool.acquire() as conn:
+        # Shallow merge server-side, so concurrent updates of different keys both stick
+        current_settings = await conn.fetchval('''
+            UPDATE users SET settings = COALESCE(settings, '{}'::jsonb) || $2::jsonb
+            WHERE id = $1
+            RETURNING settings
+        ''', user_id, settings)
+    return {"status": "updated", "settings": current_settings if current_settings is not None else settings}
 
 @app.get("/users/{user_id}/settings")
 async def get_settings(user_id: int):
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute("SELECT settings FROM users WHERE id = %s", (user_id,))
-    row = cursor.fetchone()
-    conn.close()
+    async with db_pool.acquire() as conn:
+        row = await conn.fetchrow("SELECT settings FROM users WHERE id = $1", user_id)
     
     if row and row[0]:
-        try:
-            return json.loads(row[0])
-        except:
-            return {}
+        return row[0]
     return {}
 
 @app.post("/status")
 async def create_status(request: dict):
-    user_id = request.get("user_id")
+    user_id = to_int(request.get("user_id"))
     type = request.get("type", "text")
     content = request.get("content")
     caption = request.get("caption", "")
     
-    new_id = int(datetime.now().timestamp() * 1000)
-    timestamp = datetime.now().isoformat()
+    new_id = id_generator.next_id()
+    timestamp = datetime.now(timezone.utc)
     # Expire in 24 hours
-    expires_at = (datetime.now() +  json.timedelta(hours=24) if 'timedelta' in globals() else datetime.now()).isoformat() 
-    # Wait, need timedelta. Let's import it or use simple timestamp addition if possible.
-    # Actually explicit import is safer.
-    from datetime import timedelta
-    expires_at = (datetime.now() + timedelta(hours=24)).isoformat()
+    expires_at = timestamp + timedelta(hours=24)
     
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    
-    cursor.execute('''
-        INSERT INTO status (id, user_id, type, content, caption, timestamp, expires_at, viewers, synced)
-        VALUES (%s, %s, %s, %s, %s, %s, %s, '[]', FALSE)
-    ''', (new_id, user_id, type, content, caption, timestamp, expires_at))
-    
-    conn.commit()
-    conn.close()
+    async with db_pool.acquire() as conn:
+        await conn.execute('''
+            INSERT INTO status (id, user_id, type, content, caption, timestamp, expires_at, viewers, synced)
+            VALUES ($1, $2, $3, $4, $5, $6, $7, '[]', FALSE)
+        ''', new_id, user_id, type, content, caption, timestamp, expires_at)
+    sync_worker.notify()
     
     return {"status": "created", "id": new_id}
 
@@ -1455,22 +1369,15 @@ async def create_status(request: dict):
 async def get_statuses(user_id: int):
     # Get active statuses from all users (MVP: everyone sees everyone)
     # Ideally: Filter by contacts.
-    current_time = datetime.now().isoformat()
-    
-    conn = get_db_connection()
-    cursor = get_db_cursor(conn)
-    
-    # Fetch active statuses
-    cursor.execute('''
-        SELECT s.*, u.name as user_name, u.avatar as user_avatar 
-        FROM status s
-        JOIN users u ON s.user_id = u.id
-        WHERE s.expires_at > %s
-        ORDER BY s.timestamp ASC
-    ''', (current_time,))
-    
-    rows = cursor.fetchall()
-    conn.close()
+    async with db_pool.acquire() as conn:
+        # Fetch active statuses (range scan on idx_status_expires_at)
+        rows = await conn.fetch('''
+            SELECT s.*, u.name as user_name, u.avatar as user_avatar 
+            FROM status s
+            JOIN users u ON s.user_id = u.id
+            WHERE s.expires_at > NOW()
+            ORDER BY s.timestamp ASC
+        ''')
     
     # Group by user
     grouped = {}
@@ -1485,11 +1392,7 @@ async def get_statuses(user_id: int):
             }
         
         story = dict(row)
-        # Parse viewers
-        try:
-            story['viewers'] = json.loads(story['viewers'])
-        except:
-            story['viewers'] = []
+        story['viewers'] = story.get('viewers') or []
             
         del story['user_name']
         del story['user_avatar']
@@ -1501,122 +1404,166 @@ async def get_statuses(user_id: int):
 async def view_status(status_id: int, request: dict):
     viewer_id = request.get("user_id")
     
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    
-    # Fetch current viewers
-    cursor.execute("SELECT viewers FROM status WHERE id = %s", (status_id,))
-    row = cursor.fetchone()
+    async with db_pool.acquire() as conn:
+        # Append only if not there yet; a no-op view doesn't touch the row
+        added = await conn.fetchval('''
+            UPDATE status
+            SET viewers = COALESCE(viewers, '[]'::jsonb) || $2::jsonb, synced = FALSE
+            WHERE id = $1 AND NOT COALESCE(viewers, '[]'::jsonb) @> $2::jsonb
+            RETURNING id
+        ''', status_id, [viewer_id])
+    if added:
+        sync_worker.notify()
+                
+    return {"status": "viewed"}
+@app.get("/metrics/websocket")
+async def get_websocket_metrics():
+    # Connection counts, slow-consumer events and fan-out latency histogram,
+    # plus the chat socket's metadata cache and message batcher
+    metrics = manager.metrics()
+    metrics["chat_cache"] = dict(chat_cache.stats, entries=len(chat_cache.chats))
+    metrics["message_writer"] = dict(message_writer.stats, pending=len(message_writer.pending))
+    return metrics
+
+@app.websocket("/ws/{user_id}")
+async def user_websocket_endpoint(websocket: WebSocket, user_id: int):
+    # One socket per user, multiplexing every chat they belong to.
+    # Chat events arrive as {"type": "chat_event", "chat_id", "payload"}.
+    async with db_pool.acquire() as conn:
+        rows = await conn.fetch("SELECT chat_id FROM chat_participants WHERE user_id = $1", user_id)
+    chat_ids = [row["chat_id"] for row in rows]
+    
+    was_online = manager.is_online(user_id)
+    await manager.connect_user(websocket, user_id, chat_ids)
+    if not was_online:
+        await manager.broadcast_many({"type": "status_update", "userId": user_id, "status": "online"}, chat_ids)
     
-    if row:
-        try:
-            viewers = json.loads(row[0])
-        except:
-            viewers = []
-            
-        if viewer_id not in viewers:
-            viewers.append(viewer_id)
-            cursor.execute("UPDATE status SET viewers = %s, synced = FALSE WHERE id = %s", (json.dumps(viewers), status_id))
-            conn.commit()
+    try:
+        while True:
+            data = await websocket.receive_text()
+            try:
+                request = json.loads(data)
+            except json.JSONDecodeError:
+                print(f"Invalid JSON received: {data}")
+                continue
             
-    conn.close()
-    return {"status": "viewed"}
-async def websocket_endpoint(websocket: WebSocket, chat_id: int, user_id: int):
-    # Check if user is blocked by anyone in the chat? 
-    # For now, allow connection, handle blocking at message level.
+            action = request.get("action")
+            chat_id = to_int(request.get("chat_id"))
+            if action == "subscribe" and chat_id is not None:
+                # Members, or anyone for public groups (e.g. browsing before joining)
+                async with db_pool.acquire() as conn:
+                    allowed = await conn.fetchval('''
+                        SELECT 1 FROM chats c
+                        WHERE c.id = $1 AND (
+                            (c.type = 'group' AND c.isPrivate = FALSE)
+                            OR EXISTS (SELECT 1 FROM chat_participants cp WHERE cp.chat_id = c.id AND cp.user_id = $2)
+                        )
+                    ''', chat_id, user_id)
+                if allowed:
+                    manager.route(websocket, chat_id)
+                manager.send(websocket, {"type": "subscribed" if allowed else "error", "chat_id": chat_id})
+            elif action == "unsubscribe" and chat_id is not None:
+                manager.unroute(websocket, chat_id)
+            elif action == "ping":
+                manager.send(websocket, {"type": "pong"})
+    except WebSocketDisconnect:
+        pass
+    except Exception as e:
+        print(f"User socket error: {e}")
+    finally:
+        chat_ids = list(manager.socket_chats.get(websocket, chat_ids))
+        manager.disconnect_user(websocket, user_id)
+        if not manager.is_online(user_id):
+            last_seen = datetime.now(timezone.utc)
+            try:
+                async with db_pool.acquire() as conn:
+                    await conn.execute("UPDATE users SET lastSeen = $1, synced = FALSE WHERE id = $2", last_seen, user_id)
+                sync_worker.notify()
+                await manager.broadcast_many({"type": "status_update", "userId": user_id, "status": "offline", "lastSeen": last_seen.isoformat()}, chat_ids)
+            except Exception as e:
+                print(f"Presence update error: {e}")
+
+def as_text(value):
+    return None if value is None else str(value)
+
+@app.websocket("/ws/{chat_id}/{user_id}")
+async def websocket_endpoint(websocket: WebSocket, chat_id: int, user_id: int, last_seq: int = None):
+    # Chat type, members and block pairs come from the per-worker cache,
+    # so an inbound frame costs no DB round trip of its own
+    try:
+        chat = await chat_cache.get(chat_id)
+    except Exception as e:
+        print(f"Chat lookup failed for socket on chat {chat_id}: {e}")
+        chat = None
+    if chat is None or not chat_cache.can_view(chat, user_id):
+        # Unknown chat, or a private one this user isn't in: no live events, no replay
+        await websocket.close(code=1008)
+        return
+
     await manager.connect(websocket, chat_id)
     try:
+        if last_seq is not None:
+            # Reconnect: replay only what was missed. Live events already
+            # queue behind this, and clients drop seqs they have seen.
+            missed = await events_since(chat_id, last_seq)
+            if missed is None:
+                manager.send(websocket, {"type": "resync"})
+            else:
+                for seq, event_type, payload in missed:
+                    manager.send(websocket, broadcast_payload(event_type, chat_id, payload, seq))
+
         while True:
             data = await websocket.receive_text()
             try:
                 message_data = json.loads(data)
-                
-                # Check Blocking Logic
-                sender_id = message_data.get("sender", str(user_id))
-                
-                # 1. Fetch participants of this chat to check if any of them blocked the sender
-                conn = get_db_connection()
-                cursor = conn.cursor()
-                
-                # ... (Simple Block Check: If 1-to-1, check other user)
-                # Optimization needed for production, but for MVP:
-                # We can do this check when saving to DB, or here.
-                
-                # 1. Save to Postgres
-                # ...
-                
-                # Let's add the blocking check inside the loop or before broadcast
-                
-                # Default values
-                msg_id = message_data.get("id", int(datetime.now().timestamp() * 1000))
-                # ... (rest of vars)
-                text = message_data.get("text", "")
-                sender = message_data.get("sender", str(user_id)) # Fallback to user_id path param
-                time_str = message_data.get("time", datetime.now().strftime("%H:%M"))
-                msg_type = message_data.get("type", "text")
-                file_url = message_data.get("fileUrl", "")
-                file_name = message_data.get("filename", "")
-                file_size = message_data.get("size", "")
-                
-                # BLOCKING CHECK START
-                # Check if this chat is 1-1 and the other user blocked 'sender'
-                # Fetch chat type and participants
-                cursor.execute("SELECT type, participants FROM chats WHERE id = %s", (chat_id,))
-                chat_row = cursor.fetchone()
-                
-                is_blocked = False
-                if chat_row:
-                    chat_type = chat_row[0]
-                    participants = json.loads(chat_row[1])
-                    if chat_type == 'private':
-                        # Find the other person
-                        other_user_id = next((p['id'] for p in participants if str(p['id']) != str(sender)), None)
-                        if other_user_id:
-                            # Check if other_user blocked sender
-                            cursor.execute("SELECT 1 FROM blocked_users WHERE blocker_id = %s AND blocked_id = %s", (other_user_id, sender))
-                            if cursor.fetchone():
-                                is_blocked = True
-                
-                if is_blocked:
-                    # Don't save, don't broadcast. Maybe send error back to sender?
-                    await websocket.send_text(json.dumps({
-                        "type": "error",
-                        "text": "You are blocked by this user."
-                    }))
-                    continue # Skip processing
-                # BLOCKING CHECK END
-                
-                cursor.execute('''
-                    INSERT INTO messages (id, chat_id, text, sender, time, type, fileUrl, fileName, fileSize, synced)
-
-                    VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, FALSE)
-                ''', (
-                    msg_id,
-                    chat_id,
-                    text,
-                    sender,
-                    time_str,
-                    msg_type,
-                    file_url,
-                    file_name,
-                    file_size
-                ))
-                
-                # Update Chat's Last Message
-                last_msg_preview = text if msg_type == 'text' else f"Sent a {msg_type}"
-                cursor.execute('UPDATE chats SET lastMessage = %s, timestamp = %s WHERE id = %s', 
-                               (last_msg_preview, datetime.now().isoformat(), chat_id))
-                
-                conn.commit()
-                conn.close()
-                
-                # 2. Broadcast to Room (via Redis)
-                await manager.broadcast(message_data, chat_id)
-                
             except json.JSONDecodeError:
-                print(f"Invalid JSON received: {data}")
+                print(f"Invalid JSON received: {data[:200]}")
+                continue
+            if not isinstance(message_data, dict):
+                continue
+
+            text = message_data.get("text") or ""
+            if not isinstance(text, str) or len(text) > WS_MAX_TEXT_CHARS:
+                manager.send(websocket, {"type": "error", "text": "Message is too long."})
+                continue
+
+            chat = await chat_cache.get(chat_id)
+            if chat is None:
+                # Chat was deleted while the socket was open
+                break
+            # The path identifies the sender; a "sender" field in the frame is ignored
+            if user_id not in chat["members"]:
+                manager.send(websocket, {"type": "error", "text": "You are not a member of this chat."})
+                continue
+            if chat_cache.is_blocked(chat, user_id):
+                # Don't save, don't broadcast
+                manager.send(websocket, {"type": "error", "text": "You are blocked by this user."})
+                continue
+
+            message = {
+                # Ids are always assigned here; client-chosen ones could collide
+                "id": id_generator.next_id(),
+                "chat_id": chat_id,
+                "text": text,
+                "sender": str(user_id),
+                "time": as_text(message_data.get("time")) or datetime.now().strftime("%H:%M"),
+                "type": as_text(message_data.get("type")) or "text",
+                "fileUrl": as_text(message_data.get("fileUrl")),
+                "filename": as_text(message_data.get("filename")),
+                "size": as_text(message_data.get("size")),
+                "isVoice": bool(message_data.get("isVoice", False)),
+                "replyTo": message_data.get("replyTo"),
+            }
+            # Resolves once the batch commits; the outbox then broadcasts it
+            try:
+                await message_writer.submit(message)
+            except DuplicateMessage:
+                manager.send(websocket, {"type": "error", "text": "Message was already sent."})
             except Exception as e:
-                print(f"Error processing message: {e}")
-                
+                print(f"Error saving message from socket: {e}")
+                manager.send(websocket, {"type": "error", "text": "Message could not be saved."})
+
     except WebSocketDisconnect:
+        pass
+    finally:
         manager.disconnect(websocket, chat_id)
@@ -0,0 +1,179 @@
+import os
+import json
+import asyncio
+from datetime import datetime, timezone
+from database import db_pool
+from outbox import append_outbox_many, outbox_relay, MESSAGE_CREATED
+
+# Inbound WebSocket messages are held this long (seconds) so frames from
+# every connection on this worker land in one multi-row INSERT
+MESSAGE_BATCH_INTERVAL = float(os.getenv("MESSAGE_BATCH_INTERVAL", "0.005"))
+MESSAGE_BATCH_MAX_ROWS = int(os.getenv("MESSAGE_BATCH_MAX_ROWS", "500"))
+
+UPLOADS_PREFIX = "/uploads/"
+
+# One statement per batch. Derivatives of already-processed uploads are
+# joined in, so file messages get thumbUrl/previewText like the REST path.
+INSERT_BATCH_SQL = '''
+    INSERT INTO messages (id, chat_id, text, sender, time, type, fileUrl, fileName, fileSize,
+                          isVoice, replyTo, thumbUrl, previewText, synced)
+    SELECT m.id, m.chat_id, m.text, m.sender, m.time, m.type, m.file_url, m.file_name, m.file_size,
+           m.is_voice, m.reply_to::jsonb,
+           b.derivatives::json->>'thumbUrl', b.derivatives::json->>'previewText', FALSE
+    FROM unnest($1::bigint[], $2::bigint[], $3::text[], $4::text[], $5::text[], $6::text[],
+                $7::text[], $8::text[], $9::text[], $10::boolean[], $11::text[],
+                $12::text[], $13::text[])
+         AS m(id, chat_id, text, sender, time, type, file_url, file_name, file_size,
+              is_voice, reply_to, blob_sha, blob_ext)
+    LEFT JOIN upload_blobs b ON b.sha256 = m.blob_sha AND b.ext = m.blob_ext
+    ON CONFLICT (id) DO NOTHING
+    RETURNING id, thumbUrl, previewText
+'''
+
+UPDATE_CHATS_SQL = '''
+    UPDATE chats c SET lastMessage = u.preview, timestamp = u.ts
+    FROM unnest($1::bigint[], $2::text[], $3::timestamptz[]) AS u(id, preview, ts)
+    WHERE c.id = u.id
+'''
+
+COLUMNS = ("id", "chat_id", "text", "sender", "time", "type", "fileUrl", "filename", "size", "isVoice")
+
+class DuplicateMessage(Exception):
+    pass
+
+def blob_key(file_url):
+    # (sha256, ext) of a content-addressed upload, for the derivatives join
+    if not file_url or not file_url.startswith(UPLOADS_PREFIX):
+        return None, None
+    digest, ext = os.path.splitext(file_url[len(UPLOADS_PREFIX):])
+    return digest, ext
+
+def last_message_preview(message: dict) -> str:
+    if message.get("type", "text") == "text":
+        return message.get("text") or ""
+    return f"Sent a {message.get('type')}"
+
+class MessageWriter:
+    """Write-behind persistence for messages arriving over chat WebSockets.
+
+    submit() queues a message and resolves once its batch has committed, so
+    the socket still learns about failures, but concurrent senders share
+    one transaction: a multi-row INSERT, one UPDATE for the affected chats'
+    lastMessage and one bulk outbox insert. A batch closes after
+    MESSAGE_BATCH_INTERVAL or MESSAGE_BATCH_MAX_ROWS, whichever comes first.
+    """
+
+    def __init__(self):
+        self.pending = []
+        self.task = None
+        self.wakeup = asyncio.Event()
+        self.stats = {"messages": 0, "batches": 0, "duplicates": 0, "fallbacks": 0}
+
+    def start(self):
+        self.task = asyncio.create_task(self.run())
+        print("Message writer started.")
+
+    async def stop(self):
+        if self.task:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+        # Don't lose what was already accepted
+        while self.pending:
+            await self.flush()
+        print("Message writer stopped.")
+
+    async def submit(self, message: dict) -> dict:
+        if self.task is None:
+            raise RuntimeError("Message writer is not running")
+        future = asyncio.get_running_loop().create_future()
+        self.pending.append((message, future))
+        self.wakeup.set()
+        return await future
+
+    async def run(self):
+        while True:
+            await self.wakeup.wait()
+            self.wakeup.clear()
+            if len(self.pending) < MESSAGE_BATCH_MAX_ROWS:
+                # Let other connections' frames join this batch
+                await asyncio.sleep(MESSAGE_BATCH_INTERVAL)
+            while self.pending:
+                await self.flush()
+
+    async def flush(self):
+        batch = self.pending[:MESSAGE_BATCH_MAX_ROWS]
+        del self.pending[:MESSAGE_BATCH_MAX_ROWS]
+        try:
+            results = await self.write(batch)
+        except asyncio.CancelledError:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(RuntimeError("Message writer stopped"))
+            raise
+        except Exception as e:
+            # One bad row shouldn't fail everybody else's message
+            print(f"Message batch of {len(batch)} failed, retrying one by one: {e}")
+            self.stats["fallbacks"] += 1
+            results = []
+            for item in batch:
+                try:
+                    results.extend(await self.write([item]))
+                except Exception as row_error:
+                    results.append(row_error)
+        for (_, future), result in zip(batch, results):
+            if future.done():
+                continue
+            if isinstance(result, Exception):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+
+    async def write(self, batch):
+        messages = [message for message, _ in batch]
+        columns = [[message.get(name) for message in messages] for name in COLUMNS]
+        # Sent as JSON text and cast to JSONB in INSERT_BATCH_SQL (unnest takes text[])
+        columns.append([json.dumps(message["replyTo"]) if message.get("replyTo") else None for message in messages])
+        blob_keys = [blob_key(message.get("fileUrl")) for message in messages]
+        async with db_pool.transaction() as conn:
+            rows = await conn.fetch(INSERT_BATCH_SQL, *columns,
+                                    [key[0] for key in blob_keys], [key[1] for key in blob_keys])
+            inserted = {row["id"]: row for row in rows}
+
+            results = []
+            events = []
+            latest = {}
+            seen = set()
+            for message in messages:
+                row = inserted.get(message["id"])
+                if row is None or message["id"] in seen:
+                    # Id already taken (client resent, or two clients picked the same one)
+                    self.stats["duplicates"] += 1
+                    results.append(DuplicateMessage(f"Message {message['id']} already exists"))
+                    continue
+                seen.add(message["id"])
+                saved = dict(message, isPinned=False, thumbUrl=row["thumburl"], previewText=row["previewtext"])
+                results.append(saved)
+                events.append((saved["chat_id"], MESSAGE_CREATED, saved))
+                latest[saved["chat_id"]] = last_message_preview(saved)
+
+            if latest:
+                # Lock the chats in id order before touching them, as
+                # append_outbox_many does, so concurrent batches can't deadlock
+                await conn.execute("SELECT 1 FROM chats WHERE id = ANY($1::bigint[]) ORDER BY id FOR UPDATE",
+                                   list(latest.keys()))
+                now = datetime.now(timezone.utc)
+                await conn.execute(UPDATE_CHATS_SQL, list(latest.keys()), list(latest.values()), [now] * len(latest))
+            await append_outbox_many(conn, events)
+
+        if events:
+            outbox_relay.notify()
+        self.stats["messages"] += len(events)
+        self.stats["batches"] += 1
+        return results
+
+# Global instance
+message_writer = MessageWriter()
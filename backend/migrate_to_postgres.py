@@ -1,3 +1,4 @@
+import json
 import sqlite3
 import psycopg2
 from database import get_db_connection, init_db
@@ -56,16 +57,27 @@ def migrate():
             pg_cursor.execute("""
                 INSERT INTO messages (
                     id, chat_id, text, sender, time, type, fileUrl, fileName, fileSize, 
-                    isPinned, callRoomName, callStatus, isVoice, replyTo, isDeleted, deleted_for, synced
+                    isPinned, callRoomName, callStatus, isVoice, replyTo, isDeleted, synced
                 )
-                VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+                VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
                 ON CONFLICT (id) DO NOTHING
             """, (
                 msg['id'], msg['chat_id'], msg['text'], msg['sender'], msg['time'], msg['type'], 
                 msg['fileUrl'], msg['fileName'], msg['fileSize'], 
                 bool(msg['isPinned']), msg['callRoomName'], msg['callStatus'], bool(msg['isVoice']), 
-                msg['replyTo'], bool(msg['isDeleted']), msg['deleted_for'], bool(msg['synced'])
+                msg['replyTo'], bool(msg['isDeleted']), bool(msg['synced'])
             ))
+            # 'Delete for me' lives in message_hidden now
+            try:
+                hidden_for = json.loads(msg['deleted_for'] or '[]')
+            except (ValueError, TypeError):
+                hidden_for = []
+            for user_id in hidden_for:
+                if str(user_id).isdigit():
+                    pg_cursor.execute("""
+                        INSERT INTO message_hidden (user_id, message_id) VALUES (%s, %s)
+                        ON CONFLICT DO NOTHING
+                    """, (int(user_id), msg['id']))
 
         # 4. Ideas
         print("Migrating Ideas...")
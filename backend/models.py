@@ -7,6 +7,8 @@ class Message(BaseModel):
     type: str = "text"
     filename: Optional[str] = None
     fileUrl: Optional[str] = None
+    thumbUrl: Optional[str] = None
+    previewText: Optional[str] = None
     size: Optional[str] = None
     time: Optional[str] = None
     status: Optional[str] = None
@@ -0,0 +1,353 @@
+import os
+import json
+import time
+import asyncio
+from database import db_pool
+from redis_client import redis_client
+from event_log import add_event, stamp
+from sync_worker import sync_worker
+
+OUTBOX_BATCH_SIZE = int(os.getenv("OUTBOX_BATCH_SIZE", "500"))
+OUTBOX_POLL_INTERVAL = float(os.getenv("OUTBOX_POLL_INTERVAL", "0.5"))
+OUTBOX_RETENTION_DAYS = int(os.getenv("OUTBOX_RETENTION_DAYS", "7"))
+# A client that missed more events than this refetches instead of replaying.
+# Keep it below WS_SEND_QUEUE_SIZE: the replay is queued in one go.
+REPLAY_MAX_EVENTS = int(os.getenv("REPLAY_MAX_EVENTS", "200"))
+FIRESTORE_BATCH_LIMIT = 500
+# Advisory locks: one worker at a time publishes, one mirrors to Firestore
+OUTBOX_RELAY_LOCK = 7240001
+OUTBOX_MIRROR_LOCK = 7240002
+# Wait this long for another worker's batch before trying for the lock again
+OUTBOX_LOCK_RETRY = float(os.getenv("OUTBOX_LOCK_RETRY", "0.05"))
+# After a failed Firestore mirror, wait this long before retrying it
+OUTBOX_MIRROR_RETRY = float(os.getenv("OUTBOX_MIRROR_RETRY", "5"))
+
+# Event types written by the API
+MESSAGE_CREATED = "message_created"
+MESSAGE_UPDATED = "message_updated"     # edit, pin, soft delete
+MESSAGES_UPDATED = "messages_updated"   # bulk pin/soft delete: {"messages": [...]}
+MESSAGES_CLEARED = "messages_cleared"
+CHAT_DELETED = "chat_deleted"
+PARTICIPANTS_CHANGED = "participants_changed"
+MESSAGES_READ = "messages_read"
+
+async def next_seq(conn, chat_id: int, count: int = 1):
+    # Per-chat event sequence. The chats row stays locked until the caller
+    # commits, so seq order is commit order and there are no gaps. Returns
+    # the last seq reserved, or None if the chat row is gone.
+    return await conn.fetchval(
+        "UPDATE chats SET last_seq = COALESCE(last_seq, 0) + $2 WHERE id = $1 RETURNING last_seq",
+        chat_id, count)
+
+async def append_outbox(conn, chat_id: int, event_type: str, payload: dict):
+    # Must be called on the connection/transaction that did the mutation, so
+    # the event exists if and only if the change committed. Call
+    # outbox_relay.notify() after the commit to relay it right away.
+    seq = await next_seq(conn, chat_id)
+    await conn.execute('''
+        INSERT INTO outbox (chat_id, event_type, payload, seq)
+        VALUES ($1, $2, $3, $4)
+    ''', chat_id, event_type, json.dumps(payload, default=str), seq)
+
+async def append_outbox_many(conn, events):
+    # Bulk form of append_outbox for (chat_id, event_type, payload) tuples;
+    # unnest keeps the given order, so relay order matches commit order
+    if not events:
+        return
+    counts = {}
+    for chat_id, _, _ in events:
+        counts[chat_id] = counts.get(chat_id, 0) + 1
+    # Lock the chats in id order so concurrent batches can't deadlock
+    await conn.execute("SELECT 1 FROM chats WHERE id = ANY($1::bigint[]) ORDER BY id FOR UPDATE",
+                       list(counts.keys()))
+    rows = await conn.fetch('''
+        UPDATE chats c SET last_seq = COALESCE(c.last_seq, 0) + u.n
+        FROM unnest($1::bigint[], $2::int[]) AS u(id, n)
+        WHERE c.id = u.id
+        RETURNING c.id, c.last_seq
+    ''', list(counts.keys()), list(counts.values()))
+    next_seqs = {row["id"]: row["last_seq"] - counts[row["id"]] + 1 for row in rows}
+    seqs = []
+    for chat_id, _, _ in events:
+        seq = next_seqs.get(chat_id)
+        seqs.append(seq)
+        if seq is not None:
+            next_seqs[chat_id] = seq + 1
+    await conn.execute('''
+        INSERT INTO outbox (chat_id, event_type, payload, seq)
+        SELECT chat_id, event_type, payload, seq
+        FROM unnest($1::bigint[], $2::text[], $3::text[], $4::bigint[])
+             WITH ORDINALITY AS e(chat_id, event_type, payload, seq, n)
+        ORDER BY n
+    ''', [e[0] for e in events], [e[1] for e in events],
+        [json.dumps(e[2], default=str) for e in events], seqs)
+
+async def events_since(chat_id: int, last_seq: int, limit: int = REPLAY_MAX_EVENTS):
+    """Events of a chat after last_seq, as (seq, event_type, payload), in order.
+
+    Returns None when the gap can't be replayed exactly (events pruned, too
+    many missed, or a seq from the future); the client should resync.
+    """
+    async with db_pool.acquire() as conn:
+        current = await conn.fetchval("SELECT last_seq FROM chats WHERE id = $1", chat_id)
+        if current is None or last_seq > current:
+            return None
+        if last_seq == current:
+            return []
+        if current - last_seq > limit:
+            return None
+        rows = await conn.fetch('''
+            SELECT seq, event_type, payload FROM outbox
+            WHERE chat_id = $1 AND seq > $2 AND seq <= $3
+            ORDER BY seq
+        ''', chat_id, last_seq, current)
+    if len(rows) != current - last_seq:
+        return None
+    return [(row["seq"], row["event_type"], json.loads(row["payload"])) for row in rows]
+
+def broadcast_payload(event_type: str, chat_id: int, payload: dict, seq: int = None) -> dict:
+    # What WebSocket clients receive for each event
+    if event_type == PARTICIPANTS_CHANGED:
+        event = {"type": "participant_update", "participants": payload.get("participants", [])}
+    elif event_type == MESSAGES_CLEARED:
+        event = {"type": "chat_cleared", "chat_id": chat_id}
+    elif event_type == CHAT_DELETED:
+        event = {"type": "chat_deleted", "chat_id": chat_id}
+    elif event_type == MESSAGES_READ:
+        event = {"type": "messages_read", "chat_id": chat_id, "read_by": payload.get("read_by")}
+    elif event_type == MESSAGES_UPDATED:
+        event = {"type": "messages_updated", "chat_id": chat_id, "messages": payload.get("messages", [])}
+    else:
+        event = dict(payload)
+    if seq is not None:
+        event["seq"] = seq
+    return event
+
+class OutboxRelay:
+    """Drains the outbox table in id order, in bulk, to Redis and Firestore.
+
+    Every API worker runs a relay, but each batch is taken under a
+    transaction-level advisory lock, so only one worker publishes at a time
+    and batches go out strictly in id order. The Firestore mirror follows
+    its own cursor (mirrored_at) under a second lock: a failed mirror leaves
+    its rows for the next attempt without holding up the Redis fan-out.
+    """
+
+    def __init__(self):
+        self.db = None
+        self.task = None
+        self.wakeup = asyncio.Event()
+        self.mirror_retry_at = 0.0
+
+    def start(self, firestore_db):
+        self.db = firestore_db
+        self.task = asyncio.create_task(self.run())
+        print("Outbox relay started.")
+
+    async def stop(self):
+        if self.task:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            print("Outbox relay stopped.")
+
+    def notify(self):
+        self.wakeup.set()
+
+    async def run(self):
+        passes = 0
+        while True:
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), timeout=OUTBOX_POLL_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            self.wakeup.clear()
+            try:
+                await self.drain(self.relay_batch)
+                if self.db and time.monotonic() >= self.mirror_retry_at:
+                    await self.drain(self.mirror_batch)
+                passes += 1
+                if passes % 1000 == 0:
+                    await self.prune()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"Outbox relay error: {e}")
+
+    async def drain(self, step):
+        # Runs step until the backlog is empty. None means another worker
+        # holds the lock; its batch may have been read before ours committed.
+        while True:
+            count = await step()
+            if count is None:
+                await asyncio.sleep(OUTBOX_LOCK_RETRY)
+            elif count < OUTBOX_BATCH_SIZE:
+                return
+
+    async def relay_batch(self):
+        async with db_pool.transaction() as conn:
+            if not await conn.fetchval("SELECT pg_try_advisory_xact_lock($1)", OUTBOX_RELAY_LOCK):
+                return None
+            rows = await conn.fetch('''
+                SELECT id, chat_id, event_type, payload, seq FROM outbox
+                WHERE relayed_at IS NULL
+                ORDER BY id
+                LIMIT $1
+            ''', OUTBOX_BATCH_SIZE)
+            if not rows:
+                return 0
+
+            events = [(row["id"], row["chat_id"], row["event_type"], json.loads(row["payload"])) for row in rows]
+            seqs = {row["id"]: row["seq"] for row in rows}
+
+            # Redis fan-out, one pipeline round trip for the whole batch
+            await self.publish(events, seqs)
+
+            # Without Firestore there is nothing left to do for these rows
+            await conn.execute('''
+                UPDATE outbox SET relayed_at = NOW(),
+                    mirrored_at = CASE WHEN $2 THEN NULL ELSE NOW() END
+                WHERE id = ANY($1::bigint[])
+            ''', [event[0] for event in events], bool(self.db))
+            return len(rows)
+
+    async def mirror_batch(self):
+        async with db_pool.transaction() as conn:
+            if not await conn.fetchval("SELECT pg_try_advisory_xact_lock($1)", OUTBOX_MIRROR_LOCK):
+                return None
+            # Only what has been published, in id order
+            rows = await conn.fetch('''
+                SELECT id, chat_id, event_type, payload FROM outbox
+                WHERE mirrored_at IS NULL AND relayed_at IS NOT NULL
+                ORDER BY id
+                LIMIT $1
+            ''', OUTBOX_BATCH_SIZE)
+            if not rows:
+                return 0
+
+            events = [(row["id"], row["chat_id"], row["event_type"], json.loads(row["payload"])) for row in rows]
+            try:
+                # Blocking SDK -> thread. Writes are merges/deletes, so
+                # replaying a partly applied batch converges to the same state.
+                await asyncio.to_thread(self.mirror, events)
+            except Exception as e:
+                print(f"Outbox Firestore mirror error, retrying in {OUTBOX_MIRROR_RETRY}s: {e}")
+                self.mirror_retry_at = time.monotonic() + OUTBOX_MIRROR_RETRY
+                return 0
+
+            await conn.execute("UPDATE outbox SET mirrored_at = NOW() WHERE id = ANY($1::bigint[])",
+                               [event[0] for event in events])
+            message_ids = []
+            for _, _, event_type, payload in events:
+                if event_type in (MESSAGE_CREATED, MESSAGE_UPDATED) and payload.get("id"):
+                    message_ids.append(payload["id"])
+                elif event_type == MESSAGES_UPDATED:
+                    message_ids.extend(message["id"] for message in payload.get("messages", []))
+                elif event_type == MESSAGES_READ:
+                    message_ids.extend(payload.get("message_ids", []))
+            if message_ids:
+                await conn.execute("UPDATE messages SET synced = TRUE WHERE id = ANY($1::bigint[])", message_ids)
+            return len(rows)
+
+    async def publish(self, events, seqs):
+        redis = redis_client.get_client()
+        if not redis:
+            print("Redis not connected, skipping publish")
+            return
+        async with redis.pipeline(transaction=False) as pipe:
+            for event_id, chat_id, event_type, payload in events:
+                event = stamp(broadcast_payload(event_type, chat_id, payload, seqs.get(event_id)))
+                add_event(pipe, f"chat:{chat_id}", json.dumps(event, default=str))
+            await pipe.execute()
+
+    async def prune(self):
+        # Relayed events are only kept for debugging/replay for a while;
+        # ones Firestore hasn't taken yet stay until it has
+        async with db_pool.acquire() as conn:
+            await conn.execute(
+                "DELETE FROM outbox WHERE relayed_at < NOW() - make_interval(days => $1) AND mirrored_at IS NOT NULL",
+                OUTBOX_RETENTION_DAYS)
+
+    # --- Firestore side (blocking SDK, runs in a thread) ---
+
+    def chat_ref(self, chat_id):
+        # Shares the sync worker's chat_id -> doc reference cache
+        return sync_worker.chat_ref(chat_id)
+
+    def mirror(self, events):
+        batch = self.db.batch()
+        pending = 0
+
+        def flush():
+            nonlocal batch, pending
+            if pending:
+                batch.commit()
+            batch = self.db.batch()
+            pending = 0
+
+        for _, chat_id, event_type, payload in events:
+            if event_type in (MESSAGE_CREATED, MESSAGE_UPDATED):
+                doc = {k: v for k, v in payload.items() if k not in ("chat_id", "synced")}
+                ref = self.chat_ref(chat_id).collection("messages").document(str(payload["id"]))
+                batch.set(ref, doc, merge=True)
+                pending += 1
+                if event_type == MESSAGE_CREATED:
+                    batch.set(self.chat_ref(chat_id), {
+                        "lastMessage": payload.get("text") or "Sent a file",
+                        "timestamp": payload.get("time"),
+                    }, merge=True)
+                    pending += 1
+            elif event_type == MESSAGES_UPDATED:
+                # Keep a bulk update in one Firestore batch when it fits
+                messages = payload.get("messages", [])
+                if pending + len(messages) > FIRESTORE_BATCH_LIMIT:
+                    flush()
+                for message in messages:
+                    doc = {k: v for k, v in message.items() if k not in ("chat_id", "synced")}
+                    ref = self.chat_ref(chat_id).collection("messages").document(str(message["id"]))
+                    batch.set(ref, doc, merge=True)
+                    pending += 1
+                    if pending >= FIRESTORE_BATCH_LIMIT:
+                        flush()
+            elif event_type == MESSAGES_READ:
+                # Older events carry no ids; those messages stay as they were
+                for message_id in payload.get("message_ids", []):
+                    ref = self.chat_ref(chat_id).collection("messages").document(str(message_id))
+                    batch.set(ref, {"status": "read"}, merge=True)
+                    pending += 1
+                    if pending >= FIRESTORE_BATCH_LIMIT:
+                        flush()
+            elif event_type == PARTICIPANTS_CHANGED:
+                batch.set(self.chat_ref(chat_id), {"participants": payload.get("participants", [])}, merge=True)
+                pending += 1
+            elif event_type in (MESSAGES_CLEARED, CHAT_DELETED):
+                # Order matters: apply everything queued so far first
+                flush()
+                self.delete_messages(chat_id)
+                if event_type == CHAT_DELETED:
+                    self.chat_ref(chat_id).delete()
+                    sync_worker.chat_refs.pop(chat_id, None)
+                else:
+                    self.chat_ref(chat_id).set({"lastMessage": "Chat cleared", "timestamp": payload.get("timestamp")}, merge=True)
+            if pending >= FIRESTORE_BATCH_LIMIT - 1:
+                flush()
+        flush()
+
+    def delete_messages(self, chat_id):
+        messages_ref = self.chat_ref(chat_id).collection("messages")
+        batch = self.db.batch()
+        count = 0
+        for msg in messages_ref.stream():
+            batch.delete(msg.reference)
+            count += 1
+            if count >= FIRESTORE_BATCH_LIMIT:
+                batch.commit()
+                batch = self.db.batch()
+                count = 0
+        if count > 0:
+            batch.commit()
+
+# Global instance
+outbox_relay = OutboxRelay()
@@ -0,0 +1,198 @@
+import os
+import json
+import asyncio
+from datetime import datetime, date, timezone
+from database import db_pool
+
+# Firestore caps a batch at 500 writes
+FIRESTORE_BATCH_LIMIT = 500
+SYNC_BATCH_SIZE = int(os.getenv("SYNC_BATCH_SIZE", "400"))
+SYNC_INTERVAL = float(os.getenv("SYNC_INTERVAL", "5"))
+# A claim older than this belongs to a worker that died mid-write; retake it
+SYNC_CLAIM_TIMEOUT = float(os.getenv("SYNC_CLAIM_TIMEOUT", "300"))
+
+# Table -> key column (also the Firestore doc id). Each scan is served by a
+# partial index on (key) WHERE synced = FALSE, see database.MIGRATIONS.
+# Message changes are mirrored by the outbox relay (outbox.py) instead.
+SYNCED_TABLES = {
+    "users": "id",
+    "chats": "id",
+    "ideas": "id",
+    "status": "id",
+    "user_keys": "user_id",
+}
+JSON_FIELDS = {
+    "chats": ["participants", "createdby"],
+    "messages": ["replyto"],
+    "status": ["viewers"],
+    "users": ["settings"],
+    "user_keys": ["pre_key_bundle"],
+}
+
+def to_firestore_doc(table: str, row) -> dict:
+    doc = dict(row)
+    doc.pop("synced", None)
+    doc.pop("sync_claimed_at", None)
+    for field in JSON_FIELDS.get(table, []):
+        if isinstance(doc.get(field), str):
+            try:
+                doc[field] = json.loads(doc[field])
+            except Exception:
+                pass
+    for key, value in doc.items():
+        if isinstance(value, (datetime, date)):
+            doc[key] = value.isoformat()
+    return doc
+
+class FirestoreSyncWorker:
+    """Single long-lived Postgres -> Firestore mirror.
+
+    Claims unsynced rows in one short statement (FOR UPDATE SKIP LOCKED, so
+    concurrent workers never take the same row) that flips them to synced
+    and stamps sync_claimed_at, then writes Firestore with no row locks held:
+    chat sends update the same chats rows and must not wait on Firestore.
+    A write that changes a row meanwhile sets synced = FALSE again, so it is
+    picked up by the next pass. Rows whose Firestore write failed are put
+    back; claims left by a crashed worker expire after SYNC_CLAIM_TIMEOUT.
+    """
+
+    def __init__(self):
+        self.db = None
+        self.task = None
+        self.wakeup = asyncio.Event()
+        # chat_id -> Firestore chat DocumentReference
+        self.chat_refs = {}
+
+    def start(self, firestore_db):
+        self.db = firestore_db
+        if not self.db:
+            print("Sync worker disabled (Firestore not configured).")
+            return
+        self.task = asyncio.create_task(self.run())
+        print("Sync worker started.")
+
+    async def stop(self):
+        if self.task:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            print("Sync worker stopped.")
+
+    def notify(self):
+        # Called by write endpoints; coalesces into the next sync pass
+        self.wakeup.set()
+
+    async def run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), timeout=SYNC_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            self.wakeup.clear()
+            try:
+                for table in SYNCED_TABLES:
+                    # Drain the table chunk by chunk. The cursor only moves
+                    # forward, so rows whose Firestore write failed are
+                    # retried on the next pass instead of spinning here.
+                    cursor = None
+                    while True:
+                        count, cursor = await self.sync_table(table, cursor)
+                        if count < SYNC_BATCH_SIZE:
+                            break
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"Sync worker error: {e}")
+
+    async def sync_table(self, table: str, after_id=None):
+        # Returns (rows claimed, cursor for the next chunk)
+        key = SYNCED_TABLES[table]
+        claimed_at = datetime.now(timezone.utc)
+        async with db_pool.acquire() as conn:
+            # 1. Claim and commit; the row locks end with this statement
+            rows = await conn.fetch(f'''
+                UPDATE {table} SET synced = TRUE, sync_claimed_at = $3
+                WHERE {key} IN (
+                    SELECT {key} FROM {table}
+                    -- In-flight rows wait for their claim to be released, so two
+                    -- versions of a row are never written concurrently
+                    WHERE ((synced = FALSE AND sync_claimed_at IS NULL)
+                           OR sync_claimed_at < $3 - make_interval(secs => $4))
+                      AND ($2::bigint IS NULL OR {key} > $2)
+                    ORDER BY {key}
+                    LIMIT $1
+                    FOR UPDATE SKIP LOCKED
+                )
+                RETURNING *
+            ''', SYNC_BATCH_SIZE, after_id, claimed_at, SYNC_CLAIM_TIMEOUT)
+        if not rows:
+            return 0, after_id
+        rows = sorted(rows, key=lambda row: row[key])
+
+        # 2. Firestore, outside any transaction
+        synced_ids = set(await asyncio.to_thread(self.write_rows, table, rows))
+
+        # 3. Release the claim; failed rows go back to unsynced
+        claimed_ids = [row[key] for row in rows]
+        failed_ids = [row_id for row_id in claimed_ids if row_id not in synced_ids]
+        async with db_pool.acquire() as conn:
+            await conn.execute(f'''
+                UPDATE {table}
+                SET sync_claimed_at = NULL,
+                    synced = CASE WHEN {key} = ANY($2::bigint[]) THEN FALSE ELSE synced END
+                WHERE {key} = ANY($1::bigint[]) AND sync_claimed_at = $3
+            ''', claimed_ids, failed_ids, claimed_at)
+        print(f"Synced {len(synced_ids)}/{len(rows)} {table} rows.")
+        return len(rows), claimed_ids[-1]
+
+    # --- Firestore side (blocking SDK, runs in a thread) ---
+
+    def chat_ref(self, chat_id):
+        ref = self.chat_refs.get(chat_id)
+        if ref is None:
+            # Legacy docs have auto ids with an "id" field; new ones use the chat id
+            docs = list(self.db.collection("chats").where("id", "==", chat_id).limit(1).stream())
+            ref = docs[0].reference if docs else self.db.collection("chats").document(str(chat_id))
+            self.chat_refs[chat_id] = ref
+        return ref
+
+    def write_rows(self, table: str, rows) -> list:
+        key = SYNCED_TABLES.get(table, "id")
+        writes = []
+        last_messages = {}
+        for row in rows:
+            doc = to_firestore_doc(table, row)
+            if table == "messages":
+                chat_id = doc.pop("chat_id")
+                ref = self.chat_ref(chat_id).collection("messages").document(str(doc["id"]))
+                # Only the newest message per chat updates the chat preview
+                last_messages[chat_id] = doc
+            elif table == "chats":
+                ref = self.chat_ref(doc["id"])
+            else:
+                ref = self.db.collection(table).document(str(doc[key]))
+            writes.append((ref, doc, row[key]))
+
+        for chat_id, doc in last_messages.items():
+            writes.append((self.chat_ref(chat_id), {
+                "lastMessage": doc.get("text") or "Sent a file",
+                "timestamp": doc.get("time"),
+            }, None))
+
+        synced_ids = []
+        for start in range(0, len(writes), FIRESTORE_BATCH_LIMIT):
+            chunk = writes[start:start + FIRESTORE_BATCH_LIMIT]
+            batch = self.db.batch()
+            for ref, data, _ in chunk:
+                batch.set(ref, data, merge=True)
+            try:
+                batch.commit()
+                synced_ids.extend(row_id for _, _, row_id in chunk if row_id is not None)
+            except Exception as e:
+                print(f"Firestore batch failed for {table}: {e}")
+        return synced_ids
+
+# Global instance
+sync_worker = FirestoreSyncWorker()
@@ -0,0 +1,61 @@
+"""
+Local stand-in for the Groq chat completions API.
+
+Run:
+    uvicorn tests.fake_llm_server:app --port 8001
+
+then start the backend with
+    GROQ_API_KEY=test GROQ_API_URL=http://localhost:8001/openai/v1/chat/completions
+
+FAKE_LLM_DELAY (seconds) simulates a slow model.
+"""
+import os
+import json
+import asyncio
+from fastapi import FastAPI, Request
+
+FAKE_LLM_DELAY = float(os.getenv("FAKE_LLM_DELAY", "0.5"))
+IDEA_KEYWORDS = ("idea", "app", "startup", "platform", "we should", "build")
+
+app = FastAPI()
+stats = {"requests": 0}
+
+def classify(text: str) -> dict:
+    lowered = text.lower()
+    is_idea = any(keyword in lowered for keyword in IDEA_KEYWORDS)
+    return {
+        "is_idea": is_idea,
+        "confidence": 0.9 if is_idea else 0.1,
+        "summary": text[:80] if is_idea else "",
+        "category": "Technology" if is_idea else "Other"
+    }
+
+@app.post("/openai/v1/chat/completions")
+async def chat_completions(request: Request):
+    body = await request.json()
+    stats["requests"] += 1
+    await asyncio.sleep(FAKE_LLM_DELAY)
+
+    user_content = next((m["content"] for m in body.get("messages", []) if m["role"] == "user"), "")
+    try:
+        # Batched prompt: {"items": [{"i": .., "text": ..}]}
+        items = json.loads(user_content)["items"]
+        stats["batched_items"] = stats.get("batched_items", 0) + len(items)
+        answer = {"results": [dict(classify(item["text"]), i=item["i"]) for item in items]}
+    except (ValueError, KeyError, TypeError):
+        answer = classify(user_content)
+
+    return {
+        "id": f"fake-{stats['requests']}",
+        "object": "chat.completion",
+        "model": body.get("model"),
+        "choices": [{
+            "index": 0,
+            "message": {"role": "assistant", "content": json.dumps(answer)},
+            "finish_reason": "stop"
+        }]
+    }
+
+@app.get("/stats")
+async def get_stats():
+    return stats
@@ -0,0 +1,66 @@
+import time
+import requests
+
+# Needs the backend on :8000 pointed at tests/fake_llm_server.py (see its docstring)
+BASE_URL = "http://localhost:8000"
+
+def wait_for_job(job_id, timeout=30):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        res = requests.get(f"{BASE_URL}/analysis-jobs/{job_id}")
+        job = res.json()
+        if job["status"] in ("done", "failed"):
+            return job
+        time.sleep(0.2)
+    raise TimeoutError(f"Job {job_id} did not finish")
+
+def test_analysis_jobs():
+    # 1. Submitting returns immediately with a job id
+    start = time.time()
+    res = requests.post(f"{BASE_URL}/analyze-message", json={
+        "text": "My idea is an app that finds free parking spots in crowded cities.",
+        "sender": "test_user",
+        "is_idea": False
+    })
+    elapsed = time.time() - start
+    print(f"Submit: {res.status_code} in {elapsed:.3f}s -> {res.text}")
+    assert res.status_code == 202
+    job_id = res.json()["job_id"]
+
+    # 2. The event loop stays responsive while the LLM call is in flight
+    start = time.time()
+    ping = requests.get(f"{BASE_URL}/ideas")
+    print(f"GET /ideas during analysis: {ping.status_code} in {time.time() - start:.3f}s")
+
+    # 3. Poll for the result
+    job = wait_for_job(job_id)
+    print("Job:", job)
+    assert job["status"] == "done"
+    assert job["result"]["is_idea"] is True
+
+    # 4. Non-ideas finish too
+    res = requests.post(f"{BASE_URL}/analyze-message", json={
+        "text": "Lunch at noon tomorrow, see you all there.",
+        "sender": "test_user",
+        "is_idea": False
+    })
+    job = wait_for_job(res.json()["job_id"])
+    assert job["result"]["is_idea"] is False
+
+    # 5. Re-analyzing the same content (modulo case/whitespace) hits the cache
+    res = requests.post(f"{BASE_URL}/analyze-message", json={
+        "text": "my idea is an app that finds free parking   spots in crowded cities.",
+        "sender": "test_user",
+        "is_idea": False
+    })
+    job = wait_for_job(res.json()["job_id"])
+    assert job["result"]["is_idea"] is True
+    assert job["result"]["duplicate"] is True
+    print("Cache stats:", requests.get(f"{BASE_URL}/analysis-cache/stats").json())
+
+    # 6. Unknown jobs are 404
+    assert requests.get(f"{BASE_URL}/analysis-jobs/does-not-exist").status_code == 404
+    print("Analysis job tests passed.")
+
+if __name__ == "__main__":
+    test_analysis_jobs()
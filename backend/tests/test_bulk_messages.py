@@ -0,0 +1,53 @@
+import requests
+
+BASE_URL = "http://localhost:8000"
+CHAT_ID = 1 # Assuming chat 1 exists
+USER_ID = 1
+
+def send(text):
+    res = requests.post(f"{BASE_URL}/chats/{CHAT_ID}/messages", json={
+        "text": text, "sender": "test_script", "time": "12:00 PM"})
+    res.raise_for_status()
+    return res.json()["id"]
+
+def visible_ids():
+    res = requests.get(f"{BASE_URL}/chats/{CHAT_ID}/messages", params={"user_id": USER_ID, "limit": 200})
+    return {m["id"] for m in res.json()["messages"]}
+
+def test_bulk_messages():
+    ids = [send(f"bulk {i}") for i in range(5)]
+    print(f"Added messages {ids}")
+
+    # 1. Pin a list, then unpin by range
+    res = requests.post(f"{BASE_URL}/chats/{CHAT_ID}/messages/bulk/pin", json={"message_ids": ids[:3]})
+    assert res.status_code == 200, res.text
+    assert res.json()["updated"] == 3
+    assert all(m["isPinned"] for m in res.json()["messages"])
+
+    res = requests.post(f"{BASE_URL}/chats/{CHAT_ID}/messages/bulk/pin",
+                        json={"from_id": ids[0], "to_id": ids[-1], "pinned": False})
+    assert res.json()["updated"] == 3, res.text
+    print("Pin/unpin OK")
+
+    # 2. Soft delete a range; repeating it changes nothing
+    res = requests.post(f"{BASE_URL}/chats/{CHAT_ID}/messages/bulk/delete", json={"from_id": ids[3], "to_id": ids[4]})
+    assert res.json()["updated"] == 2, res.text
+    res = requests.post(f"{BASE_URL}/chats/{CHAT_ID}/messages/bulk/delete", json={"from_id": ids[3], "to_id": ids[4]})
+    assert res.json()["updated"] == 0, res.text
+    print("Soft delete OK")
+
+    # 3. Hide for me, then clear the whole chat for me
+    res = requests.post(f"{BASE_URL}/chats/{CHAT_ID}/messages/bulk/delete_for_me",
+                        json={"user_id": USER_ID, "message_ids": ids[:2]})
+    assert res.json()["hidden"] == 2, res.text
+    assert not visible_ids() & set(ids[:2])
+
+    res = requests.post(f"{BASE_URL}/chats/{CHAT_ID}/messages/bulk/delete_for_me", json={"user_id": USER_ID})
+    assert res.status_code == 400, "whole-chat hide must be explicit"
+    res = requests.post(f"{BASE_URL}/chats/{CHAT_ID}/messages/bulk/delete_for_me", json={"user_id": USER_ID, "all": True})
+    assert res.status_code == 200, res.text
+    assert not visible_ids()
+    print("Hide for me OK")
+
+if __name__ == "__main__":
+    test_bulk_messages()
@@ -0,0 +1,49 @@
+import os
+import hashlib
+import requests
+
+BASE_URL = "http://localhost:8000"
+
+def test_uploads():
+    data = os.urandom(3 * 1024 * 1024 + 123)
+    digest = hashlib.sha256(data).hexdigest()
+
+    # 1. Direct upload is stored under its content hash
+    res = requests.post(f"{BASE_URL}/upload", files={"file": ("deck.pdf", data)})
+    print("Direct:", res.status_code, res.json())
+    assert res.json()["filename"] == f"{digest}.pdf"
+
+    # 2. Same bytes again share the blob
+    res = requests.post(f"{BASE_URL}/upload", files={"file": ("copy.pdf", data)})
+    assert res.json()["filename"] == f"{digest}.pdf"
+    assert res.json()["deduplicated"] is True
+
+    # 3. Chunked upload, with a simulated resend of the first chunk
+    session = requests.post(f"{BASE_URL}/upload/init", json={"filename": "voice.webm", "size": len(data)}).json()
+    upload_id, chunk_size = session["upload_id"], session["chunk_size"]
+    chunk_size = min(chunk_size, 1024 * 1024)
+
+    first = data[:chunk_size]
+    assert requests.post(f"{BASE_URL}/upload/{upload_id}/append", params={"offset": 0}, data=first).status_code == 200
+    # Lost response -> client resends at the stale offset and gets 409
+    res = requests.post(f"{BASE_URL}/upload/{upload_id}/append", params={"offset": 0}, data=first)
+    print("Resend:", res.status_code, res.json())
+    assert res.status_code == 409
+
+    offset = requests.get(f"{BASE_URL}/upload/{upload_id}").json()["received"]
+    while offset < len(data):
+        res = requests.post(f"{BASE_URL}/upload/{upload_id}/append", params={"offset": offset},
+                            data=data[offset:offset + chunk_size])
+        offset = res.json()["received"]
+
+    res = requests.post(f"{BASE_URL}/upload/{upload_id}/complete")
+    print("Complete:", res.status_code, res.json())
+    assert res.json()["filename"] == f"{digest}.webm"
+
+    # 4. The blob is served back intact
+    served = requests.get(f"{BASE_URL}{res.json()['url']}").content
+    assert hashlib.sha256(served).hexdigest() == digest
+    print("Upload tests passed.")
+
+if __name__ == "__main__":
+    test_uploads()
@@ -31,7 +31,7 @@ def test_clear_chat():
     # 3. Verify empty
     print("Verifying...")
     res = requests.get(f"{BASE_URL}/chats/{CHAT_ID}/messages")
-    messages = res.json()
+    messages = res.json()["messages"]
     if len(messages) == 0:
         print("Verification successful: Chat is empty.")
     else:
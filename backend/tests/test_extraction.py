@@ -36,6 +36,15 @@ try:
         
     os.remove("test.txt")
     
+    # Extraction stops at the character budget
+    with open("test_big.txt", "w") as f:
+        f.write("word " * 100000)
+    text = extract_text("test_big.txt", max_chars=1000)
+    print(f"Budgeted extraction length: {len(text)}")
+    if len(text) != 1000:
+        print("Character budget not enforced.")
+    os.remove("test_big.txt")
+    
 except Exception as e:
     print(f"Runtime error: {e}")
     exit(1)
@@ -0,0 +1,424 @@
+import os
+import re
+import gzip
+import json
+import uuid
+import hashlib
+import asyncio
+import mimetypes
+from email.utils import formatdate, parsedate_to_datetime
+from fastapi import HTTPException
+from fastapi.responses import Response, StreamingResponse
+try:
+    from python_multipart.multipart import MultipartParser, parse_options_header
+except ImportError:
+    # python-multipart before 0.0.13
+    from multipart.multipart import MultipartParser, parse_options_header
+from database import db_pool
+from derivatives import build_derivatives
+
+UPLOAD_DIR = "uploads"
+# In-progress chunked uploads
+PARTIAL_DIR = os.path.join(UPLOAD_DIR, ".partial")
+UPLOAD_MAX_BYTES = int(os.getenv("UPLOAD_MAX_BYTES", str(100 * 1024 * 1024)))
+UPLOAD_CHUNK_SIZE = int(os.getenv("UPLOAD_CHUNK_SIZE", str(4 * 1024 * 1024)))
+# Abandoned chunked sessions are removed after this long
+UPLOAD_SESSION_TTL_HOURS = int(os.getenv("UPLOAD_SESSION_TTL_HOURS", "24"))
+READ_BLOCK = 1024 * 1024
+# Room for boundaries and part headers around the file in a multipart body
+MULTIPART_OVERHEAD = 64 * 1024
+
+# Upload names are uuids or content hashes, so a URL's bytes never change
+UPLOAD_CACHE_CONTROL = "public, max-age=31536000, immutable"
+# Text-like uploads get a .gz sibling served to clients that accept gzip
+PRECOMPRESS_EXTENSIONS = {".txt", ".html", ".htm", ".json", ".csv", ".svg", ".xml", ".md", ".js", ".css"}
+PRECOMPRESS_MAX_BYTES = 20 * 1024 * 1024
+# Keeps derivative tasks referenced until they finish
+derivative_tasks = set()
+SHA256_NAME = re.compile(r"^[0-9a-f]{64}$")
+RANGE_HEADER = re.compile(r"^bytes=(\d*)-(\d*)$")
+
+def blob_name(digest: str, ext: str) -> str:
+    # Content-addressed: identical bytes (and extension) map to one file
+    return f"{digest}{ext.lower()}"
+
+def clean_ext(filename: str) -> str:
+    _, ext = os.path.splitext(filename or "")
+    # Extension ends up in a path and a URL; keep it boring
+    ext = ext.lower()
+    if len(ext) > 10 or not ext[1:].isalnum():
+        return ""
+    return ext
+
+def write_block(path: str, data: bytes, mode: str = "ab"):
+    with open(path, mode) as f:
+        f.write(data)
+
+def hash_file(path: str) -> str:
+    sha = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(READ_BLOCK), b""):
+            sha.update(block)
+    return sha.hexdigest()
+
+def remove_quietly(path: str):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+async def store_blob(tmp_path: str, digest: str, ext: str, size: int) -> dict:
+    """Moves a fully written temp file into content-addressed storage and
+    bumps the blob's reference count. Duplicates just drop the temp file."""
+    name = blob_name(digest, ext)
+    final_path = os.path.join(UPLOAD_DIR, name)
+
+    async with db_pool.transaction() as conn:
+        blob = await conn.fetchrow('''
+            INSERT INTO upload_blobs (sha256, ext, size, ref_count)
+            VALUES ($1, $2, $3, 1)
+            ON CONFLICT (sha256, ext) DO UPDATE SET ref_count = upload_blobs.ref_count + 1
+            RETURNING ref_count, derivatives
+        ''', digest, ext, size)
+        ref_count = blob["ref_count"]
+
+        # Row lock above serializes concurrent uploads of the same bytes
+        if os.path.exists(final_path):
+            await asyncio.to_thread(remove_quietly, tmp_path)
+        else:
+            await asyncio.to_thread(os.replace, tmp_path, final_path)
+            if ext in PRECOMPRESS_EXTENSIONS and size <= PRECOMPRESS_MAX_BYTES:
+                await asyncio.to_thread(precompress, final_path)
+
+    if ref_count == 1:
+        # New blob: thumbnails/previews are built in the background
+        task = asyncio.create_task(build_derivatives(name))
+        derivative_tasks.add(task)
+        task.add_done_callback(derivative_tasks.discard)
+
+    return {
+        "url": f"/uploads/{name}",
+        "filename": name,
+        "size": size,
+        "sha256": digest,
+        "deduplicated": ref_count > 1,
+        **(json.loads(blob["derivatives"]) if blob["derivatives"] else {})
+    }
+
+class FilePartReader:
+    """Push-parser callbacks for a multipart body that keep only the bytes of
+    the "file" part, so nothing is spooled before we hash and size-check it."""
+
+    def __init__(self, content_type: str):
+        ctype, options = parse_options_header(content_type or "")
+        if ctype != b"multipart/form-data" or b"boundary" not in options:
+            raise HTTPException(status_code=400, detail="Expected a multipart/form-data body")
+        self.filename = None
+        self.found = False
+        self.in_file = False
+        self.headers = {}
+        self.header_field = b""
+        self.header_value = b""
+        self.pending = []
+        self.parser = MultipartParser(options[b"boundary"], callbacks={
+            "on_part_begin": self.on_part_begin,
+            "on_header_field": self.on_header_field,
+            "on_header_value": self.on_header_value,
+            "on_header_end": self.on_header_end,
+            "on_headers_finished": self.on_headers_finished,
+            "on_part_data": self.on_part_data,
+            "on_part_end": self.on_part_end,
+        })
+
+    def on_part_begin(self):
+        self.headers = {}
+
+    def on_header_field(self, data, start, end):
+        self.header_field += data[start:end]
+
+    def on_header_value(self, data, start, end):
+        self.header_value += data[start:end]
+
+    def on_header_end(self):
+        self.headers[self.header_field.lower()] = self.header_value
+        self.header_field = b""
+        self.header_value = b""
+
+    def on_headers_finished(self):
+        _, options = parse_options_header(self.headers.get(b"content-disposition", b""))
+        if options.get(b"name") == b"file" and not self.found:
+            self.found = True
+            self.in_file = True
+            self.filename = options.get(b"filename", b"").decode("utf-8", "replace")
+
+    def on_part_data(self, data, start, end):
+        if self.in_file:
+            # The parser reuses its buffer; copy out
+            self.pending.append(bytes(data[start:end]))
+
+    def on_part_end(self):
+        self.in_file = False
+
+    def feed(self, chunk: bytes) -> bytes:
+        # Returns the file bytes found in this chunk
+        self.parser.write(chunk)
+        block, self.pending = b"".join(self.pending), []
+        return block
+
+async def save_upload(request) -> dict:
+    """Streams a multipart upload from the request body to disk, hashing as
+    it goes. Oversized bodies are refused from Content-Length before any
+    bytes are read, and again by a running count for chunked requests."""
+    try:
+        declared = int(request.headers.get("content-length") or 0)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid Content-Length")
+    if declared > UPLOAD_MAX_BYTES + MULTIPART_OVERHEAD:
+        raise HTTPException(status_code=413, detail=f"File exceeds {UPLOAD_MAX_BYTES} bytes")
+
+    reader = FilePartReader(request.headers.get("content-type"))
+    os.makedirs(PARTIAL_DIR, exist_ok=True)
+    tmp_path = os.path.join(PARTIAL_DIR, f"direct-{uuid.uuid4().hex}")
+    sha = hashlib.sha256()
+    size = 0
+    received = 0
+    try:
+        # Keep empty uploads working (old behaviour); start from an empty blob
+        await asyncio.to_thread(write_block, tmp_path, b"", "wb")
+        async for chunk in request.stream():
+            received += len(chunk)
+            if received > UPLOAD_MAX_BYTES + MULTIPART_OVERHEAD:
+                raise HTTPException(status_code=413, detail=f"File exceeds {UPLOAD_MAX_BYTES} bytes")
+            block = reader.feed(chunk)
+            if not block:
+                continue
+            size += len(block)
+            if size > UPLOAD_MAX_BYTES:
+                raise HTTPException(status_code=413, detail=f"File exceeds {UPLOAD_MAX_BYTES} bytes")
+            sha.update(block)
+            await asyncio.to_thread(write_block, tmp_path, block)
+        reader.parser.finalize()
+        if not reader.found:
+            raise HTTPException(status_code=400, detail="file field required")
+    except BaseException:
+        await asyncio.to_thread(remove_quietly, tmp_path)
+        raise
+
+    return await store_blob(tmp_path, sha.hexdigest(), clean_ext(reader.filename), size)
+
+# --- Resumable chunked uploads: init -> append (repeat) -> complete ---
+
+async def init_session(filename: str, size: int) -> dict:
+    if size is None or size < 0:
+        raise HTTPException(status_code=400, detail="size required")
+    if size > UPLOAD_MAX_BYTES:
+        raise HTTPException(status_code=413, detail=f"File exceeds {UPLOAD_MAX_BYTES} bytes")
+
+    os.makedirs(PARTIAL_DIR, exist_ok=True)
+    upload_id = uuid.uuid4().hex
+    async with db_pool.acquire() as conn:
+        await conn.execute('''
+            INSERT INTO upload_sessions (id, filename, ext, size, received)
+            VALUES ($1, $2, $3, $4, 0)
+        ''', upload_id, filename, clean_ext(filename), size)
+    await asyncio.to_thread(write_block, os.path.join(PARTIAL_DIR, upload_id), b"", "wb")
+    await prune_sessions()
+    return {"upload_id": upload_id, "received": 0, "size": size, "chunk_size": UPLOAD_CHUNK_SIZE}
+
+async def get_session(upload_id: str) -> dict:
+    async with db_pool.acquire() as conn:
+        row = await conn.fetchrow("SELECT id, filename, size, received FROM upload_sessions WHERE id = $1", upload_id)
+    if not row:
+        raise HTTPException(status_code=404, detail="Upload session not found")
+    return {"upload_id": row["id"], "filename": row["filename"], "size": row["size"], "received": row["received"]}
+
+async def append_chunk(upload_id: str, offset: int, stream) -> dict:
+    """Appends the request body at offset. offset must equal what the server
+    already has, so a client that lost a response can resend safely."""
+    part_path = os.path.join(PARTIAL_DIR, upload_id)
+    async with db_pool.transaction() as conn:
+        # Row lock: one append per session at a time
+        row = await conn.fetchrow("SELECT size, received FROM upload_sessions WHERE id = $1 FOR UPDATE", upload_id)
+        if not row:
+            raise HTTPException(status_code=404, detail="Upload session not found")
+        if offset != row["received"]:
+            raise HTTPException(status_code=409, detail={"message": "Offset mismatch", "received": row["received"]})
+
+        received = row["received"]
+        written = 0
+        try:
+            # The partial file can hold bytes from an append that died before
+            # its commit; cut back to the committed length first
+            await asyncio.to_thread(os.truncate, part_path, received)
+            async for block in stream:
+                written += len(block)
+                if written > UPLOAD_CHUNK_SIZE or received + written > row["size"]:
+                    raise HTTPException(status_code=413, detail="Chunk exceeds the declared size")
+                await asyncio.to_thread(write_block, part_path, block)
+        except BaseException:
+            await asyncio.to_thread(os.truncate, part_path, received)
+            raise
+
+        received += written
+        await conn.execute("UPDATE upload_sessions SET received = $1, updated_at = NOW() WHERE id = $2", received, upload_id)
+    return {"upload_id": upload_id, "received": received, "size": row["size"]}
+
+async def complete_session(upload_id: str) -> dict:
+    part_path = os.path.join(PARTIAL_DIR, upload_id)
+    async with db_pool.transaction() as conn:
+        row = await conn.fetchrow("SELECT ext, size, received FROM upload_sessions WHERE id = $1 FOR UPDATE", upload_id)
+        if not row:
+            raise HTTPException(status_code=404, detail="Upload session not found")
+        if row["received"] != row["size"]:
+            raise HTTPException(status_code=409, detail={"message": "Upload incomplete", "received": row["received"]})
+        await conn.execute("DELETE FROM upload_sessions WHERE id = $1", upload_id)
+
+    digest = await asyncio.to_thread(hash_file, part_path)
+    return await store_blob(part_path, digest, row["ext"], row["size"])
+
+async def prune_sessions():
+    async with db_pool.acquire() as conn:
+        rows = await conn.fetch('''
+            DELETE FROM upload_sessions
+            WHERE updated_at < NOW() - make_interval(hours => $1)
+            RETURNING id
+        ''', UPLOAD_SESSION_TTL_HOURS)
+    for row in rows:
+        await asyncio.to_thread(remove_quietly, os.path.join(PARTIAL_DIR, row["id"]))
+
+def precompress(path: str):
+    # Only keep the variant when it actually saves something
+    try:
+        with open(path, "rb") as f:
+            raw = f.read()
+        packed = gzip.compress(raw, compresslevel=9)
+        if len(packed) < len(raw) * 0.9:
+            tmp_path = f"{path}.gz.tmp"
+            with open(tmp_path, "wb") as f:
+                f.write(packed)
+            os.replace(tmp_path, f"{path}.gz")
+    except OSError as e:
+        print(f"Precompress failed for {path}: {e}")
+
+# --- Serving: strong ETags, immutable caching, Range and precompressed variants ---
+
+def resolve_upload(name: str):
+    # No traversal and nothing hidden (.partial, .extracted)
+    parts = name.split("/")
+    if not name or any(part in ("", ".", "..") or part.startswith(".") for part in parts):
+        return None
+    path = os.path.join(UPLOAD_DIR, *parts)
+    return path if os.path.isfile(path) else None
+
+def upload_etag(path: str, stat) -> str:
+    stem = os.path.splitext(os.path.basename(path))[0]
+    if SHA256_NAME.match(stem):
+        # Content-addressed: the name is the content hash
+        return f'"{stem}"'
+    return f'"{stat.st_size:x}-{stat.st_mtime_ns:x}"'
+
+def etag_matches(header: str, etag: str) -> bool:
+    if not header:
+        return False
+    if header.strip() == "*":
+        return True
+    candidates = [tag.strip() for tag in header.split(",")]
+    # If-None-Match uses weak comparison
+    return any(tag.removeprefix("W/") == etag for tag in candidates)
+
+def parse_range(header: str, size: int):
+    """Returns (start, end) inclusive, None for 'serve everything', or raises
+    ValueError for an unsatisfiable range. Multi-range requests get the whole
+    file, which RFC 9110 allows."""
+    match = RANGE_HEADER.match(header.strip())
+    if not match:
+        return None
+    first, last = match.groups()
+    if not first and not last:
+        return None
+    if not first:
+        # Suffix range: last N bytes
+        length = int(last)
+        if length == 0:
+            raise ValueError()
+        return max(size - length, 0), size - 1
+    start = int(first)
+    end = min(int(last), size - 1) if last else size - 1
+    if start >= size or start > end:
+        raise ValueError()
+    return start, end
+
+async def read_file_range(path: str, start: int, length: int):
+    with open(path, "rb") as f:
+        f.seek(start)
+        remaining = length
+        while remaining > 0:
+            block = await asyncio.to_thread(f.read, min(READ_BLOCK, remaining))
+            if not block:
+                break
+            remaining -= len(block)
+            yield block
+
+async def serve_upload(request, name: str):
+    path = resolve_upload(name)
+    if not path:
+        raise HTTPException(status_code=404, detail="Not Found")
+
+    stat = await asyncio.to_thread(os.stat, path)
+    etag = upload_etag(path, stat)
+    gzip_etag = f'{etag[:-1]}-gz"'
+    media_type = mimetypes.guess_type(path)[0] or "application/octet-stream"
+    headers = {
+        "ETag": etag,
+        "Cache-Control": UPLOAD_CACHE_CONTROL,
+        "Last-Modified": formatdate(stat.st_mtime, usegmt=True),
+        "Accept-Ranges": "bytes",
+        "Vary": "Accept-Encoding",
+    }
+
+    # Pick the variant up front so a 304 carries the ETag the body would.
+    # Byte ranges refer to the identity bytes, so they never get gzip
+    range_header = request.headers.get("range")
+    use_gzip = (not range_header and "gzip" in request.headers.get("accept-encoding", "")
+                and os.path.isfile(f"{path}.gz"))
+    if use_gzip:
+        headers["Content-Encoding"] = "gzip"
+        headers["ETag"] = gzip_etag
+        # Byte ranges would refer to the compressed stream; don't offer them
+        headers.pop("Accept-Ranges")
+
+    # Conditional GET: repeat views cost a 304. Both variants hold the same
+    # content, so a cached copy of either one is still current
+    if_none_match = request.headers.get("if-none-match")
+    if etag_matches(if_none_match, etag) or etag_matches(if_none_match, gzip_etag):
+        return Response(status_code=304, headers=headers)
+    if not if_none_match and request.headers.get("if-modified-since"):
+        try:
+            if int(stat.st_mtime) <= parsedate_to_datetime(request.headers["if-modified-since"]).timestamp():
+                return Response(status_code=304, headers=headers)
+        except (TypeError, ValueError):
+            pass
+
+    size = stat.st_size
+    if_range = request.headers.get("if-range")
+    if range_header and (not if_range or if_range.strip() == etag):
+        try:
+            byte_range = parse_range(range_header, size)
+        except ValueError:
+            return Response(status_code=416, headers={**headers, "Content-Range": f"bytes */{size}"})
+        if byte_range:
+            start, end = byte_range
+            length = end - start + 1
+            headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+            headers["Content-Length"] = str(length)
+            body = b"" if request.method == "HEAD" else read_file_range(path, start, length)
+            return StreamingResponse(body, status_code=206, media_type=media_type, headers=headers)
+
+    # Whole file: the precompressed variant when the client takes gzip
+    if use_gzip:
+        path = f"{path}.gz"
+        size = (await asyncio.to_thread(os.stat, path)).st_size
+
+    headers["Content-Length"] = str(size)
+    body = b"" if request.method == "HEAD" else read_file_range(path, 0, size)
+    return StreamingResponse(body, media_type=media_type, headers=headers)
@@ -1,71 +1,393 @@
 from fastapi import WebSocket
-from typing import List, Dict
+from typing import Dict, Set
+import os
 import json
+import time
 import asyncio
 from redis_client import redis_client
+from event_log import StreamReader, add_event, publish, use_streams, stamp, published_at, EVENT_TRANSPORT
+
+# One pattern subscription per worker covers every chat and user channel
+CHAT_PATTERN = "chat:*"
+USER_PATTERN = "user:*"
+RECONNECT_DELAY = 1.0
+
+# Per-connection outbound buffer; what happens when a client can't keep up:
+#   drop       - discard the new event
+#   coalesce   - replace the whole backlog with one {"type": "resync"} (client refetches)
+#   disconnect - close the socket (1013, try again later)
+WS_SEND_QUEUE_SIZE = int(os.getenv("WS_SEND_QUEUE_SIZE", "256"))
+WS_SLOW_CONSUMER_POLICY = os.getenv("WS_SLOW_CONSUMER_POLICY", "coalesce")
+# A single send blocked longer than this means the socket is dead
+WS_SEND_TIMEOUT = float(os.getenv("WS_SEND_TIMEOUT", "10"))
+RESYNC_EVENT = json.dumps({"type": "resync"})
+
+class LatencyHistogram:
+    # Cumulative-bucket histogram (Prometheus style), in milliseconds
+    BUCKETS_MS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+
+    def __init__(self):
+        self.counts = [0] * (len(self.BUCKETS_MS) + 1)
+        self.total = 0
+        self.sum_ms = 0.0
+
+    def observe(self, ms: float):
+        self.total += 1
+        self.sum_ms += ms
+        for i, bound in enumerate(self.BUCKETS_MS):
+            if ms <= bound:
+                self.counts[i] += 1
+                return
+        self.counts[-1] += 1
+
+    def snapshot(self) -> dict:
+        buckets = {}
+        running = 0
+        for bound, count in zip(self.BUCKETS_MS, self.counts):
+            running += count
+            buckets[f"le_{bound}"] = running
+        buckets["le_inf"] = self.total
+        return {"count": self.total, "sum_ms": round(self.sum_ms, 3), "buckets": buckets}
+
+class ClientConnection:
+    """A socket plus its bounded outbound queue and writer task, so one slow
+    client never holds up delivery to anyone else."""
+
+    def __init__(self, websocket: WebSocket, manager):
+        self.websocket = websocket
+        self.manager = manager
+        self.queue = asyncio.Queue(maxsize=WS_SEND_QUEUE_SIZE)
+        self.closed = False
+        self.writer = asyncio.create_task(self.write_loop())
+
+    def enqueue(self, text: str, sent_at: float = None):
+        # sent_at: wall-clock ms of the Redis publish; None for direct replies
+        if self.closed:
+            return
+        try:
+            self.queue.put_nowait((text, sent_at))
+            return
+        except asyncio.QueueFull:
+            pass
+
+        self.manager.stats["slow_consumer"] += 1
+        if WS_SLOW_CONSUMER_POLICY == "disconnect":
+            self.close(code=1013)
+        elif WS_SLOW_CONSUMER_POLICY == "coalesce":
+            while not self.queue.empty():
+                self.queue.get_nowait()
+            self.queue.put_nowait((RESYNC_EVENT, sent_at))
+        else:
+            self.manager.stats["dropped"] += 1
+
+    async def write_loop(self):
+        try:
+            while True:
+                text, sent_at = await self.queue.get()
+                await asyncio.wait_for(self.websocket.send_text(text), timeout=WS_SEND_TIMEOUT)
+                if sent_at is not None:
+                    self.manager.fanout_latency.observe(max(0.0, time.time() * 1000 - sent_at))
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            print(f"WS: Dropping dead connection: {e}")
+            self.closed = True
+            self.manager.forget(self.websocket)
+
+    def close(self, code: int = 1000):
+        if self.closed:
+            return
+        self.closed = True
+        self.writer.cancel()
+        self.manager.forget(self.websocket)
+        asyncio.create_task(self.close_socket(code))
+
+    async def close_socket(self, code: int):
+        try:
+            await self.websocket.close(code=code)
+        except Exception:
+            pass
 
 class ConnectionManager:
+    """Routes Redis pub/sub events to local WebSockets.
+
+    Each worker holds a single pubsub connection with pattern subscriptions
+    on chat:* and user:*, and a local routing table chat_id -> sockets, so
+    the Redis connection count scales with workers, not with chats.
+
+    With EVENT_TRANSPORT=streams the pub/sub connection is replaced by a
+    consumer group on the sharded event streams (event_log.py), so a worker
+    whose Redis connection drops catches up instead of losing events.
+
+    Delivery never awaits a client: every socket has a bounded queue drained
+    by its own writer task, events are serialized once, and a client that
+    falls behind is handled by WS_SLOW_CONSUMER_POLICY.
+
+    Two kinds of sockets are routed:
+      * chat sockets (/ws/{chat_id}/{user_id}) receive that chat's events as-is
+      * user sockets (/ws/{user_id}) multiplex all of a user's chats; each
+        event arrives wrapped as {"type": "chat_event", "chat_id", "payload"}
+    """
+
     def __init__(self):
-        # Store active connections: chat_id -> List[WebSocket]
-        self.active_connections: Dict[int, List[WebSocket]] = {}
-        # Keep track of redis listener tasks: chat_id -> Task
-        self.redis_tasks: Dict[int, asyncio.Task] = {}
+        # chat_id -> chat sockets
+        self.active_connections: Dict[int, Set[WebSocket]] = {}
+        # chat_id -> user sockets routed to that chat
+        self.chat_routes: Dict[int, Set[WebSocket]] = {}
+        # user_id -> that user's user sockets
+        self.user_connections: Dict[int, Set[WebSocket]] = {}
+        # user socket -> chat_ids it is routed to
+        self.socket_chats: Dict[WebSocket, Set[int]] = {}
+        # socket -> its queue/writer
+        self.clients: Dict[WebSocket, ClientConnection] = {}
+        self.listener_task = None
+        self.stream_reader = StreamReader() if use_streams() else None
+        # Redis publish (stamped by the publisher) -> handed to the socket,
+        # per delivered event; includes Redis transit and local backlog
+        self.fanout_latency = LatencyHistogram()
+        self.stats = {"slow_consumer": 0, "dropped": 0, "dead": 0}
+        # Called with (kind, target_id, data) for every event this worker sees
+        self.event_hooks = []
+
+    def add_event_hook(self, hook):
+        # For local caches that are invalidated by pub/sub events
+        self.event_hooks.append(hook)
+
+    def start(self):
+        self.listener_task = asyncio.create_task(self.listen())
+        print("WS: Redis listener started.")
+
+    async def stop(self):
+        if self.listener_task:
+            self.listener_task.cancel()
+            try:
+                await self.listener_task
+            except asyncio.CancelledError:
+                pass
+            if self.stream_reader:
+                await self.stream_reader.close(redis_client.get_client())
+            print("WS: Redis listener stopped.")
+
+    # --- Chat sockets ---
 
     async def connect(self, websocket: WebSocket, chat_id: int):
         await websocket.accept()
-        if chat_id not in self.active_connections:
-            self.active_connections[chat_id] = []
-            # Start Redis Listener for this chat if first user
-            self.redis_tasks[chat_id] = asyncio.create_task(self.subscribe_to_chat(chat_id))
-            
-        self.active_connections[chat_id].append(websocket)
+        self.clients[websocket] = ClientConnection(websocket, self)
+        self.active_connections.setdefault(chat_id, set()).add(websocket)
         print(f"WS: Client connected to chat {chat_id}. Total: {len(self.active_connections[chat_id])}")
 
     def disconnect(self, websocket: WebSocket, chat_id: int):
-        if chat_id in self.active_connections:
-            if websocket in self.active_connections[chat_id]:
-                self.active_connections[chat_id].remove(websocket)
-                print(f"WS: Client disconnected from chat {chat_id}. Total: {len(self.active_connections[chat_id])}")
-            
-            if not self.active_connections[chat_id]:
+        self.release(websocket)
+        connections = self.active_connections.get(chat_id)
+        if connections and websocket in connections:
+            connections.discard(websocket)
+            print(f"WS: Client disconnected from chat {chat_id}. Total: {len(connections)}")
+            if not connections:
                 del self.active_connections[chat_id]
-                # Allow task to be cancelled or cleanup if needed
-                if chat_id in self.redis_tasks:
-                    self.redis_tasks[chat_id].cancel()
-                    del self.redis_tasks[chat_id]
 
-    async def subscribe_to_chat(self, chat_id: int):
-        redis = redis_client.get_client()
-        if not redis:
-            print("Redis client not initialized")
+    # --- User sockets ---
+
+    async def connect_user(self, websocket: WebSocket, user_id: int, chat_ids):
+        await websocket.accept()
+        self.clients[websocket] = ClientConnection(websocket, self)
+        self.user_connections.setdefault(user_id, set()).add(websocket)
+        self.socket_chats[websocket] = set()
+        for chat_id in chat_ids:
+            self.route(websocket, chat_id)
+        print(f"WS: User {user_id} connected ({len(self.socket_chats[websocket])} chats).")
+
+    def disconnect_user(self, websocket: WebSocket, user_id: int):
+        self.release(websocket)
+        for chat_id in self.socket_chats.pop(websocket, set()):
+            self.unroute_chat(websocket, chat_id)
+        sockets = self.user_connections.get(user_id)
+        if sockets:
+            sockets.discard(websocket)
+            if not sockets:
+                del self.user_connections[user_id]
+        print(f"WS: User {user_id} disconnected.")
+
+    def route(self, websocket: WebSocket, chat_id: int):
+        self.chat_routes.setdefault(chat_id, set()).add(websocket)
+        self.socket_chats.setdefault(websocket, set()).add(chat_id)
+
+    def unroute_chat(self, websocket: WebSocket, chat_id: int):
+        routes = self.chat_routes.get(chat_id)
+        if routes:
+            routes.discard(websocket)
+            if not routes:
+                del self.chat_routes[chat_id]
+
+    def unroute(self, websocket: WebSocket, chat_id: int):
+        self.unroute_chat(websocket, chat_id)
+        chats = self.socket_chats.get(websocket)
+        if chats:
+            chats.discard(chat_id)
+
+    def route_user(self, user_id: int, chat_id: int):
+        # Membership changed: start routing this chat to the user's sockets
+        for websocket in self.user_connections.get(user_id, ()):
+            self.route(websocket, chat_id)
+
+    def is_online(self, user_id: int) -> bool:
+        return user_id in self.user_connections
+
+    def release(self, websocket: WebSocket):
+        client = self.clients.pop(websocket, None)
+        if client and not client.closed:
+            client.closed = True
+            client.writer.cancel()
+
+    def forget(self, websocket: WebSocket):
+        # Dead or evicted socket: stop routing anything to it right away.
+        # The endpoint's own disconnect handling runs later and is a no-op.
+        if self.clients.pop(websocket, None):
+            self.stats["dead"] += 1
+        for chat_id, connections in list(self.active_connections.items()):
+            connections.discard(websocket)
+            if not connections:
+                del self.active_connections[chat_id]
+        for chat_id in self.socket_chats.get(websocket, set()):
+            self.unroute_chat(websocket, chat_id)
+
+    def send(self, websocket: WebSocket, message: dict):
+        # Direct replies go through the same queue to keep ordering
+        client = self.clients.get(websocket)
+        if client:
+            client.enqueue(json.dumps(message, default=str))
+
+    def metrics(self) -> dict:
+        return {
+            "connections": len(self.clients),
+            "chats": len(self.active_connections) + len(self.chat_routes),
+            "users": len(self.user_connections),
+            "queued": sum(client.queue.qsize() for client in self.clients.values()),
+            "slow_consumer_policy": WS_SLOW_CONSUMER_POLICY,
+            **self.stats,
+            "fanout_latency_ms": self.fanout_latency.snapshot(),
+            "transport": EVENT_TRANSPORT,
+            "event_log": self.stream_reader.stats if self.stream_reader else None,
+        }
+
+    # --- Redis side ---
+
+    async def listen(self):
+        if self.stream_reader:
+            await self.listen_streams()
             return
+        while True:
+            redis = redis_client.get_client()
+            if not redis:
+                await asyncio.sleep(RECONNECT_DELAY)
+                continue
+            pubsub = redis.pubsub()
+            try:
+                await pubsub.psubscribe(CHAT_PATTERN, USER_PATTERN)
+                async for message in pubsub.listen():
+                    if message["type"] == "pmessage":
+                        await self.dispatch(message["channel"], message["data"])
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"Redis Subscribe Error: {e}")
+                await asyncio.sleep(RECONNECT_DELAY)
+            finally:
+                try:
+                    await pubsub.punsubscribe()
+                    await pubsub.close()
+                except Exception:
+                    pass
 
-        pubsub = redis.pubsub()
-        await pubsub.subscribe(f"chat:{chat_id}")
-        
+    async def listen_streams(self):
+        # Same dispatch as pub/sub; after an error the consumer group picks
+        # up from the last acknowledged event instead of losing the gap
+        while True:
+            redis = redis_client.get_client()
+            if not redis:
+                await asyncio.sleep(RECONNECT_DELAY)
+                continue
+            try:
+                await self.stream_reader.run(redis, self.dispatch)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"Redis Stream Read Error: {e}")
+                await asyncio.sleep(RECONNECT_DELAY)
+
+    async def dispatch(self, channel: str, data: str):
+        kind, _, key = channel.partition(":")
         try:
-            async for message in pubsub.listen():
-                if message["type"] == "message":
-                    data = json.loads(message["data"])
-                    # Send to all local connections for this chat
-                    if chat_id in self.active_connections:
-                        for connection in self.active_connections[chat_id]:
-                            try:
-                                await connection.send_json(data)
-                            except Exception as e:
-                                print(f"WS: Error sending message: {e}")
-        except asyncio.CancelledError:
-            pass
-        except Exception as e:
-            print(f"Redis Subscribe Error chat {chat_id}: {e}")
-        finally:
-            await pubsub.unsubscribe(f"chat:{chat_id}")
-            await pubsub.close()
+            target_id = int(key)
+        except ValueError:
+            return
+
+        for hook in self.event_hooks:
+            try:
+                hook(kind, target_id, data)
+            except Exception as e:
+                print(f"WS event hook error: {e}")
+
+        if kind == "user":
+            sockets = self.user_connections.get(target_id)
+            if sockets:
+                await self.send_all(sockets, data, published_at(json.loads(data)))
+            return
+
+        chat_id = target_id
+        chat_sockets = self.active_connections.get(chat_id)
+        routed = self.chat_routes.get(chat_id)
+        # Membership changes must be seen even for chats nobody here routes
+        # yet: they are how a new member's user socket starts receiving it
+        if not chat_sockets and not routed and '"participant_update"' not in data:
+            return
+
+        event = json.loads(data)
+        if event.get("type") == "participant_update":
+            # New members who are online here start receiving this chat
+            for participant in event.get("participants", []):
+                try:
+                    self.route_user(int(participant.get("id")), chat_id)
+                except (AttributeError, TypeError, ValueError):
+                    continue
+            routed = self.chat_routes.get(chat_id)
+        if not chat_sockets and not routed:
+            # Nobody on this worker cares about this chat
+            return
+
+        sent_at = published_at(event)
+        if chat_sockets:
+            await self.send_all(chat_sockets, data, sent_at)
+        if routed:
+            # Encode the envelope once for every user socket
+            envelope = json.dumps({"type": "chat_event", "chat_id": chat_id, "payload": event})
+            await self.send_all(routed, envelope, sent_at)
+
+        if event.get("type") == "chat_deleted":
+            for websocket in list(self.chat_routes.get(chat_id, ())):
+                self.unroute(websocket, chat_id)
+
+    async def send_all(self, connections, text: str, sent_at: float = None):
+        # Non-blocking: each socket's writer task drains its own queue
+        for websocket in list(connections):
+            client = self.clients.get(websocket)
+            if client:
+                client.enqueue(text, sent_at)
 
     async def broadcast(self, message: dict, chat_id: int):
         # Instead of local loop, Publish to Redis
+        await publish(f"chat:{chat_id}", json.dumps(stamp(dict(message)), default=str))
+
+    async def broadcast_many(self, message: dict, chat_ids):
+        # Same event to many chats in one round trip (presence)
         redis = redis_client.get_client()
-        if redis:
-            await redis.publish(f"chat:{chat_id}", json.dumps(message))
-        else:
+        if not redis:
             print("Redis not connected, skipping publish")
+            return
+        data = json.dumps(stamp(dict(message)), default=str)
+        async with redis.pipeline(transaction=False) as pipe:
+            for chat_id in chat_ids:
+                add_event(pipe, f"chat:{chat_id}", data)
+            await pipe.execute()
+
+    async def send_to_user(self, message: dict, user_id: int):
+        await publish(f"user:{user_id}", json.dumps(stamp(dict(message)), default=str))
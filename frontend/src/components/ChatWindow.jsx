@@ -3,6 +3,7 @@ import { ArrowLeft, Phone, Video, MoreVertical, Paperclip, Mic, Send, Lightbulb,
 import VideoCall from './VideoCall';
 import FilePreviewModal from './FilePreviewModal';
 import ConfirmationModal from './ConfirmationModal';
+import UploadService from '../services/UploadService';
 
 const ChatWindow = ({ chat, chats, userStatuses, currentUser, onBack, onDeleteChat }) => {
     // Dynamic API URL
@@ -140,22 +141,9 @@ const ChatWindow = ({ chat, chats, userStatuses, currentUser, onBack, onDeleteCh
         // Add to UI immediately
         setMessages(prev => [...prev, tempMessage]);
 
-        const formData = new FormData();
-        formData.append('file', file);
-
         try {
-            // 2. Upload File
-            const response = await fetch(`${API_URL}/upload`, {
-                method: 'POST',
-                body: formData
-            });
-
-            if (!response.ok) {
-                const errData = await response.json().catch(() => ({}));
-                throw new Error(errData.detail || "Upload failed");
-            }
-
-            const data = await response.json();
+            // 2. Upload File (chunked + resumable for large files)
+            const data = await UploadService.uploadFile(file);
             if (!data.url) throw new Error("Server returned no file URL");
 
             // 3. Prepare Final Message
@@ -204,25 +192,97 @@ const ChatWindow = ({ chat, chats, userStatuses, currentUser, onBack, onDeleteCh
     };
 
     const lastMessagesRef = useRef("");
+    // Event seqs seen for this chat: everything up to `last`, plus any that
+    // arrived out of order. `last` is what we resume from on reconnect.
+    const seqRef = useRef({ last: 0, ahead: new Set() });
+    // Cursor for the next older page (null when the start of history is loaded)
+    const [olderCursor, setOlderCursor] = useState(null);
+
+    // Merge a page into the list by id (page wins), keeping id order
+    const mergeMessages = (prev, page) => {
+        const byId = new Map(prev.map(m => [m.id, m]));
+        page.forEach(m => byId.set(m.id, m));
+        return Array.from(byId.values()).sort((a, b) => a.id - b.id);
+    };
+
+    const loadOlderMessages = () => {
+        if (!olderCursor || !currentUser) return;
+        fetch(`${API_URL}/chats/${chat.id}/messages?user_id=${currentUser.id}&before_id=${olderCursor}`)
+            .then(res => {
+                if (!res.ok) throw new Error("Failed to fetch older messages");
+                return res.json();
+            })
+            .then(data => {
+                setMessages(prev => mergeMessages(prev, data.messages));
+                setOlderCursor(data.next_before_id);
+            })
+            .catch(err => console.error("Failed to fetch older messages", err));
+    };
 
     useEffect(() => {
         lastMessagesRef.current = ""; // Reset on chat change
+        seqRef.current = { last: 0, ahead: new Set() };
+        setMessages([]);
+        setOlderCursor(null);
+
+        // Returns false for an event already applied (replay overlapping live events)
+        const acceptSeq = (seq) => {
+            const seen = seqRef.current;
+            if (seq <= seen.last || seen.ahead.has(seq)) return false;
+            seen.ahead.add(seq);
+            while (seen.ahead.has(seen.last + 1)) {
+                seen.ahead.delete(seen.last + 1);
+                seen.last += 1;
+            }
+            return true;
+        };
 
-        const fetchMessages = () => {
+        // A fetched page already contains everything up to its last_seq
+        const advanceSeq = (seq) => {
+            const seen = seqRef.current;
+            if (!seq || seq <= seen.last) return;
+            seen.last = seq;
+            seen.ahead.forEach(s => { if (s <= seq) seen.ahead.delete(s); });
+            while (seen.ahead.has(seen.last + 1)) {
+                seen.ahead.delete(seen.last + 1);
+                seen.last += 1;
+            }
+        };
+
+        let arrivedIds = null; // messages seen on the socket while a reset fetch is in flight
+
+        // reset: initial load or resync. The page replaces the list and moves
+        // the seq cursor. The backup poll only merges: it can't tell which
+        // events (deletes, clears) it saw, so it must not skip any.
+        const fetchMessages = (reset = false) => {
             if (!currentUser) return; // Don't fetch if user not ready
+            if (reset) arrivedIds = new Set();
 
+            // Newest page only; older history is loaded on demand
             fetch(`${API_URL}/chats/${chat.id}/messages?user_id=${currentUser.id}`)
                 .then(res => {
                     if (!res.ok) throw new Error("Failed to fetch messages");
                     return res.json();
                 })
                 .then(data => {
-                    const dataStr = JSON.stringify(data);
+                    if (reset) {
+                        setOlderCursor(data.next_before_id);
+                        advanceSeq(data.last_seq);
+                        lastMessagesRef.current = "";
+                    }
+                    const dataStr = JSON.stringify(data.messages);
                     if (dataStr !== lastMessagesRef.current) {
                         lastMessagesRef.current = dataStr;
-                        setMessages(data);
+                        if (reset) {
+                            // Keep only what arrived on the socket meanwhile
+                            const arrived = arrivedIds || new Set();
+                            arrivedIds = null;
+                            setMessages(prev => mergeMessages(data.messages, prev.filter(m => arrived.has(m.id))));
+                        } else {
+                            setMessages(prev => mergeMessages(prev, data.messages));
+                        }
 
-                        const pinned = data.filter(m => m.isPinned);
+                        const pinned = data.messages.filter(m => m.isPinned);
                         if (JSON.stringify(pinned) !== JSON.stringify(pinnedMessages)) {
                             setPinnedMessages(pinned);
                             if (pinned.length > 0 && pinned.length > pinnedMessages.length) setActivePinIndex(pinned.length - 1);
@@ -232,20 +292,43 @@ const ChatWindow = ({ chat, chats, userStatuses, currentUser, onBack, onDeleteCh
                 .catch(err => console.error("Failed to fetch messages", err));
         };
 
-        fetchMessages(); // Initial fetch
+        fetchMessages(true); // Initial fetch
 
         // WebSocket Connection
         const wsProtocol = window.location.protocol === 'https:' ? 'wss:' : 'ws:';
         const wsBase = API_URL.replace(/^http/, 'ws');
-        const socket = new WebSocket(`${wsBase}/ws/${chat.id}/${currentUser?.id || 0}`);
+        let socket = null;
+        let closed = false;
+        let retries = 0;
+        let reconnectTimer = null;
+
+        const connect = () => {
+            // After a drop, resume from the last seq: the server replays only what we missed
+            const resume = seqRef.current.last ? `?last_seq=${seqRef.current.last}` : '';
+            socket = new WebSocket(`${wsBase}/ws/${chat.id}/${currentUser?.id || 0}${resume}`);
+
+            socket.onopen = () => {
+                console.log("WebSocket Connected");
+                retries = 0;
+            };
 
-        socket.onopen = () => {
-            console.log("WebSocket Connected");
+            socket.onmessage = handleEvent;
+
+            socket.onclose = () => {
+                console.log("WebSocket Disconnected");
+                if (closed) return;
+                // Jittered backoff so a server restart isn't met by every client at once
+                const delay = Math.min(30000, 1000 * 2 ** retries) * (0.5 + Math.random() / 2);
+                retries += 1;
+                reconnectTimer = setTimeout(connect, delay);
+            };
         };
 
-        socket.onmessage = (event) => {
+        const handleEvent = (event) => {
             const msg = JSON.parse(event.data);
 
+            if (msg.seq && !acceptSeq(msg.seq)) return;
+
             // Handle Participant Updates
             if (msg.type === 'participant_update') {
                 console.log("Received participant update", msg.participants);
@@ -258,9 +341,51 @@ const ChatWindow = ({ chat, chats, userStatuses, currentUser, onBack, onDeleteCh
                 return;
             }
 
+            // Server dropped our backlog (slow connection); refetch instead
+            if (msg.type === 'resync') {
+                fetchMessages(true);
+                return;
+            }
+
+            if (msg.type === 'chat_cleared') {
+                if (arrivedIds) arrivedIds.clear();
+                setMessages([]);
+                return;
+            }
+
+            // Handle Read Receipts
+            if (msg.type === 'messages_read') {
+                if (msg.chat_id === chat.id) {
+                    setMessages(prev => prev.map(m => {
+                        // If I sent the message, mark it as read
+                        if (m.sender === 'me' || String(m.sender) === String(currentUser?.id)) {
+                            return { ...m, status: 'read' };
+                        }
+                        return m;
+                    }));
+                }
+                return;
+            }
+
+            if (msg.type === 'chat_deleted') {
+                return;
+            }
+
+            // Bulk pin/delete: one event for the whole batch
+            if (msg.type === 'messages_updated') {
+                const updates = new Map(msg.messages.map(m => [m.id, m]));
+                setMessages(prev => prev.map(m => updates.get(m.id) || m));
+                setPinnedMessages(prev => [
+                    ...prev.filter(p => !updates.has(p.id)),
+                    ...msg.messages.filter(m => m.isPinned)
+                ].sort((a, b) => a.id - b.id));
+                return;
+            }
+
             // Handle Normal Messages
             // Handle Normal Messages
             const incomingMsg = msg;
+            if (arrivedIds) arrivedIds.add(incomingMsg.id);
             setMessages(prev => {
                 const existingIndex = prev.findIndex(m => m.id === incomingMsg.id);
                 if (existingIndex !== -1) {
@@ -273,17 +398,6 @@ const ChatWindow = ({ chat, chats, userStatuses, currentUser, onBack, onDeleteCh
                 return [...prev, incomingMsg];
             });
 
-            // Handle Read Receipts
-            if (msg.type === 'messages_read' && msg.chat_id === chat.id) {
-                setMessages(prev => prev.map(m => {
-                    // If I sent the message, mark it as read
-                    if (m.sender === 'me' || String(m.sender) === String(currentUser?.id)) {
-                        return { ...m, status: 'read' };
-                    }
-                    return m;
-                }));
-            }
-
             // Auto-close call if it ended
             if (incomingMsg.callStatus === 'ended') {
                 setCallRoomName(currentRoom => {
@@ -296,14 +410,14 @@ const ChatWindow = ({ chat, chats, userStatuses, currentUser, onBack, onDeleteCh
             }
         };
 
-        socket.onclose = () => {
-            console.log("WebSocket Disconnected");
-        };
+        connect();
 
         // Keep polling as backup (slower interval)
-        const interval = setInterval(fetchMessages, 10000);
+        const interval = setInterval(() => fetchMessages(false), 10000);
 
         return () => {
+            closed = true;
+            clearTimeout(reconnectTimer);
             socket.close();
             clearInterval(interval);
         };
@@ -491,16 +605,9 @@ const ChatWindow = ({ chat, chats, userStatuses, currentUser, onBack, onDeleteCh
         };
         setMessages(prev => [...prev, tempMessage]);
 
-        const formData = new FormData();
-        formData.append('file', audioBlob, 'voice_message.webm');
-
         try {
             // Upload
-            const response = await fetch(`${API_URL}/upload`, {
-                method: 'POST',
-                body: formData
-            });
-            const data = await response.json();
+            const data = await UploadService.uploadFile(audioBlob, 'voice_message.webm');
 
             // Send Message
             const messageToSend = {
@@ -697,6 +804,19 @@ const ChatWindow = ({ chat, chats, userStatuses, currentUser, onBack, onDeleteCh
         });
     };
 
+    // Analysis runs as a background job on the server; poll until it finishes
+    const waitForAnalysis = async (response) => {
+        const { job_id } = await response.json();
+        for (let attempt = 0; attempt < 60; attempt++) {
+            await new Promise(resolve => setTimeout(resolve, 1000));
+            const res = await fetch(`${API_URL}/analysis-jobs/${job_id}`);
+            const job = await res.json();
+            if (job.status === 'done') return job.result;
+            if (job.status === 'failed') throw new Error(job.error || 'Analysis failed');
+        }
+        throw new Error('Analysis timed out');
+    };
+
     const handleAnalyzeFile = async (filename) => {
         showNotification(`Analyzing ${filename}...`);
         try {
@@ -708,7 +828,7 @@ const ChatWindow = ({ chat, chats, userStatuses, currentUser, onBack, onDeleteCh
                     content_preview: "File content placeholder" // In a real app, we'd send actual content
                 })
             });
-            const data = await response.json();
+            const data = await waitForAnalysis(response);
 
             if (data.is_idea) {
                 showNotification("File saved to Idea Hub! 💡");
@@ -732,7 +852,7 @@ const ChatWindow = ({ chat, chats, userStatuses, currentUser, onBack, onDeleteCh
                     sender: sender
                 })
             });
-            const data = await response.json();
+            const data = await waitForAnalysis(response);
 
             if (data.is_idea) {
                 showNotification("Idea saved to Idea Hub! 💡");
@@ -898,6 +1018,13 @@ const ChatWindow = ({ chat, chats, userStatuses, currentUser, onBack, onDeleteCh
                         </div>
                     </div>
                 )}
+                {olderCursor && (
+                    <div className="flex justify-center">
+                        <button onClick={loadOlderMessages} className="bg-white text-gray-600 text-xs px-3 py-1 rounded-full shadow-sm border hover:bg-gray-50">
+                            Load older messages
+                        </button>
+                    </div>
+                )}
                 {messages.map((msg) => {
                     // Fix: Use String conversion to handle '1' vs 1 mismatch
                     const isMe = msg.sender === 'me' || String(msg.sender) === String(currentUser?.id);
@@ -1006,12 +1133,25 @@ const ChatWindow = ({ chat, chats, userStatuses, currentUser, onBack, onDeleteCh
                                             }
                                         }}
                                     >
-                                        <div className={`p-2 rounded-lg ${/\.(jpg|jpeg|png|gif|webp)$/i.test(msg.filename || msg.fileName || msg.filename) ? 'bg-purple-100 text-purple-500' : 'bg-red-100 text-red-500'}`}>
-                                            {/\.(jpg|jpeg|png|gif|webp)$/i.test(msg.filename || msg.fileName || msg.filename) ? <Image size={24} /> : <Paperclip size={24} />}
-                                        </div>
+                                        {(msg.thumbUrl || msg.thumburl) ? (
+                                            // Small server-side thumbnail instead of the full file
+                                            <img
+                                                src={`${API_URL}${msg.thumbUrl || msg.thumburl}`}
+                                                alt={msg.filename || msg.fileName || "attachment"}
+                                                loading="lazy"
+                                                className="w-16 h-16 object-cover rounded-lg"
+                                            />
+                                        ) : (
+                                            <div className={`p-2 rounded-lg ${/\.(jpg|jpeg|png|gif|webp)$/i.test(msg.filename || msg.fileName || msg.filename) ? 'bg-purple-100 text-purple-500' : 'bg-red-100 text-red-500'}`}>
+                                                {/\.(jpg|jpeg|png|gif|webp)$/i.test(msg.filename || msg.fileName || msg.filename) ? <Image size={24} /> : <Paperclip size={24} />}
+                                            </div>
+                                        )}
                                         <div className="flex-1 min-w-0">
                                             <p className="font-medium text-gray-800 truncate text-sm">{msg.filename || msg.fileName || msg.filename || "Unknown File"}</p>
                                             <p className="text-xs text-gray-500">{msg.size || msg.fileSize || msg.filesize || "Unknown size"}</p>
+                                            {(msg.previewText || msg.previewtext) && (
+                                                <p className="text-xs text-gray-600 line-clamp-2 mt-1">{msg.previewText || msg.previewtext}</p>
+                                            )}
                                         </div>
                                         <button className="opacity-0 group-hover/file:opacity-100 absolute -left-10 top-2 bg-yellow-100 text-yellow-700 p-1.5 rounded-full shadow-sm hover:bg-yellow-200 transition-opacity" title="Mark as Idea" onClick={(e) => { e.stopPropagation(); const url = msg.fileUrl || msg.fileurl; const serverFilename = url ? url.split('/').pop() : (msg.filename || msg.fileName); console.log("Did click analyze", serverFilename); handleAnalyzeFile(serverFilename); }}>
                                             <Lightbulb size={16} />
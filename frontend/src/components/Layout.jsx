@@ -1,4 +1,4 @@
-import React, { useState, useEffect } from 'react';
+import React, { useState, useEffect, useRef } from 'react';
 import Sidebar from './Sidebar';
 import ChatWindow from './ChatWindow';
 import IdeaHub from './IdeaHub';
@@ -42,6 +42,12 @@ const Layout = () => {
   const [chats, setChats] = useState([]);
   const [userStatuses, setUserStatuses] = useState({}); // userId -> {status, lastSeen}
 
+  // Latest selected chat for the socket handler (avoids reconnecting on every change)
+  const selectedChatRef = useRef(null);
+  useEffect(() => {
+    selectedChatRef.current = selectedChat;
+  }, [selectedChat]);
+
   // WebSocket Connection
   useEffect(() => {
     if (user) {
@@ -52,14 +58,51 @@ const Layout = () => {
         console.log("Connected to WebSocket");
       };
 
+      const handleStatus = (data) => {
+        setUserStatuses(prev => ({
+          ...prev,
+          [data.userId]: { status: data.status, lastSeen: new Date().toLocaleTimeString() }
+        }));
+      };
+
       ws.onmessage = (event) => {
         try {
           const data = JSON.parse(event.data);
           if (data.type === 'status_update') {
-            setUserStatuses(prev => ({
-              ...prev,
-              [data.userId]: { status: data.status, lastSeen: new Date().toLocaleTimeString() }
-            }));
+            handleStatus(data);
+            return;
+          }
+          // Server dropped our backlog (slow connection); refetch the list
+          if (data.type === 'resync') {
+            fetch(`${API_URL}/users/${user.id}/chats`)
+              .then(res => res.json())
+              .then(setChats)
+              .catch(err => console.error("Failed to fetch chats", err));
+            return;
+          }
+          // Events for any of this user's chats, multiplexed on one socket
+          if (data.type === 'chat_event') {
+            const payload = data.payload || {};
+            if (payload.type === 'status_update') {
+              handleStatus(payload);
+            } else if (payload.id && payload.sender !== undefined) {
+              setChats(prev => {
+                const index = prev.findIndex(c => c.id === data.chat_id);
+                if (index === -1) return prev;
+                const current = prev[index];
+                // Edits/pins re-send known ids; only count new messages
+                if (current.lastMessageId && payload.id <= current.lastMessageId) return prev;
+                const isOpen = selectedChatRef.current?.id === data.chat_id;
+                const isMine = String(payload.sender) === String(user.id);
+                const updated = {
+                  ...current,
+                  lastMessage: payload.text || 'Sent a file',
+                  lastMessageId: payload.id,
+                  unread: isOpen || isMine ? current.unread : (current.unread || 0) + 1
+                };
+                return [updated, ...prev.slice(0, index), ...prev.slice(index + 1)];
+              });
+            }
           }
         } catch (e) {
           console.error("Error parsing WS message", e);
@@ -79,9 +122,10 @@ const Layout = () => {
     }
   }, [user]);
 
-  // Fetch chats on mount
+  // Fetch chats on mount (only this user's chats, with unread counts)
   useEffect(() => {
-    fetch(`${API_URL}/chats`)
+    if (!user) return;
+    fetch(`${API_URL}/users/${user.id}/chats`)
       .then(res => res.json())
       .then(data => {
         console.log("Fetched chats:", data);
@@ -220,7 +264,7 @@ const Layout = () => {
       })
       .then(() => {
         // Refresh chats to show the new group
-        return fetch(`${API_URL}/chats`);
+        return fetch(`${API_URL}/users/${user.id}/chats`);
       })
       .then(res => res.json())
       .then(data => {
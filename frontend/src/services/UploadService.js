@@ -0,0 +1,77 @@
+// UploadService.js - File uploads; large files use the resumable chunked protocol
+
+const API_URL = import.meta.env.VITE_API_URL || 'http://localhost:8000';
+const CHUNKED_THRESHOLD = 8 * 1024 * 1024;
+const MAX_RETRIES = 5;
+
+const sleep = (ms) => new Promise(resolve => setTimeout(resolve, ms));
+
+const readError = async (response, fallback) => {
+    const errData = await response.json().catch(() => ({}));
+    const detail = errData.detail;
+    return new Error((detail && detail.message) || detail || fallback);
+};
+
+const UploadService = {
+    // Returns { url, filename, size, sha256 }
+    uploadFile: async (file, filename = file.name) => {
+        if (file.size < CHUNKED_THRESHOLD) {
+            return UploadService.uploadDirect(file, filename);
+        }
+        return UploadService.uploadChunked(file, filename);
+    },
+
+    uploadDirect: async (file, filename) => {
+        const formData = new FormData();
+        formData.append('file', file, filename);
+        const response = await fetch(`${API_URL}/upload`, { method: 'POST', body: formData });
+        if (!response.ok) throw await readError(response, "Upload failed");
+        return response.json();
+    },
+
+    uploadChunked: async (file, filename) => {
+        const initRes = await fetch(`${API_URL}/upload/init`, {
+            method: 'POST',
+            headers: { 'Content-Type': 'application/json' },
+            body: JSON.stringify({ filename, size: file.size })
+        });
+        if (!initRes.ok) throw await readError(initRes, "Upload failed");
+        const session = await initRes.json();
+
+        let offset = 0;
+        let retries = 0;
+        while (offset < file.size) {
+            const chunk = file.slice(offset, offset + session.chunk_size);
+            try {
+                const res = await fetch(`${API_URL}/upload/${session.upload_id}/append?offset=${offset}`, {
+                    method: 'POST',
+                    headers: { 'Content-Type': 'application/octet-stream' },
+                    body: chunk
+                });
+                if (res.ok) {
+                    offset = (await res.json()).received;
+                    retries = 0;
+                    continue;
+                }
+                if (res.status !== 409) {
+                    const error = await readError(res, "Upload failed");
+                    error.fatal = res.status < 500;
+                    throw error;
+                }
+            } catch (error) {
+                if (error.fatal || ++retries > MAX_RETRIES) throw error;
+                await sleep(1000 * retries);
+            }
+            // Connection dropped or offset mismatch: ask the server where to resume
+            const statusRes = await fetch(`${API_URL}/upload/${session.upload_id}`);
+            if (!statusRes.ok) throw await readError(statusRes, "Upload failed");
+            offset = (await statusRes.json()).received;
+        }
+
+        const completeRes = await fetch(`${API_URL}/upload/${session.upload_id}/complete`, { method: 'POST' });
+        if (!completeRes.ok) throw await readError(completeRes, "Upload failed");
+        return completeRes.json();
+    }
+};
+
+export default UploadService;